@@ -1,5 +1,9 @@
-from django.contrib import admin
-from .models import Family, Student, LessonSlot, Reservation, Waitlist
+import json
+
+from django.contrib import admin, messages
+from django.utils import timezone
+from .jobs import is_sensitive
+from .models import Family, Student, LessonSlot, Reservation, Waitlist, RecurrenceRule, RecurrenceException, Job
 
 # 家族/保護者モデルのインライン表示
 class StudentInline(admin.TabularInline):
@@ -18,10 +22,32 @@ class StudentAdmin(admin.ModelAdmin):
     list_filter = ('family',)
     search_fields = ('name', 'family__user__username')
 
+# 繰り返しルールの休講日のインライン表示
+class RecurrenceExceptionInline(admin.TabularInline):
+    model = RecurrenceException
+    extra = 1
+
+@admin.register(RecurrenceRule)
+class RecurrenceRuleAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'weekday', 'start_time', 'end_time', 'capacity', 'valid_from', 'valid_until', 'is_active')
+    list_filter = ('weekday', 'is_active')
+    search_fields = ('title',)
+    inlines = [RecurrenceExceptionInline]
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # 同じ日時・授業名の授業枠がすでにあるため、授業名を変更できなかった授業枠
+        for slot in getattr(obj, '_conflicting_slots', []):
+            self.message_user(
+                request,
+                f"{timezone.localtime(slot.start_time):%Y/%m/%d %H:%M} の授業枠は、同じ日時・授業名の授業枠がすでにあるため授業名を「{slot.title}」のままにしました（定員は更新しました）。",
+                messages.WARNING,
+            )
+
 @admin.register(LessonSlot)
 class LessonSlotAdmin(admin.ModelAdmin):
-    list_display = ('title', 'start_time', 'capacity', 'reservation_start_time', 'available_slots')
-    list_filter = ('start_time', 'reservation_start_time')
+    list_display = ('title', 'start_time', 'capacity', 'reserved_count', 'waitlist_count', 'reservation_start_time', 'available_slots')
+    list_filter = ('start_time', 'reservation_start_time', 'recurrence_rule')
     search_fields = ('title',)
 
 @admin.register(Reservation)
@@ -36,3 +62,17 @@ class WaitlistAdmin(admin.ModelAdmin):
     list_filter = ('lesson_slot__title', 'waitlisted_at')
     search_fields = ('student__name', 'lesson_slot__title')
     readonly_fields = ('waitlisted_at',)
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'run_at', 'attempts', 'max_attempts', 'locked_by', 'finished_at')
+    list_filter = ('status', 'name')
+    # 引数は編集させず、パスワードなどを含むジョブの引数は表示もしない
+    exclude = ('payload',)
+    readonly_fields = ('payload_display', 'attempts', 'last_error', 'locked_by', 'locked_at', 'created_at', 'finished_at')
+
+    @admin.display(description='引数')
+    def payload_display(self, obj):
+        if is_sensitive(obj.name):
+            return '（機密情報を含むため非表示）'
+        return json.dumps(obj.payload, ensure_ascii=False)
@@ -1,9 +1,29 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
-from datetime import timedelta, datetime
-from .forms import LessonSlotCreateForm, LessonSlotEditForm, StudentForm
-from .models import LessonSlot, Reservation, Waitlist, Family, Student
+from django.db import transaction
+from django.db.models import Case, IntegerField, Prefetch, Q, Value, When
+from django.core.handlers.asgi import ASGIRequest
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
+from datetime import timedelta
+from .analytics import WEEKDAY_LABELS, occupancy_report
+from .availability import by_local_date, window_availability
+from .calendar_cache import CALENDAR_FRAGMENT_TIMEOUT, cached_fragment_dates, date_versions
+from .calendar_window import CalendarWindow
+from .exports import EXPORTS, aiter_chunks, export_queryset, stream_csv
+from .jobs import enqueue
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, collect as collect_metrics, render_prometheus
+from .forms import FamilyImportForm, LessonSlotCreateForm, LessonSlotEditForm, OccupancyReportForm, ReservationFilterForm, StudentForm
+from .models import LessonSlot, Reservation, Family, Student
+from .onboarding import COLUMNS as FAMILY_IMPORT_COLUMNS, import_families as import_family_rows, parse_family_csv, stash_upload
+from .pagination import Cursor, paginate_recent
+from .recurrence import materialize_window, skip_occurrence
+from .services import ReservationStatus, promote_waitlist, release_reservation, remove_student, reserve_seat
+from .slot_generation import generate_slot_definitions, parse_time_slots, write_lesson_slots
+from .stats import dashboard_stats
 from django.utils import timezone
 from django.contrib.auth.models import User
 
@@ -15,23 +35,52 @@ def is_staff(user):
 @login_required
 @user_passes_test(is_staff)
 def admin_dashboard(request):
-    """管理者ダッシュボード"""
-    total_lessons = LessonSlot.objects.count()
-    upcoming_lessons = LessonSlot.objects.filter(start_time__gte=timezone.now()).count()
-    total_reservations = Reservation.objects.count()
-    total_students = Student.objects.count()
-    total_families = Family.objects.count()
+    """管理者ダッシュボード（統計は短時間キャッシュしたものを表示）"""
+    stats = dashboard_stats()
     
     context = {
-        'total_lessons': total_lessons,
-        'upcoming_lessons': upcoming_lessons,
-        'total_reservations': total_reservations,
-        'total_students': total_students,
-        'total_families': total_families,
+        'total_lessons': stats.total_lessons,
+        'upcoming_lessons': stats.upcoming_lessons,
+        'total_reservations': stats.total_reservations,
+        'total_students': stats.total_students,
+        'total_families': stats.total_families,
+        'stats': stats,
+        'weekly': [
+            ('予約', '#007bff', stats.weekly['reserved']),
+            ('キャンセル', '#dc3545', stats.weekly['cancelled']),
+            ('補欠登録', '#ffc107', stats.weekly['waitlisted']),
+        ],
     }
     return render(request, 'booking/admin/dashboard.html', context)
 
+# 利用状況レポート（曜日・時間帯ごとの予約率・満席までの時間・補欠数）
+# 期間を指定しない場合に集計する日数（今日まで）
+OCCUPANCY_REPORT_DEFAULT_DAYS = 365
+
+@login_required
+@user_passes_test(is_staff)
+def occupancy_report_view(request):
+    """利用状況レポート"""
+    today = timezone.localdate()
+    form = OccupancyReportForm(request.GET or {
+        'date_from': today - timedelta(days=OCCUPANCY_REPORT_DEFAULT_DAYS - 1),
+        'date_to': today,
+    })
+    report = None
+    if form.is_valid():
+        report = occupancy_report(form.cleaned_data['date_from'], form.cleaned_data['date_to'])
+    
+    context = {
+        'form': form,
+        'report': report,
+        'weekdays': WEEKDAY_LABELS,
+    }
+    return render(request, 'booking/admin/occupancy_report.html', context)
+
 # 授業枠一括作成機能
+# この件数を超える場合はリクエスト内で作成せずバックグラウンドジョブに任せる
+SLOT_GENERATION_ASYNC_THRESHOLD = 1000
+
 @login_required
 @user_passes_test(is_staff)
 def create_lesson_slots(request):
@@ -40,58 +89,41 @@ def create_lesson_slots(request):
         form = LessonSlotCreateForm(request.POST)
         if form.is_valid():
             data = form.cleaned_data
-            
-            start_date = data["start_date"]
-            end_date = data["end_date"]
             days_of_week = [int(d) for d in data["days_of_week"]]
-            time_slots = data["time_slots"]
-            capacity = data["capacity"]
-            title = data["title"]
-            reservation_start_datetime = data["reservation_start_datetime"]
-
-            # 授業名が空の場合のデフォルト設定
-            if not title:
-                title = "書道教室"
-
-            current_date = start_date
-            created_count = 0
-            
-            # 時間スロットをパース
-            time_pairs = []
-            for line in time_slots.strip().split('\n'):
-                line = line.strip()
-                if line and '-' in line:
-                    try:
-                        start_str, end_str = line.split('-')
-                        start_time = datetime.strptime(start_str.strip(), '%H:%M').time()
-                        end_time = datetime.strptime(end_str.strip(), '%H:%M').time()
-                        time_pairs.append((start_time, end_time))
-                    except ValueError:
-                        continue
-            
-            # 期間内の日付を反復処理
-            while current_date <= end_date:
-                # 選択された曜日であるかチェック
-                if current_date.weekday() in days_of_week:
-                    # 各時間スロットに対して授業枠を作成
-                    for start_time, end_time in time_pairs:
-                        lesson_start_dt = datetime.combine(current_date, start_time, tzinfo=timezone.get_current_timezone())
-                        lesson_end_dt = datetime.combine(current_date, end_time, tzinfo=timezone.get_current_timezone())
-                        
-                        # 授業枠を作成
-                        LessonSlot.objects.create(
-                            title=title,
-                            start_time=lesson_start_dt,
-                            end_time=lesson_end_dt,
-                            capacity=capacity,
-                            reservation_start_time=reservation_start_datetime
-                        )
-                        created_count += 1
-                
-                # 次の日へ
-                current_date += timedelta(days=1)
-
-            messages.success(request, f"授業枠を {created_count} 件作成しました。")
+            definitions = list(generate_slot_definitions(
+                data["start_date"],
+                data["end_date"],
+                days_of_week,
+                parse_time_slots(data["time_slots"]),
+                title=data["title"],
+                capacity=data["capacity"],
+                reservation_start_time=data["reservation_start_datetime"],
+            ))
+
+            # プレビューの場合は件数のみ集計して保存しない
+            if "preview" in request.POST:
+                preview = write_lesson_slots(definitions, dry_run=True)
+                return render(request, "booking/admin/create_lesson.html", {"form": form, "preview": preview})
+
+            # 件数が多い場合はバックグラウンドジョブで作成する
+            if len(definitions) > SLOT_GENERATION_ASYNC_THRESHOLD:
+                enqueue("create_lesson_slots", {
+                    "start_date": data["start_date"].isoformat(),
+                    "end_date": data["end_date"].isoformat(),
+                    "days_of_week": days_of_week,
+                    "time_slots": data["time_slots"],
+                    "title": data["title"],
+                    "capacity": data["capacity"],
+                    "reservation_start_time": data["reservation_start_datetime"].isoformat(),
+                })
+                messages.success(request, f"授業枠 {len(definitions)} 件の作成を受け付けました。バックグラウンドで作成されます。")
+                return redirect("admin_lesson_list")
+
+            result = write_lesson_slots(definitions)
+            if result.skipped:
+                messages.success(request, f"授業枠を {result.created} 件作成しました。（既存と重複する {result.skipped} 件はスキップしました）")
+            else:
+                messages.success(request, f"授業枠を {result.created} 件作成しました。")
             return redirect("admin_lesson_list")
     else:
         form = LessonSlotCreateForm()
@@ -121,9 +153,14 @@ def edit_lesson_slot(request, lesson_id):
     lesson = get_object_or_404(LessonSlot, pk=lesson_id)
     
     if request.method == 'POST':
+        old_capacity = lesson.capacity
         form = LessonSlotEditForm(request.POST, instance=lesson)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
+                # 定員が増えた場合は同じトランザクションで補欠を繰り上げる
+                if lesson.capacity > old_capacity:
+                    promote_waitlist(lesson.pk)
             messages.success(request, f"授業枠「{lesson.title}」を更新しました。")
             return redirect('admin_lesson_list')
     else:
@@ -144,6 +181,8 @@ def delete_lesson_slot(request, lesson_id):
     
     if request.method == 'POST':
         lesson_title = lesson.title
+        # 繰り返しルールの回は休講日として登録し、再作成されないようにする
+        skip_occurrence(lesson)
         lesson.delete()
         messages.success(request, f"授業枠「{lesson_title}」を削除しました。")
         return redirect('admin_lesson_list')
@@ -176,14 +215,65 @@ def create_lesson_single(request):
 @login_required
 @user_passes_test(is_staff)
 def reservation_list(request):
-    """予約一覧"""
-    reservations = Reservation.objects.all().order_by('-reserved_at')
+    """予約一覧（予約日時の新しい順に、キーセットページングで1ページずつ表示）"""
+    form = ReservationFilterForm(request.GET)
+    reservations = Reservation.objects.select_related('lesson_slot', 'student__family__user')
+    if form.is_valid():
+        reservations = form.filter(reservations)
+    
+    # ページ位置が不正な場合は先頭ページを表示
+    cursors = {}
+    for key in ('after', 'before'):
+        try:
+            cursors[key] = Cursor.decode(request.GET[key])
+        except (KeyError, ValueError):
+            cursors[key] = None
+    page = paginate_recent(reservations, 'reserved_at', **cursors)
+    
+    # ページ移動のリンクには絞り込み条件だけを引き継ぐ
+    filter_query = request.GET.copy()
+    for key in ('after', 'before'):
+        filter_query.pop(key, None)
     
     context = {
-        'reservations': reservations
+        'reservations': page.items,
+        'page': page,
+        'form': form,
+        'filter_query': filter_query.urlencode(),
     }
     return render(request, 'booking/admin/reservation_list.html', context)
 
+# CSV 出力（予約履歴・授業ごとの名簿・補欠）
+@login_required
+@user_passes_test(is_staff)
+def export_csv(request, kind):
+    """予約一覧と同じ条件で絞り込んだ CSV を、全件を読み込まずに少しずつ送信する"""
+    export = EXPORTS.get(kind)
+    if export is None:
+        raise Http404
+    form = ReservationFilterForm(request.GET)
+    if not form.is_valid():
+        messages.error(request, '絞り込み条件が正しくないため、CSV を出力できませんでした。')
+        return redirect('admin_reservation_list')
+    
+    chunks = stream_csv(export, export_queryset(export, form))
+    if isinstance(request, ASGIRequest):
+        chunks = aiter_chunks(chunks)
+    response = StreamingHttpResponse(chunks, content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{kind}-{timezone.localdate():%Y%m%d}.csv"'
+    return response
+
+# メトリクス（Prometheus のテキスト形式）
+def _has_metrics_token(request):
+    token = settings.METRICS_TOKEN
+    return bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+def metrics(request):
+    """URL 名ごとのレスポンス時間・SQL の件数と時間・レスポンスのサイズ（管理者、または METRICS_TOKEN で取得）"""
+    if not (request.user.is_staff or _has_metrics_token(request)):
+        raise PermissionDenied
+    return HttpResponse(render_prometheus(collect_metrics()), content_type=METRICS_CONTENT_TYPE)
+
 # 生徒管理一覧
 @login_required
 @user_passes_test(is_staff)
@@ -196,6 +286,43 @@ def student_management(request):
     }
     return render(request, 'booking/admin/student_management.html', context)
 
+# 保護者・生徒の CSV 一括登録
+# この家族数を超える場合はパスワードのハッシュ化に時間がかかるため、バックグラウンドジョブに任せる
+FAMILY_IMPORT_ASYNC_THRESHOLD = 10
+
+@login_required
+@user_passes_test(is_staff)
+def import_families(request):
+    """保護者・生徒の CSV 一括登録（確認のみの場合は検証結果を表示して保存しない）"""
+    plan = None
+    if request.method == "POST":
+        form = FamilyImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            csv_text = form.cleaned_data["file"]
+            plan = parse_family_csv(csv_text)
+            if "preview" not in request.POST and not plan.errors:
+                if not plan.families:
+                    messages.error(request, "登録できる保護者がありません。")
+                elif len(plan.families) > FAMILY_IMPORT_ASYNC_THRESHOLD:
+                    # CSV はパスワードを含むため、ジョブにはキャッシュに保存した CSV の参照だけを渡す
+                    enqueue("import_families", {"upload": stash_upload(csv_text)})
+                    messages.success(request, f"保護者 {len(plan.families)} 件・生徒 {plan.student_count} 件の登録を受け付けました。バックグラウンドで登録されます。")
+                    return redirect("admin_student_management")
+                else:
+                    # 件数が少ないため、リクエストのプロセス内で順番にハッシュ化する（並列化はジョブのワーカーだけで行う）
+                    result = import_family_rows(plan, workers=1)
+                    messages.success(request, f"保護者 {result.families} 件・生徒 {result.students} 件を登録しました。")
+                    return redirect("admin_student_management")
+    else:
+        form = FamilyImportForm()
+
+    context = {
+        "form": form,
+        "plan": plan,
+        "columns": FAMILY_IMPORT_COLUMNS,
+    }
+    return render(request, "booking/admin/import_families.html", context)
+
 # 生徒追加
 @login_required
 @user_passes_test(is_staff)
@@ -251,7 +378,7 @@ def delete_student_admin(request, student_id):
     
     if request.method == 'POST':
         student_name = student.name
-        student.delete()
+        remove_student(student)
         messages.success(request, f"生徒「{student_name}」を削除しました。")
         return redirect('admin_student_management')
     
@@ -271,7 +398,7 @@ def cancel_reservation_admin(request, reservation_id):
     if request.method == 'POST':
         student_name = reservation.student.name
         lesson_title = reservation.lesson_slot.title or '書道教室'
-        reservation.delete()
+        release_reservation(reservation)
         messages.success(request, f'{student_name}の"{lesson_title}"への予約をキャンセルしました。')
         return redirect('admin_reservation_list')
     
@@ -288,27 +415,88 @@ def admin_reservation_calendar(request):
     """管理者用予約カレンダー"""
     from collections import defaultdict
     
-    # 今後の授業枠を取得
-    lessons = LessonSlot.objects.filter(start_time__gte=timezone.now()).order_by('start_time')
+    window = CalendarWindow.from_request(request)
+    # 繰り返しルールの回のうち、表示期間内で未作成のものを作成し、前後の期間へのリンクを求める
+    occurrences = materialize_window(window)
+    window.resolve_links(LessonSlot.objects.all(), occurrences)
+    has_students = Student.objects.exists()
     
-    # 日付ごとにグループ化
-    lessons_by_date = defaultdict(list)
-    for lesson in lessons:
-        date_key = lesson.start_time.date()
-        lessons_by_date[date_key].append(lesson)
+    # 表示期間内の授業枠の日付は空き状況スナップショットから求める
+    slots_by_date = by_local_date(window_availability(window.start, window.end))
+    versions = date_versions([date_key for date_key, _ in slots_by_date])
+    cached_dates = cached_fragment_dates(
+        'admin_calendar_day',
+        {date_key: [date_key, versions[date_key], has_students] for date_key, _ in slots_by_date},
+    )
     
-    # 日付順にソート
-    sorted_lessons_by_date = sorted(lessons_by_date.items())
-    
-    # 全生徒を取得
-    all_students = Student.objects.all().select_related('family__user').order_by('family__user__username', 'name')
+    # 授業枠と予約者は断片キャッシュがない日付の分だけ一括取得する
+    # （キャッシュがある日付も、描画までに期限切れになった場合に備えて遅延評価のクエリセットを渡す）
+    lessons = LessonSlot.objects.prefetch_related(
+        Prefetch('reservation_set', queryset=Reservation.objects.select_related('student__family__user'))
+    ).order_by('start_time')
+    missed = defaultdict(list)
+    for lesson in lessons.filter(pk__in=[
+        pk for date_key, slots in slots_by_date if date_key not in cached_dates for pk, _ in slots
+    ]):
+        missed[timezone.localtime(lesson.start_time).date()].append(lesson)
+    sorted_lessons_by_date = [
+        (
+            date_key,
+            lessons.filter(pk__in=[pk for pk, _ in slots]) if date_key in cached_dates else missed[date_key],
+            versions[date_key],
+        )
+        for date_key, slots in slots_by_date
+    ]
     
+    # 生徒は選択時に admin_student_search から検索して取得する
     context = {
         'lessons_by_date': sorted_lessons_by_date,
-        'all_students': all_students,
+        'has_students': has_students,
+        'window': window,
+        'fragment_timeout': CALENDAR_FRAGMENT_TIMEOUT,
     }
     return render(request, 'booking/admin/calendar.html', context)
 
+# 生徒検索(管理者用カレンダーの生徒選択で使用)
+STUDENT_SEARCH_DEFAULT_LIMIT = 20
+STUDENT_SEARCH_MAX_LIMIT = 50
+
+@login_required
+@user_passes_test(is_staff)
+def student_search(request):
+    """生徒名・保護者ユーザー名で生徒を検索し、Select2 形式の JSON を返す"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        limit = min(max(int(request.GET.get('limit', STUDENT_SEARCH_DEFAULT_LIMIT)), 1), STUDENT_SEARCH_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'page と limit は整数で指定してください。'}, status=400)
+
+    students = Student.objects.select_related('family__user')
+    if query:
+        # 前方一致を部分一致より先に表示する
+        students = students.filter(
+            Q(name__icontains=query) | Q(family__user__username__icontains=query)
+        ).annotate(
+            match_rank=Case(
+                When(name__istartswith=query, then=Value(0)),
+                When(family__user__username__istartswith=query, then=Value(1)),
+                default=Value(2),
+                output_field=IntegerField(),
+            )
+        ).order_by('match_rank', 'family__user__username', 'name', 'pk')
+    else:
+        students = students.order_by('family__user__username', 'name', 'pk')
+
+    # 1件多く取得して次ページの有無を判定
+    offset = (page - 1) * limit
+    rows = list(students[offset:offset + limit + 1])
+    results = [
+        {'id': student.pk, 'text': f'{student.name} ({student.family.user.username})'}
+        for student in rows[:limit]
+    ]
+    return JsonResponse({'results': results, 'pagination': {'more': len(rows) > limit}})
+
 # 管理者による予約作成
 @login_required
 @user_passes_test(is_staff)
@@ -320,14 +508,13 @@ def admin_reserve_lesson(request, lesson_id):
         student_id = request.POST.get('student_id')
         student = get_object_or_404(Student, pk=student_id)
         
-        # 予約処理（管理者は予約開始時刻の制限を受けない）
-        if lesson.available_slots() > 0:
-            try:
-                Reservation.objects.create(lesson_slot=lesson, student=student)
-                messages.success(request, f'{student.name}の予約が完了しました。')
-            except Exception as e:
-                messages.error(request, '予約に失敗しました。すでに予約済みの可能性があります。')
-        else:
+        # 予約処理（管理者は予約開始時刻の制限を受けず、補欠登録済みの生徒は補欠から予約に切り替える）
+        outcome = reserve_seat(lesson, student, enforce_open=False, allow_waitlist=False, from_waitlist=True)
+        if outcome.status == ReservationStatus.RESERVED:
+            messages.success(request, f'{student.name}の予約が完了しました。')
+        elif outcome.status == ReservationStatus.FULL:
             messages.error(request, '満席のため予約できません。')
+        else:
+            messages.error(request, '予約に失敗しました。すでに予約済みの可能性があります。')
 
     return redirect('admin_reservation_calendar')
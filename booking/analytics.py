@@ -0,0 +1,155 @@
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple
+
+from django.db.models import Avg, Case, Count, F, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When, Window
+from django.db.models.functions import Coalesce, ExtractIsoWeekDay, Greatest, TruncTime
+from django.utils import timezone
+from .models import BookingEvent, LessonSlot
+
+WEEKDAY_LABELS = ["月", "火", "水", "木", "金", "土", "日"]
+
+
+class OccupancyCell(NamedTuple):
+    """曜日・開始時刻ごとの集計（weekday は 1=月曜 〜 7=日曜）"""
+    weekday: int
+    start_time: time
+    slots: int
+    capacity: int
+    reserved: int
+    sold_out: int
+    time_to_sellout: timedelta | None
+    # 授業枠ごとの補欠の最大人数の平均と最大
+    waitlist_avg: float
+    waitlist_max: int
+
+    @property
+    def fill_rate(self):
+        """予約率（%）"""
+        return round(self.reserved * 100 / self.capacity) if self.capacity else 0
+
+    @property
+    def heat(self):
+        """ヒートマップの色の濃さ（0〜1）"""
+        return round(min(self.fill_rate, 100) / 100, 2)
+
+    @property
+    def sold_out_rate(self):
+        """満席になった授業枠の割合（%）"""
+        return round(self.sold_out * 100 / self.slots) if self.slots else 0
+
+
+class OccupancyReport(NamedTuple):
+    date_from: date
+    date_to: date
+    cells: list
+
+    @property
+    def rows(self):
+        """ヒートマップの行 [(開始時刻, [月曜〜日曜の OccupancyCell または None])]"""
+        by_key = {(cell.start_time, cell.weekday): cell for cell in self.cells}
+        times = sorted({cell.start_time for cell in self.cells})
+        return [(start_time, [by_key.get((start_time, weekday)) for weekday in range(1, 8)]) for start_time in times]
+
+
+def _sold_out_at():
+    """
+    授業枠が満席になった日時。予約の履歴を日時順に +1（予約）・-1（キャンセル）で累計し（ウィンドウ関数）、
+    累計が定員に達した最初の日時を返す。満席にならなかった場合は NULL。
+    """
+    booked = Window(
+        Sum(Case(When(kind=BookingEvent.KIND_RESERVED, then=Value(1)), default=Value(-1))),
+        partition_by=[F("lesson_slot_id")],
+        order_by=[F("created_at").asc(), F("pk").asc()],
+    )
+    return Subquery(
+        BookingEvent.objects.filter(
+            lesson_slot_id=OuterRef("pk"),
+            kind__in=[BookingEvent.KIND_RESERVED, BookingEvent.KIND_CANCELLED],
+        )
+        .annotate(booked=booked)
+        .filter(booked__gte=OuterRef("capacity"))
+        .order_by("created_at", "pk")
+        .values("created_at")[:1]
+    )
+
+
+def _waitlist_peak():
+    """
+    授業枠の補欠の最大人数。補欠の履歴を日時順に +1（補欠登録）・-1（補欠の解除）で累計し（ウィンドウ関数）、
+    累計の最大値を返す。履歴を記録する前からの補欠も数えられるよう、現在の補欠の人数を下限にする。
+    """
+    depth = Window(
+        Sum(Case(When(kind=BookingEvent.KIND_WAITLISTED, then=Value(1)), default=Value(-1))),
+        partition_by=[F("lesson_slot_id")],
+        order_by=[F("created_at").asc(), F("pk").asc()],
+    )
+    peak = Subquery(
+        BookingEvent.objects.filter(
+            lesson_slot_id=OuterRef("pk"),
+            kind__in=[BookingEvent.KIND_WAITLISTED, BookingEvent.KIND_DEQUEUED],
+        )
+        .annotate(depth=depth)
+        .order_by("-depth")
+        .values("depth")[:1]
+    )
+    return Greatest(Coalesce(peak, Value(0)), F("waitlist_count"), output_field=IntegerField())
+
+
+def occupancy_report(date_from, date_to):
+    """
+    授業日が date_from 〜 date_to の授業枠を曜日・開始時刻ごとに集計する。
+    集計は DB で行い、期間の長さに関わらず1クエリで済む。
+    """
+    tz = timezone.get_current_timezone()
+    start = datetime.combine(date_from, time.min, tzinfo=tz)
+    end = datetime.combine(date_to + timedelta(days=1), time.min, tzinfo=tz)
+    rows = (
+        LessonSlot.objects.filter(start_time__gte=start, start_time__lt=end)
+        .annotate(
+            weekday=ExtractIsoWeekDay("start_time", tzinfo=tz),
+            local_start=TruncTime("start_time", tzinfo=tz),
+            sold_out_at=_sold_out_at(),
+            waitlist_peak=_waitlist_peak(),
+        )
+        .values("weekday", "local_start")
+        .annotate(
+            slots=Count("pk"),
+            capacity_total=Sum("capacity"),
+            reserved_total=Sum("reserved_count"),
+            sold_out=Count("pk", filter=Q(reserved_count__gte=F("capacity"))),
+            # 満席にならなかった授業枠（NULL）は平均に含まれない
+            time_to_sellout=Avg(F("sold_out_at") - F("reservation_start_time")),
+            waitlist_avg=Avg("waitlist_peak"),
+            waitlist_max=Max("waitlist_peak"),
+        )
+        .order_by("local_start", "weekday")
+    )
+    cells = [
+        OccupancyCell(
+            weekday=row["weekday"],
+            start_time=row["local_start"],
+            slots=row["slots"],
+            capacity=row["capacity_total"],
+            reserved=row["reserved_total"],
+            sold_out=row["sold_out"],
+            time_to_sellout=row["time_to_sellout"],
+            waitlist_avg=round(row["waitlist_avg"] or 0, 1),
+            waitlist_max=row["waitlist_max"] or 0,
+        )
+        for row in rows
+    ]
+    return OccupancyReport(date_from, date_to, cells)
+
+
+def format_duration(value):
+    """満席までの時間の表示（例: 2日3時間、45分）"""
+    if value is None:
+        return "-"
+    minutes = int(value.total_seconds() // 60)
+    days, minutes = divmod(minutes, 60 * 24)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days}日{hours}時間"
+    if hours:
+        return f"{hours}時間{minutes}分"
+    return f"{minutes}分"
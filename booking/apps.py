@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class BookingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'booking'
+
+    def ready(self):
+        # 予約数カウンタ等を同期するシグナルとバックグラウンドジョブを登録
+        from . import signals, tasks  # noqa: F401
+        # リクエストごとの SQL の件数と時間を数える（booking.metrics）
+        from django.db.backends.signals import connection_created
+        from . import metrics, profiling
+        connection_created.connect(metrics.install_query_recorder, dispatch_uid="booking.metrics")
+        connection_created.connect(profiling.install_query_recorder, dispatch_uid="booking.profiling")
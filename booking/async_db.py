@@ -0,0 +1,28 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+
+def _isolated(func):
+    """スレッドプールのスレッドで実行する関数。リクエストの開始・終了時と同じく古い DB 接続を閉じる"""
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return run
+
+
+async def run_db(request, func, *args, **kwargs):
+    """
+    非同期ビューから DB 処理をまとめた同期関数を実行する。
+    非同期 ORM や既定の sync_to_async (thread_sensitive=True) は、ASGI ではプロセス内の1つのスレッドで
+    順番に実行されるため、DB の待ち時間中に他のリクエストの DB 処理を進められない。
+    ASGI では呼び出しごとにスレッドプールのスレッド（と、そのスレッドの DB 接続）で実行する。
+    トランザクションは func の中で完結させること。
+    WSGI ではリクエストのスレッドで実行する（テストのトランザクションも同じ接続で見える）。
+    """
+    if isinstance(request, ASGIRequest):
+        return await sync_to_async(_isolated(func), thread_sensitive=False)(*args, **kwargs)
+    return await sync_to_async(func)(*args, **kwargs)
@@ -0,0 +1,200 @@
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .live import record_slot_changes
+from .models import LessonSlot
+
+# 空き状況スナップショットの対象期間（今日から。今月・来月の月表示が収まる日数）
+SNAPSHOT_DAYS = 62
+# スナップショットの最大経過秒数。同時更新で反映が失われた場合も、この時間内に DB の値に戻る
+SNAPSHOT_MAX_AGE = 60
+
+_INDEX_KEY = "booking:availability:index"
+_COUNTER_KEY = "booking:availability:slot:{}"
+_VERSION_KEY = "booking:availability:version"
+_CHANGED_AT_KEY = "booking:availability:changed-at"
+_REBUILD_LOCK_KEY = "booking:availability:rebuilding"
+
+
+class SlotAvailability(NamedTuple):
+    """授業枠1件の空き状況"""
+    start_time: datetime
+    capacity: int
+    reserved: int
+    waitlisted: int
+    opens_at: datetime
+
+    @property
+    def remaining(self):
+        return self.capacity - self.reserved
+
+    def is_reservable(self, now=None):
+        return (now or timezone.now()) >= self.opens_at and self.remaining > 0
+
+
+class _Index(NamedTuple):
+    """スナップショットの授業枠一覧 {id: (開始日時, 定員, 予約開始日時)}。予約数は授業枠ごとに別のキーで持つ"""
+    built_at: float
+    start: datetime
+    end: datetime
+    slots: dict
+
+
+def _counter_key(pk):
+    return _COUNTER_KEY.format(pk)
+
+
+def _rows(queryset):
+    return queryset.values_list(
+        "pk", "start_time", "capacity", "reserved_count", "waitlist_count", "reservation_start_time",
+    )
+
+
+def _store_counters(rows):
+    cache.set_many(
+        {_counter_key(pk): (reserved, waitlisted) for pk, _, _, reserved, waitlisted, _ in rows},
+        timeout=SNAPSHOT_MAX_AGE,
+    )
+
+
+def _from_rows(rows):
+    return {
+        pk: SlotAvailability(start_time, capacity, reserved, waitlisted, opens_at)
+        for pk, start_time, capacity, reserved, waitlisted, opens_at in rows
+    }
+
+
+def version():
+    """スナップショットのバージョン（空き状況が変わるたびに増える）"""
+    # キャッシュから消えた場合も以前の値より大きくなるよう、初期値は現在時刻（ナノ秒）
+    cache.add(_VERSION_KEY, time.time_ns(), timeout=None)
+    return cache.get(_VERSION_KEY)
+
+
+def changed_at():
+    """空き状況が最後に変わった日時（不明な場合は None）"""
+    timestamp = cache.get(_CHANGED_AT_KEY)
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc) if timestamp else None
+
+
+def _bump_version():
+    try:
+        cache.incr(_VERSION_KEY)
+    except ValueError:
+        cache.add(_VERSION_KEY, time.time_ns(), timeout=None)
+    cache.set(_CHANGED_AT_KEY, time.time(), timeout=None)
+
+
+def mark_changed():
+    """空き状況 API の応答に含まれる内容（生徒名など）が変わったときにバージョンだけを進める"""
+    transaction.on_commit(_bump_version)
+
+
+def _build_index():
+    """DB から対象期間の授業枠を1クエリで取得し、スナップショットを作り直す"""
+    start = datetime.combine(timezone.localdate(), datetime.min.time(), tzinfo=timezone.get_current_timezone())
+    end = start + timedelta(days=SNAPSHOT_DAYS)
+    rows = list(_rows(LessonSlot.objects.filter(start_time__gte=start, start_time__lt=end)))
+    index = _Index(
+        built_at=time.time(),
+        start=start,
+        end=end,
+        slots={pk: (start_time, capacity, opens_at) for pk, start_time, capacity, _, _, opens_at in rows},
+    )
+    cache.set(_INDEX_KEY, index, timeout=None)
+    _store_counters(rows)
+    return index
+
+
+def _load_index():
+    """
+    スナップショットを取得する。古くなっていれば1つのワーカーだけが作り直し、
+    その間ほかのワーカーは古いスナップショットをそのまま使う（作り直しの集中を防ぐ）。
+    """
+    index = cache.get(_INDEX_KEY)
+    if index is not None and time.time() - index.built_at <= SNAPSHOT_MAX_AGE:
+        return index
+    if index is None or cache.add(_REBUILD_LOCK_KEY, 1, timeout=SNAPSHOT_MAX_AGE):
+        try:
+            return _build_index()
+        finally:
+            cache.delete(_REBUILD_LOCK_KEY)
+    return index
+
+
+def window_availability(start, end):
+    """開始日時が start 以上 end 未満の授業枠の空き状況 {id: SlotAvailability}"""
+    index = _load_index()
+    if not (index.start <= start and end <= index.end):
+        # スナップショットの対象期間外は DB から直接取得する
+        return _from_rows(_rows(LessonSlot.objects.filter(start_time__gte=start, start_time__lt=end)))
+
+    ids = [pk for pk, (start_time, _, _) in index.slots.items() if start <= start_time < end]
+    found = cache.get_many([_counter_key(pk) for pk in ids])
+    missing = [pk for pk in ids if _counter_key(pk) not in found]
+    if missing:
+        # 期限切れの予約数だけ DB から補う
+        rows = list(_rows(LessonSlot.objects.filter(pk__in=missing)))
+        _store_counters(rows)
+        found.update({_counter_key(pk): (reserved, waitlisted) for pk, _, _, reserved, waitlisted, _ in rows})
+
+    availability = {}
+    for pk in ids:
+        counters = found.get(_counter_key(pk))
+        if counters is not None:
+            start_time, capacity, opens_at = index.slots[pk]
+            availability[pk] = SlotAvailability(start_time, capacity, *counters, opens_at)
+    return availability
+
+
+def slot_availability(pk):
+    """授業枠1件の空き状況。スナップショットにない場合は None（DB にはアクセスしない）"""
+    index = cache.get(_INDEX_KEY)
+    counters = cache.get(_counter_key(pk))
+    if index is None or pk not in index.slots or counters is None:
+        return None
+    start_time, capacity, opens_at = index.slots[pk]
+    return SlotAvailability(start_time, capacity, *counters, opens_at)
+
+
+def by_local_date(availability):
+    """空き状況を日付ごとにまとめ、日付順・開始日時順の [(日付, [(id, SlotAvailability)])] にする"""
+    grouped = defaultdict(list)
+    for pk, slot in sorted(availability.items(), key=lambda item: (item[1].start_time, item[0])):
+        grouped[timezone.localtime(slot.start_time).date()].append((pk, slot))
+    return sorted(grouped.items())
+
+
+def _refresh_counters(ids):
+    rows = list(_rows(LessonSlot.objects.filter(pk__in=ids)))
+    _store_counters(rows)
+    record_slot_changes([(pk, capacity, reserved, waitlisted) for pk, _, capacity, reserved, waitlisted, _ in rows])
+    cache.delete_many([_counter_key(pk) for pk in set(ids) - {row[0] for row in rows}])
+    _bump_version()
+
+
+def refresh_counters(lesson_slot_ids):
+    """
+    予約数・補欠数が変わった授業枠の値を DB から読み直してスナップショットに反映し、
+    ライブ更新の変更フィードに記録する。
+    トランザクション内ではコミット後に反映する。反映に失敗してもコミット済みの予約は取り消せないため、
+    例外は呼び出し元に伝えずにログに記録する（呼び出し元が失敗とみなして再試行しないようにする）。
+    """
+    ids = {pk for pk in lesson_slot_ids if pk is not None}
+    if ids:
+        transaction.on_commit(lambda: _refresh_counters(ids), robust=True)
+
+
+def _invalidate_index():
+    cache.delete(_INDEX_KEY)
+    _bump_version()
+
+
+def invalidate_snapshot():
+    """授業枠の作成・削除・日時や定員の変更時に、スナップショットを次の参照時に作り直させる"""
+    transaction.on_commit(_invalidate_index)
@@ -0,0 +1,62 @@
+import time
+
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+from django.utils import timezone
+
+# カレンダーの日付ブロックのテンプレート断片キャッシュの有効期間（秒）
+CALENDAR_FRAGMENT_TIMEOUT = 60 * 60
+
+_DATE_VERSION_KEY = "booking:calendar:date-version:{}"
+
+
+def _version_key(day):
+    return _DATE_VERSION_KEY.format(day.isoformat())
+
+
+def date_versions(dates):
+    """
+    日付ごとのバージョンを返す。断片キャッシュのキーに含めることで、
+    その日の授業枠・予約・補欠が変わったときだけ再描画される。
+    """
+    keys = {day: _version_key(day) for day in dates}
+    found = cache.get_many(keys.values())
+    missing = {key: time.time_ns() for key in keys.values() if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return {day: found[key] for day, key in keys.items()}
+
+
+def bump_dates(dates):
+    """日付のバージョンを更新し、その日の断片キャッシュを無効にする"""
+    version = time.time_ns()
+    cache.set_many({_version_key(day): version for day in dates}, timeout=None)
+
+
+def bump_slot_dates(start_times):
+    """
+    授業枠の開始日時から日付を求めてバージョンを更新する。
+    トランザクション内ではコミット後に更新し、コミット前の内容がキャッシュされないようにする。
+    """
+    dates = {timezone.localdate(start_time) for start_time in start_times if start_time}
+    if dates:
+        transaction.on_commit(lambda: bump_dates(dates))
+
+
+def lessons_state(slots, now=None):
+    """
+    その日に表示する授業枠と予約可否の組み合わせ（slots は (id, SlotAvailability) のリスト）。
+    予約開始時刻の到来や開始済み授業枠の除外はシグナルでは検知できないため、キーに含める。
+    """
+    return ",".join(f"{pk}:{int(slot.is_reservable(now))}" for pk, slot in slots)
+
+
+def cached_fragment_dates(fragment_name, vary_on_by_date):
+    """
+    断片キャッシュが残っている日付の集合。
+    キャッシュから描画される日付については、断片内でしか使わないデータの取得を省ける。
+    """
+    keys = {make_template_fragment_key(fragment_name, vary_on): day for day, vary_on in vary_on_by_date.items()}
+    return {keys[key] for key in cache.get_many(keys)}
@@ -0,0 +1,112 @@
+from datetime import date, datetime, time, timedelta
+
+from django.utils import timezone
+
+# カレンダーの表示期間
+SPAN_WEEK = "week"
+SPAN_MONTH = "month"
+SPANS = (SPAN_WEEK, SPAN_MONTH)
+# 表示できる期間の開始日の上限（今日から何日後まで）。date.max 付近の日付で期間の終了日が計算できなくなるのを防ぐ
+MAX_DAYS_AHEAD = 730
+
+
+def _first_of_next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _window_start(day, span):
+    """表示期間の開始日（月表示は月初に揃える）"""
+    return day.replace(day=1) if span == SPAN_MONTH else day
+
+
+def _latest_start(today):
+    return today + timedelta(days=MAX_DAYS_AHEAD)
+
+
+def _local_midnight(day):
+    return datetime.combine(day, time.min, tzinfo=timezone.get_current_timezone())
+
+
+class CalendarWindow:
+    """
+    予約カレンダーの表示期間（週または月）。
+    授業枠は start_time の範囲検索で取得し、前後の期間へのリンクは
+    期間外で最も近い授業枠（未作成の繰り返しルールの回を含む）の日付から求める（空の週・月は飛ばす）。
+    """
+
+    def __init__(self, start_date, span, now=None):
+        self.span = span
+        self.now = now or timezone.now()
+        self.start_date = _window_start(start_date, span)
+        if span == SPAN_MONTH:
+            self.end_date = _first_of_next_month(self.start_date)
+        else:
+            self.end_date = self.start_date + timedelta(days=7)
+        self.prev_date = None
+        self.next_date = None
+
+    @classmethod
+    def from_request(cls, request, now=None):
+        """GET パラメータ start (YYYY-MM-DD), span (week/month) から表示期間を決める"""
+        now = now or timezone.now()
+        today = timezone.localdate(now)
+        span = request.GET.get("span")
+        if span not in SPANS:
+            span = SPAN_WEEK
+        try:
+            start_date = date.fromisoformat(request.GET.get("start", ""))
+        except ValueError:
+            start_date = today
+        # 過去の期間と、MAX_DAYS_AHEAD 日より先の期間は表示しない
+        return cls(min(max(start_date, today), _latest_start(today)), span, now=now)
+
+    @property
+    def start(self):
+        """範囲検索の下限（現在時刻より前の授業枠は含めない）"""
+        return max(_local_midnight(self.start_date), self.now)
+
+    @property
+    def end(self):
+        return _local_midnight(self.end_date)
+
+    @property
+    def latest_end(self):
+        """次の期間へのリンクの対象とする授業枠の上限（表示できる最後の期間の終わり）"""
+        return CalendarWindow(_latest_start(timezone.localdate(self.now)), self.span, now=self.now).end
+
+    @property
+    def last_date(self):
+        """表示期間の最終日（テンプレート表示用）"""
+        return self.end_date - timedelta(days=1)
+
+    def filter(self, queryset):
+        """表示期間内の授業枠に絞り込む"""
+        return queryset.filter(start_time__gte=self.start, start_time__lt=self.end)
+
+    def resolve_links(self, queryset, occurrences=()):
+        """
+        期間外で最も近い授業枠から前後の期間の開始日を求める（インデックスを使う1件取得×2）。
+        occurrences には授業枠が未作成の繰り返しルールの回の開始日時を渡す。
+        """
+        latest_end = self.latest_end
+        next_start = (
+            queryset.filter(start_time__gte=self.end, start_time__lt=latest_end)
+            .order_by("start_time").values_list("start_time", flat=True).first()
+        )
+        prev_start = (
+            queryset.filter(start_time__gte=self.now, start_time__lt=self.start)
+            .order_by("-start_time").values_list("start_time", flat=True).first()
+        )
+        next_starts = [start for start in occurrences if self.end <= start < latest_end]
+        prev_starts = [start for start in occurrences if self.now <= start < self.start]
+        next_start = min(next_starts + [next_start] if next_start else next_starts, default=None)
+        prev_start = max(prev_starts + [prev_start] if prev_start else prev_starts, default=None)
+        if next_start is not None:
+            self.next_date = _window_start(timezone.localdate(next_start), self.span)
+        if prev_start is not None:
+            prev_date = timezone.localdate(prev_start)
+            if self.span == SPAN_WEEK:
+                # 直前の授業枠を含む週を、今日より前にならない範囲で表示する
+                prev_date = max(prev_date - timedelta(days=6), timezone.localdate(self.now))
+            self.prev_date = _window_start(prev_date, self.span)
+        return self
@@ -0,0 +1,133 @@
+import csv
+from typing import Callable, NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from .models import Reservation, Waitlist
+
+# DB から一度に読み込む行数（サーバーサイドカーソルが使える DB ではカーソルの取得単位）
+EXPORT_CHUNK_SIZE = 2000
+# 1回の送信にまとめる行数
+ROWS_PER_WRITE = 500
+# Excel で開いたときに UTF-8 と認識させるための BOM
+BOM = "\ufeff"
+
+# 表計算ソフトで数式として解釈される先頭文字
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _datetime(value):
+    return timezone.localtime(value).strftime("%Y-%m-%d %H:%M") if value else ""
+
+
+def _text(value):
+    """生徒名など利用者が入力した文字列が数式として実行されないようにする"""
+    value = value or ""
+    return f"'{value}" if value.startswith(_FORMULA_PREFIXES) else value
+
+
+class CsvExport(NamedTuple):
+    """CSV 出力の定義（ヘッダー行、出力する列、並び順、1行分の変換）"""
+    name: str
+    header: tuple
+    model: type
+    fields: tuple
+    ordering: tuple
+    row: Callable
+
+
+def _reservation_row(values):
+    pk, reserved_at, lesson_id, title, start, end, student, family, phone = values
+    return (pk, _datetime(reserved_at), lesson_id, _text(title), _datetime(start), _datetime(end),
+            _text(student), _text(family), _text(phone))
+
+
+def _roster_row(values):
+    lesson_id, title, start, end, capacity, student, family, phone = values
+    return (lesson_id, _text(title), _datetime(start), _datetime(end), capacity,
+            _text(student), _text(family), _text(phone))
+
+
+def _waitlist_row(values):
+    lesson_id, title, start, waitlisted_at, student, family, phone = values
+    return (lesson_id, _text(title), _datetime(start), _datetime(waitlisted_at),
+            _text(student), _text(family), _text(phone))
+
+
+_STUDENT_FIELDS = ("student__name", "student__family__user__username", "student__family__phone_number")
+
+EXPORTS = {
+    export.name: export
+    for export in (
+        CsvExport(
+            name="reservations",
+            header=("予約ID", "予約日時", "授業ID", "授業名", "開始日時", "終了日時", "生徒名", "保護者", "電話番号"),
+            model=Reservation,
+            fields=("pk", "reserved_at", "lesson_slot_id", "lesson_slot__title", "lesson_slot__start_time",
+                    "lesson_slot__end_time", *_STUDENT_FIELDS),
+            ordering=("reserved_at", "pk"),
+            row=_reservation_row,
+        ),
+        CsvExport(
+            name="rosters",
+            header=("授業ID", "授業名", "開始日時", "終了日時", "定員", "生徒名", "保護者", "電話番号"),
+            model=Reservation,
+            fields=("lesson_slot_id", "lesson_slot__title", "lesson_slot__start_time", "lesson_slot__end_time",
+                    "lesson_slot__capacity", *_STUDENT_FIELDS),
+            ordering=("lesson_slot__start_time", "lesson_slot_id", "reserved_at", "pk"),
+            row=_roster_row,
+        ),
+        CsvExport(
+            name="waitlists",
+            header=("授業ID", "授業名", "開始日時", "補欠登録日時", "生徒名", "保護者", "電話番号"),
+            model=Waitlist,
+            fields=("lesson_slot_id", "lesson_slot__title", "lesson_slot__start_time", "waitlisted_at",
+                    *_STUDENT_FIELDS),
+            ordering=("lesson_slot__start_time", "lesson_slot_id", "waitlisted_at", "pk"),
+            row=_waitlist_row,
+        ),
+    )
+}
+
+
+class _Echo:
+    """csv.writer の書き込み先。書き込まれた文字列をそのまま返す"""
+
+    def write(self, value):
+        return value
+
+
+def export_queryset(export, filter_form=None):
+    """出力対象のクエリセット（filter_form は検証済みの ReservationFilterForm）"""
+    queryset = export.model.objects.all()
+    if filter_form is not None:
+        queryset = filter_form.filter(queryset)
+    return queryset.order_by(*export.ordering).values_list(*export.fields)
+
+
+def stream_csv(export, queryset):
+    """
+    CSV を先頭の BOM から順に文字列のかたまりで生成する。
+    行は iterator() で EXPORT_CHUNK_SIZE 件ずつ読むため、件数が増えてもメモリ使用量は変わらない。
+    """
+    writer = csv.writer(_Echo())
+    yield BOM + writer.writerow(export.header)
+    lines = []
+    for values in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        lines.append(writer.writerow(export.row(values)))
+        if len(lines) >= ROWS_PER_WRITE:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+async def aiter_chunks(chunks):
+    """
+    ASGI では同期イテレータは全体を読み込んでから送信されるため、
+    かたまりを1つずつスレッドで取り出して非同期に送信する。
+    """
+    sentinel = object()
+    fetch = sync_to_async(next)
+    while (chunk := await fetch(chunks, sentinel)) is not sentinel:
+        yield chunk
@@ -1,7 +1,8 @@
 from django import forms
 from django.utils import timezone
-from datetime import timedelta
-from .models import LessonSlot, Student
+from datetime import datetime, time, timedelta
+from .models import Family, LessonSlot, Student
+from .onboarding import decode_csv
 
 class LessonSlotCreateForm(forms.Form):
     """授業枠一括作成フォーム"""
@@ -115,3 +116,74 @@ class StudentForm(forms.ModelForm):
         widgets = {
             'name': forms.TextInput(attrs={'placeholder': '例: 山田太郎'})
         }
+
+
+class ReservationFilterForm(forms.Form):
+    """予約一覧の絞り込み（授業日の範囲・授業枠・家族）"""
+    date_from = forms.DateField(
+        required=False,
+        label="授業日（から）",
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        required=False,
+        label="授業日（まで）",
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    # 授業枠・家族は一覧の各行のリンクから指定する
+    lesson = forms.ModelChoiceField(queryset=LessonSlot.objects.all(), required=False, widget=forms.HiddenInput)
+    family = forms.ModelChoiceField(
+        queryset=Family.objects.select_related('user'), required=False, widget=forms.HiddenInput
+    )
+
+    def filter(self, queryset):
+        """予約のクエリセットを絞り込む（is_valid() の後に呼び出す）"""
+        data = self.cleaned_data
+        tz = timezone.get_current_timezone()
+        if data.get('date_from'):
+            queryset = queryset.filter(lesson_slot__start_time__gte=datetime.combine(data['date_from'], time.min, tzinfo=tz))
+        if data.get('date_to'):
+            end = datetime.combine(data['date_to'] + timedelta(days=1), time.min, tzinfo=tz)
+            queryset = queryset.filter(lesson_slot__start_time__lt=end)
+        if data.get('lesson'):
+            queryset = queryset.filter(lesson_slot=data['lesson'])
+        if data.get('family'):
+            queryset = queryset.filter(student__family=data['family'])
+        return queryset
+
+
+class FamilyImportForm(forms.Form):
+    """保護者・生徒の CSV 一括登録"""
+    MAX_SIZE = 2 * 1024 * 1024
+
+    file = forms.FileField(label="CSV ファイル")
+
+    def clean_file(self):
+        """アップロードされた CSV を文字列で返す"""
+        upload = self.cleaned_data['file']
+        if upload.size > self.MAX_SIZE:
+            raise forms.ValidationError("ファイルが大きすぎます（2MB まで）。")
+        try:
+            return decode_csv(upload.read())
+        except UnicodeDecodeError:
+            raise forms.ValidationError("文字コードを判別できません。UTF-8 または Shift_JIS で保存してください。")
+
+
+class OccupancyReportForm(forms.Form):
+    """利用状況レポートの集計期間"""
+    date_from = forms.DateField(
+        label="授業日（から）",
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        label="授業日（まで）",
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise forms.ValidationError("終了日は開始日以降の日付を指定してください。")
+        return cleaned_data
@@ -0,0 +1,126 @@
+from typing import NamedTuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+from .async_db import run_db
+from .models import Family, Student
+
+# ログイン中の保護者の情報（ユーザー・家族・生徒）をキャッシュする秒数
+IDENTITY_TIMEOUT = 60 * 60
+
+_IDENTITY_KEY = "booking:identity:{}"
+
+
+class Identity(NamedTuple):
+    """ユーザー1人分の認証・家族情報。家族のないユーザー（管理者など）は family が None"""
+    user: User
+    family: Family | None
+    students: tuple
+
+
+def _identity_key(user_id):
+    return _IDENTITY_KEY.format(user_id)
+
+
+def load_identity(user_id):
+    """
+    ユーザー・家族・生徒をキャッシュから取得する。キャッシュにない場合は DB から読み込んで保存する。
+    ユーザーが存在しない場合は None。
+    """
+    key = _identity_key(user_id)
+    identity = cache.get(key)
+    if identity is None:
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            return None
+        family = Family.objects.filter(user=user).first()
+        students = tuple(Student.objects.filter(family=family).order_by('pk')) if family else ()
+        identity = Identity(user, family, students)
+        cache.set(key, identity, timeout=IDENTITY_TIMEOUT)
+    return identity
+
+
+def invalidate_identity(user_id):
+    """ユーザー・家族・生徒の変更時にキャッシュを削除する（トランザクション内ではコミット後）"""
+    if user_id is not None:
+        transaction.on_commit(lambda: cache.delete(_identity_key(user_id)))
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend と同じ認証を行い、リクエストごとのユーザーの取得をキャッシュから行う。
+    取得したユーザーには同じキャッシュの家族・生徒を付けておき、FamilyMiddleware で使う。
+    """
+
+    def get_user(self, user_id):
+        identity = load_identity(user_id)
+        if identity is None or not self.user_can_authenticate(identity.user):
+            return None
+        user = identity.user
+        user._identity = identity
+        return user
+
+    async def aget_user(self, user_id):
+        return await sync_to_async(self.get_user)(user_id)
+
+
+def _identity_for(user):
+    if not user.is_authenticated:
+        return None
+    return getattr(user, '_identity', None) or load_identity(user.pk)
+
+
+class FamilyMiddleware:
+    """
+    ログイン中の保護者の家族と生徒を request.family・request.students に設定する
+    （家族のないユーザーは None と空のタプル）。AuthenticationMiddleware の後に置く。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _attach(self, request, identity):
+        request.family = identity.family if identity else None
+        request.students = identity.students if identity else ()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self._attach(request, _identity_for(request.user))
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        user = await request.auser()
+        identity = getattr(user, '_identity', None) if user.is_authenticated else None
+        if identity is None and user.is_authenticated:
+            identity = await run_db(request, load_identity, user.pk)
+        self._attach(request, identity)
+        return await self.get_response(request)
+
+
+def get_family_or_404(request):
+    """ログイン中の保護者の家族（家族のないユーザーは 404）"""
+    if request.family is None:
+        raise Http404("家族情報が見つかりません。")
+    return request.family
+
+
+def get_student_or_404(request, student_id):
+    """ログイン中の保護者の生徒（他の家族の生徒や存在しない生徒は 404）"""
+    get_family_or_404(request)
+    try:
+        student_id = int(student_id)
+    except (TypeError, ValueError):
+        raise Http404("生徒が見つかりません。")
+    for student in request.students:
+        if student.pk == student_id:
+            return student
+    raise Http404("生徒が見つかりません。")
@@ -0,0 +1,148 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# 再試行の待ち時間（秒）: RETRY_BASE_SECONDS * 2 ** (試行回数 - 1)、上限 RETRY_MAX_SECONDS
+RETRY_BASE_SECONDS = 10
+RETRY_MAX_SECONDS = 60 * 60
+# ワーカーは実行中のジョブの locked_at を HEARTBEAT_INTERVAL ごとに更新する。
+# STALE_AFTER を超えて更新されないジョブは、ワーカーが異常終了したものとして再実行する
+HEARTBEAT_INTERVAL = timedelta(minutes=1)
+STALE_AFTER = timedelta(minutes=5)
+
+_registry = {}
+# 終了後に引数を消去するジョブ（パスワードなどを含むもの）
+_sensitive = set()
+
+
+def job(name, *, sensitive=False):
+    """
+    関数をジョブとして登録するデコレータ。
+    sensitive=True の場合、完了・失敗したジョブの引数を履歴に残さない。
+    """
+    def decorator(func):
+        _registry[name] = func
+        if sensitive:
+            _sensitive.add(name)
+        return func
+    return decorator
+
+
+def is_sensitive(name):
+    """引数にパスワードなどを含むジョブかどうか"""
+    return name in _sensitive
+
+
+def _finished(job_obj, **fields):
+    if job_obj.name in _sensitive:
+        fields["payload"] = {}
+    Job.objects.filter(pk=job_obj.pk).update(finished_at=timezone.now(), **fields)
+
+
+def enqueue(name, payload=None, *, run_at=None, max_attempts=5):
+    """ジョブを登録する。run_at を指定するとその日時以降に実行される"""
+    if name not in _registry:
+        raise ValueError(f"未登録のジョブです: {name}")
+    return Job.objects.create(
+        name=name,
+        payload=payload or {},
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts,
+    )
+
+
+def retry_delay(attempts):
+    """attempts 回目の失敗後、次の実行までの待ち時間"""
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), RETRY_MAX_SECONDS))
+
+
+def claim_jobs(worker_id, limit):
+    """
+    実行可能なジョブを最大 limit 件取り出して実行中にする。
+    PostgreSQL では SELECT ... FOR UPDATE SKIP LOCKED で他のワーカーと重複せずに取り出し、
+    SKIP LOCKED が使えない SQLite では状態を条件にした UPDATE で1件ずつ確保する。
+    """
+    now = timezone.now()
+    runnable = Job.objects.filter(status=Job.STATUS_PENDING, run_at__lte=now).order_by("run_at", "pk")
+    claim = dict(
+        status=Job.STATUS_RUNNING,
+        locked_by=worker_id,
+        locked_at=now,
+        attempts=F("attempts") + 1,
+    )
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(runnable.select_for_update(skip_locked=True).values_list("pk", flat=True)[:limit])
+            Job.objects.filter(pk__in=ids).update(**claim)
+    else:
+        ids = [
+            pk for pk in runnable.values_list("pk", flat=True)[:limit]
+            if Job.objects.filter(pk=pk, status=Job.STATUS_PENDING).update(**claim)
+        ]
+    return list(Job.objects.filter(pk__in=ids).order_by("run_at", "pk"))
+
+
+def run_job(job_obj):
+    """ジョブを実行し、結果に応じて完了・再試行待ち・失敗に更新する"""
+    handler = _registry.get(job_obj.name)
+    try:
+        if handler is None:
+            raise LookupError(f"未登録のジョブです: {job_obj.name}")
+        handler(**job_obj.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("ジョブ %s (id=%s) が失敗しました", job_obj.name, job_obj.pk)
+        if job_obj.attempts < job_obj.max_attempts:
+            Job.objects.filter(pk=job_obj.pk).update(
+                status=Job.STATUS_PENDING,
+                run_at=timezone.now() + retry_delay(job_obj.attempts),
+                last_error=error,
+                locked_by="",
+                locked_at=None,
+            )
+        else:
+            _finished(job_obj, status=Job.STATUS_FAILED, last_error=error)
+        return False
+
+    _finished(job_obj, status=Job.STATUS_DONE)
+    return True
+
+
+def heartbeat(worker_id, job_ids):
+    """実行中のジョブの locked_at を更新し、長時間のジョブが再実行されないようにする"""
+    if not job_ids:
+        return 0
+    return Job.objects.filter(
+        pk__in=job_ids, status=Job.STATUS_RUNNING, locked_by=worker_id,
+    ).update(locked_at=timezone.now())
+
+
+def requeue_stale_jobs(stale_after=STALE_AFTER):
+    """
+    ハートビートが stale_after を過ぎても更新されない実行中のジョブを待機中に戻し、戻した件数を返す。
+    最大試行回数に達したジョブ（毎回ワーカーごと異常終了するものなど）は失敗にする。
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.STATUS_RUNNING, locked_at__lt=now - stale_after)
+    error = "ワーカーの応答がなくなったため中断しました。"
+    exhausted = stale.filter(attempts__gte=F("max_attempts"))
+    exhausted.filter(name__in=_sensitive).update(payload={})
+    exhausted.update(status=Job.STATUS_FAILED, finished_at=now, last_error=error, locked_by="", locked_at=None)
+    return stale.update(status=Job.STATUS_PENDING, last_error=error, locked_by="", locked_at=None)
+
+
+def purge_finished_jobs(older_than=timedelta(days=7)):
+    """完了したジョブの履歴を削除する"""
+    deleted, _ = Job.objects.filter(
+        status=Job.STATUS_DONE,
+        finished_at__lt=timezone.now() - older_than,
+    ).delete()
+    return deleted
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+from .models import SlotChange
+
+# 他プロセスでの変更を取り込むため、変更フィードを読む間隔（秒）
+FEED_POLL_INTERVAL = 1.0
+# コミット順と ID 順が前後した変更も拾えるよう、前回の読み込みより少し前から読み直す
+FEED_LOOKBACK = timedelta(seconds=2)
+# 変更フィードの保持期間
+FEED_RETENTION = timedelta(hours=1)
+# 記録時に保持期間を過ぎた変更フィードを削除する間隔（秒）。
+# ジョブのワーカー（run_jobs）を動かさない構成でもテーブルが増え続けないようにする
+FEED_PURGE_INTERVAL = 60
+# 無通信の接続がプロキシに切断されないよう、コメント行を送る間隔（秒）
+HEARTBEAT_INTERVAL = 15
+# 1接続で購読できる授業枠の上限（月表示の授業枠数を十分に上回る数）
+MAX_SUBSCRIBED_SLOTS = 300
+
+
+def _message(change):
+    return {
+        "id": change.lesson_slot_id,
+        "capacity": change.capacity,
+        "reserved": change.reserved_count,
+        "waitlisted": change.waitlist_count,
+        "remaining": change.capacity - change.reserved_count,
+    }
+
+
+class _Subscriber:
+    """接続1件分の購読。未送信の変更は授業枠ごとに最新の1件だけを保持する"""
+
+    def __init__(self, slot_ids):
+        self.slot_ids = slot_ids
+        self.pending = {}
+        self.sent = {}
+        self.event = asyncio.Event()
+
+    def offer(self, change):
+        slot_id = change.lesson_slot_id
+        if slot_id not in self.slot_ids or change.pk <= self.sent.get(slot_id, 0):
+            return
+        if change.pk > getattr(self.pending.get(slot_id), "pk", 0):
+            self.pending[slot_id] = change
+            self.event.set()
+
+    def drain(self):
+        changes, self.pending = list(self.pending.values()), {}
+        self.event.clear()
+        for change in changes:
+            self.sent[change.lesson_slot_id] = change.pk
+        return changes
+
+
+class SlotChangeHub:
+    """
+    プロセス内の配信ハブ。接続はイベントループ上で待機するだけで、接続ごとのスレッドは使わない。
+    同じプロセスでの変更は publish で即座に配信し、他プロセスでの変更は購読者がいる間だけ
+    1本のタスクが変更フィード（SlotChange）を定期的に読んで配信する。
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._loop = None
+        self._poller = None
+
+    def subscribe(self, slot_ids):
+        self._loop = asyncio.get_running_loop()
+        subscriber = _Subscriber(slot_ids)
+        self._subscribers.add(subscriber)
+        if self._poller is None or self._poller.done():
+            self._poller = self._loop.create_task(self._poll_feed())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, changes):
+        """同期処理（コミット後のコールバックなど）からも呼べるよう、配信はイベントループに任せる"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._subscribers:
+            return
+        loop.call_soon_threadsafe(self._dispatch, list(changes))
+
+    def _dispatch(self, changes):
+        for change in changes:
+            for subscriber in self._subscribers:
+                subscriber.offer(change)
+
+    async def _poll_feed(self):
+        since = timezone.now()
+        while self._subscribers:
+            await asyncio.sleep(FEED_POLL_INTERVAL)
+            started = timezone.now()
+            try:
+                changes = [change async for change in SlotChange.objects.filter(created_at__gte=since - FEED_LOOKBACK)]
+            except Exception:
+                # DB に一時的に接続できない場合は次の周期で読み直す
+                continue
+            since = started
+            self._dispatch(changes)
+
+    async def stream(self, slot_ids):
+        """Server-Sent Events の本文を生成する。切断されると購読を解除する"""
+        subscriber = self.subscribe(slot_ids)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.event.wait(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                for change in subscriber.drain():
+                    yield f"id: {change.pk}\nevent: seats\ndata: {json.dumps(_message(change))}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+hub = SlotChangeHub()
+
+
+def record_slot_changes(rows):
+    """授業枠の (id, 定員, 予約数, 補欠数) を変更フィードに記録し、同じプロセスの接続へ配信する"""
+    changes = SlotChange.objects.bulk_create([
+        SlotChange(lesson_slot_id=pk, capacity=capacity, reserved_count=reserved, waitlist_count=waitlisted)
+        for pk, capacity, reserved, waitlisted in rows
+    ])
+    # ID を返せないデータベースでは、変更フィードの読み込みで配信される
+    hub.publish([change for change in changes if change.pk is not None])
+    _purge_periodically()
+
+
+_last_purge = 0.0
+
+
+def _purge_periodically():
+    """プロセスごとに FEED_PURGE_INTERVAL に1回だけ、保持期間を過ぎた変更フィードを削除する"""
+    global _last_purge
+    if time.monotonic() - _last_purge < FEED_PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    purge_slot_changes()
+
+
+def purge_slot_changes(older_than=FEED_RETENTION):
+    """保持期間を過ぎた変更フィードを削除する"""
+    deleted, _ = SlotChange.objects.filter(created_at__lt=timezone.now() - older_than).delete()
+    return deleted
@@ -0,0 +1,77 @@
+import csv
+import io
+import json
+import os
+import secrets
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from booking.onboarding import COLUMNS, import_families, parse_family_csv
+from .bench_reservation_burst import current_commit
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "保護者・生徒の CSV 一括登録のベンチマーク。同じ CSV を順番にハッシュ化する場合と"
+        "プロセスに分けて並列にハッシュ化する場合で取り込み、所要時間を JSON で出力します（登録内容は残しません）。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--families", type=int, default=200, help="家族数")
+        parser.add_argument("--students-per-family", type=int, default=2, help="家族ごとの生徒数")
+        parser.add_argument("--workers", type=int, default=None, help="並列時のプロセス数（省略時は CPU 数）")
+        parser.add_argument("--output", default=None, help="結果 JSON の出力先ファイル（省略時は標準出力）")
+
+    def handle(self, *args, **options):
+        if options["families"] < 1:
+            raise CommandError("--families は 1 以上を指定してください。")
+        workers = options["workers"] or os.cpu_count() or 1
+        plan = parse_family_csv(self._csv(secrets.token_hex(4), options))
+        if plan.errors:
+            raise CommandError(plan.errors[0])
+
+        serial = self._timed(plan, 1)
+        parallel = self._timed(plan, workers)
+        result = {
+            "commit": current_commit(),
+            "families": len(plan.families),
+            "students": plan.student_count,
+            "cpu_count": os.cpu_count(),
+            "workers": workers,
+            "serial_seconds": round(serial, 3),
+            "parallel_seconds": round(parallel, 3),
+            "speedup": round(serial / parallel, 2),
+        }
+
+        output = json.dumps(result, ensure_ascii=False, indent=2)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def _csv(self, run_id, options):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        for i in range(options["families"]):
+            for n in range(options["students_per_family"]):
+                password = secrets.token_urlsafe(12) if n == 0 else ""
+                writer.writerow([f"bench_{run_id}_{i}", password, "", f"生徒{i}-{n}"])
+        return buffer.getvalue()
+
+    def _timed(self, plan, workers):
+        """取り込みにかかった秒数（登録内容はロールバックする）"""
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                import_families(plan, workers=workers)
+                elapsed = time.perf_counter() - started
+                raise _Rollback
+        except _Rollback:
+            return elapsed
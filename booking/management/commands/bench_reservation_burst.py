@@ -0,0 +1,279 @@
+import asyncio
+import json
+import math
+import secrets
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.urls import reverse
+from django.utils import timezone
+from booking.models import Family, Student, LessonSlot, Reservation, Waitlist
+
+
+def percentile(sorted_values, pct):
+    """ソート済みリストの百分位数（nearest-rank 法）"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def current_commit():
+    """比較用に現在の git コミットを取得（取得できなければ None）"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "予約開始時刻に保護者が一斉に予約した場合の負荷を再現するベンチマーク。"
+        "家族・生徒を作成し、1つの授業枠に対して同時に予約 POST を送信して結果を JSON で出力します。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--families", type=int, default=50, help="作成する家族数")
+        parser.add_argument("--students-per-family", type=int, default=1, help="家族ごとの生徒数")
+        parser.add_argument("--capacity", type=int, default=10, help="授業枠の定員")
+        parser.add_argument("--concurrency", type=int, default=20, help="同時に送信するスレッド数")
+        parser.add_argument(
+            "--open-delay", type=float, default=1.0,
+            help="シード完了から予約開始時刻までの秒数（この時刻に一斉送信）",
+        )
+        parser.add_argument(
+            "--url", default=None,
+            help="起動中のサーバーのベース URL（例: http://127.0.0.1:8000）。省略時はアプリを直接呼び出す",
+        )
+        parser.add_argument(
+            "--interface", choices=["wsgi", "asgi"], default="wsgi",
+            help="--url を省略した場合の呼び出し方法。wsgi はスレッドごとに同期で、"
+                 "asgi は1つのイベントループ上で非同期に --concurrency 件ずつ送信する",
+        )
+        parser.add_argument("--output", default=None, help="結果 JSON の出力先ファイル（省略時は標準出力）")
+        parser.add_argument("--keep", action="store_true", help="作成したデータを削除せずに残す")
+
+    def handle(self, *args, **options):
+        if options["families"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--families と --concurrency は 1 以上を指定してください。")
+        if options["url"]:
+            options["interface"] = None
+
+        run_id = secrets.token_hex(4)
+        lesson, students = self._seed(run_id, options)
+        try:
+            clients = self._login_all(students, options)
+            open_at = lesson.reservation_start_time
+            samples, wall_time = self._fire(lesson, students, clients, open_at, options)
+            result = self._report(run_id, lesson, samples, wall_time, options)
+        finally:
+            if not options["keep"]:
+                self._cleanup(run_id, lesson)
+
+        output = json.dumps(result, ensure_ascii=False, indent=2)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    # ---- シード ----------------------------------------------------------------
+
+    def _seed(self, run_id, options):
+        """ベンチマーク用の家族・生徒・授業枠を作成"""
+        User.objects.bulk_create([
+            User(username=f"bench_{run_id}_{i}") for i in range(options["families"])
+        ])
+        # bulk_create で pk が返らないバックエンドに備えて取り直す
+        users = list(User.objects.filter(username__startswith=f"bench_{run_id}_").order_by("pk"))
+        Family.objects.bulk_create([Family(user=user) for user in users])
+        families = Family.objects.filter(user__in=users).order_by("pk")
+        Student.objects.bulk_create([
+            Student(family=family, name=f"bench {family.pk}-{n}")
+            for family in families
+            for n in range(options["students_per_family"])
+        ])
+        students = list(Student.objects.filter(family__in=families).select_related("family__user").order_by("pk"))
+
+        start = timezone.now() + timedelta(days=1)
+        lesson = LessonSlot.objects.create(
+            title=f"bench_{run_id}",
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=options["capacity"],
+            reservation_start_time=timezone.now() + timedelta(seconds=options["open_delay"]),
+        )
+        return lesson, students
+
+    def _login_all(self, students, options):
+        """家族ごとにログイン済みのクライアント（またはセッション Cookie）を用意"""
+        clients = {}
+        for student in students:
+            user = student.family.user
+            if user.pk in clients:
+                continue
+            client = Client()
+            client.force_login(user)
+            if options["url"]:
+                clients[user.pk] = client.cookies[settings.SESSION_COOKIE_NAME].value
+            elif options["interface"] == "asgi":
+                async_client = AsyncClient()
+                async_client.cookies = client.cookies
+                clients[user.pk] = async_client
+            else:
+                clients[user.pk] = client
+        return clients
+
+    def _cleanup(self, run_id, lesson):
+        LessonSlot.objects.filter(pk=lesson.pk).delete()
+        User.objects.filter(username__startswith=f"bench_{run_id}_").delete()
+
+    # ---- 送信 ------------------------------------------------------------------
+
+    def _fire(self, lesson, students, clients, open_at, options):
+        """予約開始時刻に全生徒分の予約 POST を同時送信し、(レイテンシ, 成否) を集める"""
+        path = reverse("reserve_lesson", args=[lesson.pk])
+        if options["interface"] == "asgi":
+            return asyncio.run(self._fire_asgi(path, students, clients, open_at, options))
+        if options["url"]:
+            send = self._http_sender(options["url"].rstrip("/") + path)
+        else:
+            send = self._wsgi_sender(path)
+
+        # 家族単位のクライアントはスレッド間で共有しないよう家族ごとにロックする
+        locks = {user_id: threading.Lock() for user_id in clients}
+
+        def task(student):
+            user_id = student.family.user_id
+            delay = (open_at - timezone.now()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+            with locks[user_id]:
+                started = time.perf_counter()
+                try:
+                    ok = send(clients[user_id], student)
+                except Exception:
+                    ok = False
+                finally:
+                    if not options["url"]:
+                        connection.close()
+                return time.perf_counter() - started, ok
+
+        burst_start = max(open_at, timezone.now())
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            samples = list(executor.map(task, students))
+        wall_time = (timezone.now() - burst_start).total_seconds()
+        return samples, wall_time
+
+    async def _fire_asgi(self, path, students, clients, open_at, options):
+        """ASGI アプリに対し、1つのイベントループから最大 --concurrency 件を同時に送信する"""
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        locks = {user_id: asyncio.Lock() for user_id in clients}
+
+        async def task(student):
+            user_id = student.family.user_id
+            delay = (open_at - timezone.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with semaphore, locks[user_id]:
+                started = time.perf_counter()
+                try:
+                    response = await clients[user_id].post(path, {"student_id": student.pk})
+                    ok = response.status_code == 302
+                except Exception:
+                    ok = False
+                return time.perf_counter() - started, ok
+
+        burst_start = max(open_at, timezone.now())
+        samples = await asyncio.gather(*(task(student) for student in students))
+        wall_time = (timezone.now() - burst_start).total_seconds()
+        return samples, wall_time
+
+    def _wsgi_sender(self, path):
+        def send(client, student):
+            response = client.post(path, {"student_id": student.pk})
+            return response.status_code == 302
+        return send
+
+    def _http_sender(self, url):
+        csrf_token = secrets.token_hex(16)
+
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        opener = urllib.request.build_opener(NoRedirect)
+
+        def send(session_key, student):
+            request = urllib.request.Request(
+                url,
+                data=f"student_id={student.pk}".encode(),
+                headers={
+                    "Cookie": f"{settings.SESSION_COOKIE_NAME}={session_key}; "
+                              f"{settings.CSRF_COOKIE_NAME}={csrf_token}",
+                    "X-CSRFToken": csrf_token,
+                    "Content-Type": "application/x-www-form-urlencoded",
+                },
+            )
+            try:
+                with opener.open(request, timeout=30) as response:
+                    return response.status == 302
+            except urllib.error.HTTPError as e:
+                return e.code == 302
+        return send
+
+    # ---- 集計 ------------------------------------------------------------------
+
+    def _report(self, run_id, lesson, samples, wall_time, options):
+        lesson.refresh_from_db()
+        latencies = sorted(latency * 1000 for latency, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        reserved = Reservation.objects.filter(lesson_slot=lesson).count()
+        waitlisted = Waitlist.objects.filter(lesson_slot=lesson).count()
+
+        def ms(value):
+            return round(value, 2) if value is not None else None
+
+        return {
+            "run_id": run_id,
+            "commit": current_commit(),
+            "target": options["url"] or options["interface"],
+            "database": connection.vendor,
+            "scenario": {
+                "families": options["families"],
+                "students_per_family": options["students_per_family"],
+                "capacity": options["capacity"],
+                "concurrency": options["concurrency"],
+            },
+            "requests": len(samples),
+            "errors": errors,
+            "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+            "wall_time_s": round(wall_time, 3),
+            "throughput_rps": round(len(samples) / wall_time, 2) if wall_time > 0 else None,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 50)),
+                "p95": ms(percentile(latencies, 95)),
+                "p99": ms(percentile(latencies, 99)),
+                "max": ms(latencies[-1] if latencies else None),
+            },
+            "reserved": reserved,
+            "waitlisted": waitlisted,
+            "overbooking_violations": max(0, reserved - lesson.capacity),
+            "counter_drift": {
+                "reserved_count": lesson.reserved_count - reserved,
+                "waitlist_count": lesson.waitlist_count - waitlisted,
+            },
+        }
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from booking.exports import EXPORTS, export_queryset, stream_csv
+from booking.forms import ReservationFilterForm
+
+
+class Command(BaseCommand):
+    help = "予約履歴・授業ごとの名簿・補欠を CSV（BOM 付き UTF-8）で出力します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(EXPORTS), help="出力する内容")
+        parser.add_argument("--from", dest="date_from", help="授業日の開始（YYYY-MM-DD）")
+        parser.add_argument("--to", dest="date_to", help="授業日の終了（YYYY-MM-DD）")
+        parser.add_argument("-o", "--output", help="出力先のファイル（省略時は標準出力）")
+
+    def handle(self, *args, **options):
+        form = ReservationFilterForm({"date_from": options["date_from"], "date_to": options["date_to"]})
+        if not form.is_valid():
+            raise CommandError("--from / --to は YYYY-MM-DD 形式で指定してください。")
+
+        export = EXPORTS[options["kind"]]
+        chunks = stream_csv(export, export_queryset(export, form))
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8", newline="") as f:
+                f.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
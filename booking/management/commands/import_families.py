@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from booking.onboarding import decode_csv, import_families, parse_family_csv
+
+
+class Command(BaseCommand):
+    help = "保護者アカウント・家族・生徒を CSV から一括登録します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV ファイル（列: ユーザー名, パスワード, 電話番号, 生徒名）")
+        parser.add_argument("--dry-run", action="store_true", help="検証結果と件数を表示するだけで登録しない")
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="パスワードのハッシュ化に使うプロセス数（省略時は CPU 数、1 で並列化しない）",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["path"], "rb") as f:
+                text = decode_csv(f.read())
+        except OSError as e:
+            raise CommandError(f"ファイルを読み込めません: {e}")
+        except UnicodeDecodeError:
+            raise CommandError("文字コードを判別できません。UTF-8 または Shift_JIS で保存してください。")
+
+        plan = parse_family_csv(text)
+        for duplicate in plan.duplicates:
+            self.stdout.write(self.style.WARNING(duplicate))
+        for error in plan.errors:
+            self.stderr.write(self.style.ERROR(error))
+        if plan.errors:
+            raise CommandError(f"{len(plan.errors)} 件のエラーがあるため登録しませんでした。")
+
+        if options["dry_run"]:
+            self.stdout.write(f"登録予定: 保護者 {len(plan.families)} 件・生徒 {plan.student_count} 件（未登録）")
+            return
+        result = import_families(plan, workers=options["workers"])
+        self.stdout.write(self.style.SUCCESS(f"保護者 {result.families} 件・生徒 {result.students} 件を登録しました。"))
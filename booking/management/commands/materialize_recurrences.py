@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from booking.recurrence import materialize_occurrences
+
+
+class Command(BaseCommand):
+    help = "繰り返しルールから、今後指定週数分の未作成の授業枠を作成します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--weeks", type=int, default=8, help="今日から何週間先まで作成するか")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        created = materialize_occurrences(today, today + timedelta(weeks=options["weeks"]))
+        self.stdout.write(self.style.SUCCESS(f"授業枠を {created} 件作成しました。"))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from booking.analytics import WEEKDAY_LABELS, format_duration, occupancy_report
+from booking.forms import OccupancyReportForm
+
+
+class Command(BaseCommand):
+    help = "曜日・開始時刻ごとの予約率・満席までの時間・補欠の人数をタブ区切りで出力します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", help="授業日の開始（YYYY-MM-DD、省略時は1年前）")
+        parser.add_argument("--to", dest="date_to", help="授業日の終了（YYYY-MM-DD、省略時は今日）")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        form = OccupancyReportForm({
+            "date_from": options["date_from"] or today - timedelta(days=364),
+            "date_to": options["date_to"] or today,
+        })
+        if not form.is_valid():
+            raise CommandError("--from / --to は YYYY-MM-DD 形式で、--from が --to 以前になるよう指定してください。")
+
+        report = occupancy_report(form.cleaned_data["date_from"], form.cleaned_data["date_to"])
+        self.stdout.write("\t".join(["曜日", "開始時刻", "授業枠", "予約率(%)", "満席(%)", "満席まで", "補欠平均", "補欠最大"]))
+        for cell in report.cells:
+            self.stdout.write("\t".join(str(value) for value in [
+                WEEKDAY_LABELS[cell.weekday - 1],
+                cell.start_time.strftime("%H:%M"),
+                cell.slots,
+                cell.fill_rate,
+                cell.sold_out_rate,
+                format_duration(cell.time_to_sellout),
+                cell.waitlist_avg,
+                cell.waitlist_max,
+            ]))
@@ -0,0 +1,56 @@
+import io
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from booking.profiling import load_profiles
+
+
+class Command(BaseCommand):
+    help = "保存済みのリクエストのプロファイルをビューごとに一覧・集計します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("view", nargs="?", help="URL 名（指定するとそのビューのプロファイルの一覧と、合算した関数ごとの時間を表示）")
+        parser.add_argument("--limit", type=int, default=30, help="表示する関数の数（累積時間の順）")
+
+    def handle(self, *args, **options):
+        if options["view"]:
+            self._show_view(options["view"], options["limit"])
+            return
+
+        by_view = {}
+        for info in load_profiles():
+            by_view.setdefault(info.view, []).append(info)
+        if not by_view:
+            self.stdout.write(f"プロファイルがありません（{settings.PROFILE_DIR}）。")
+            return
+        self.stdout.write("\t".join(["ビュー", "件数", "平均(ms)", "最大(ms)", "SQL平均(件)", "SQL平均(ms)", "最新"]))
+        for view, profiles in sorted(by_view.items(), key=lambda item: -max(info.seconds for info in item[1])):
+            count = len(profiles)
+            self.stdout.write("\t".join(str(value) for value in [
+                view,
+                count,
+                round(sum(info.seconds for info in profiles) * 1000 / count, 1),
+                round(max(info.seconds for info in profiles) * 1000, 1),
+                round(sum(info.queries for info in profiles) / count, 1),
+                round(sum(info.sql_seconds for info in profiles) * 1000 / count, 1),
+                profiles[-1].name,
+            ]))
+
+    def _show_view(self, view, limit):
+        profiles = load_profiles(view)
+        if not profiles:
+            raise CommandError(f"{view} のプロファイルがありません。")
+        for info in profiles:
+            self.stdout.write(
+                f"{info.created_at}  {info.method} {info.path} -> {info.status}  "
+                f"{info.seconds * 1000:.1f} ms  SQL {info.queries} 件 {info.sql_seconds * 1000:.1f} ms  {info.name}.txt"
+            )
+        paths = [os.path.join(settings.PROFILE_DIR, f"{info.name}.prof") for info in profiles]
+        paths = [path for path in paths if os.path.exists(path)]
+        if paths:
+            out = io.StringIO()
+            pstats.Stats(*paths, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+            self.stdout.write(f"\n{len(paths)} 件の合算（累積時間の順）")
+            self.stdout.write(out.getvalue())
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from booking.services import promote_all_waitlists
+
+
+class Command(BaseCommand):
+    help = "空席と補欠の両方がある今後の授業枠について、補欠を登録順に予約へ繰り上げます。"
+
+    def handle(self, *args, **options):
+        promoted = promote_all_waitlists()
+        self.stdout.write(self.style.SUCCESS(f"補欠 {promoted} 件を予約に繰り上げました。"))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from booking.models import LessonSlot, Reservation, Waitlist
+from booking.availability import refresh_counters
+from booking.calendar_cache import bump_slot_dates
+from booking.services import count_subquery
+
+
+class Command(BaseCommand):
+    help = "授業枠の予約数・補欠数カウンタと実際の件数のずれを検出して修正します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="ずれの一覧を表示するだけで修正しない",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drifted = (
+                LessonSlot.objects.select_for_update()
+                .annotate(
+                    actual_reserved=count_subquery(Reservation),
+                    actual_waitlist=count_subquery(Waitlist),
+                )
+                .filter(
+                    ~Q(reserved_count=F("actual_reserved"))
+                    | ~Q(waitlist_count=F("actual_waitlist"))
+                )
+                .order_by("pk")
+            )
+            fixed = 0
+            for lesson in drifted:
+                self.stdout.write(
+                    f"{lesson.pk}: {lesson} "
+                    f"予約数 {lesson.reserved_count} -> {lesson.actual_reserved}, "
+                    f"補欠数 {lesson.waitlist_count} -> {lesson.actual_waitlist}"
+                )
+                if not options["dry_run"]:
+                    LessonSlot.objects.filter(pk=lesson.pk).update(
+                        reserved_count=lesson.actual_reserved,
+                        waitlist_count=lesson.actual_waitlist,
+                    )
+                    refresh_counters([lesson.pk])
+                    bump_slot_dates([lesson.start_time])
+                fixed += 1
+
+        if options["dry_run"]:
+            self.stdout.write(f"ずれのある授業枠: {fixed} 件（未修正）")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{fixed} 件の授業枠のカウンタを修正しました。"))
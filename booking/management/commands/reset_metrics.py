@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from booking.metrics import reset_metrics
+
+
+class Command(BaseCommand):
+    help = "URL ごとのレスポンス時間・SQL の件数などの集計を削除します（サーバーの起動前に実行）。"
+
+    def handle(self, *args, **options):
+        reset_metrics()
@@ -0,0 +1,78 @@
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from booking.jobs import HEARTBEAT_INTERVAL, claim_jobs, heartbeat, purge_finished_jobs, requeue_stale_jobs, run_job
+from booking.live import purge_slot_changes
+
+# 実行中でないジョブや古い変更フィードの整理を行う間隔（秒）
+MAINTENANCE_INTERVAL = 300
+
+
+class Command(BaseCommand):
+    help = "バックグラウンドジョブのワーカー。待機中のジョブを取り出して実行します。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=2, help="同時に実行するジョブ数（スレッド数）")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="ジョブがないときの待機秒数")
+        parser.add_argument("--once", action="store_true", help="実行可能なジョブがなくなったら終了する")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        if concurrency < 1:
+            raise CommandError("--concurrency は 1 以上を指定してください。")
+
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop.set())
+
+        running = set()
+        lock = threading.Lock()
+
+        def execute(job_obj):
+            try:
+                run_job(job_obj)
+            finally:
+                connection.close()
+                with lock:
+                    running.discard(job_obj.pk)
+
+        self.stdout.write(f"ワーカー {worker_id} を起動しました（同時実行数 {concurrency}）")
+        last_maintenance = 0.0
+        last_heartbeat = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while not stop.is_set():
+                close_old_connections()
+                if time.monotonic() - last_maintenance > MAINTENANCE_INTERVAL:
+                    requeue_stale_jobs()
+                    purge_finished_jobs()
+                    purge_slot_changes()
+                    last_maintenance = time.monotonic()
+                if time.monotonic() - last_heartbeat > HEARTBEAT_INTERVAL.total_seconds():
+                    with lock:
+                        job_ids = list(running)
+                    heartbeat(worker_id, job_ids)
+                    last_heartbeat = time.monotonic()
+
+                with lock:
+                    free = concurrency - len(running)
+                jobs = claim_jobs(worker_id, free) if free > 0 else []
+                for job_obj in jobs:
+                    with lock:
+                        running.add(job_obj.pk)
+                    executor.submit(execute, job_obj)
+
+                if not jobs:
+                    with lock:
+                        idle = not running
+                    if options["once"] and idle:
+                        break
+                    stop.wait(options["poll_interval"])
+
+        self.stdout.write(f"ワーカー {worker_id} を終了しました")
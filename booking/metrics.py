@@ -0,0 +1,245 @@
+import bisect
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# レスポンス時間のヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# リクエストあたりの SQL の件数のヒストグラムの区切り（N+1 の検出用）
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+# プロセスごとの集計をファイルに書き出す間隔（秒）
+FLUSH_INTERVAL = 5
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 処理中のリクエストの SQL の件数と時間（sync_to_async で実行される DB 処理にも引き継がれる）
+_current = contextvars.ContextVar("booking_metrics_request", default=None)
+
+
+class _RequestStats:
+    __slots__ = ("queries", "sql_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    """connection.execute_wrappers に登録して、リクエスト中の SQL の件数と時間を数える"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """DB 接続ごとに record_query を登録する（connection_created シグナルで呼ぶ）"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _empty():
+    return {
+        "requests": 0,
+        "latency_sum": 0.0,
+        "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+        "queries_sum": 0,
+        "query_buckets": [0] * (len(QUERY_BUCKETS) + 1),
+        "sql_seconds": 0.0,
+        "response_bytes": 0,
+    }
+
+
+def _merge(total, views):
+    for view, values in views.items():
+        merged = total.setdefault(view, _empty())
+        for key, value in values.items():
+            if isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+
+
+class _Registry:
+    """
+    プロセス内の URL 名ごとの集計。FLUSH_INTERVAL 秒ごとに METRICS_DIR/<pid>.json に書き出し、
+    gunicorn の複数ワーカーの集計はメトリクスの取得時にファイルを合計して求める。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.flushed_at = 0.0
+
+    def observe(self, view, seconds, queries, sql_seconds, size):
+        with self.lock:
+            values = self.views.get(view)
+            if values is None:
+                values = self.views[view] = _empty()
+            values["requests"] += 1
+            values["latency_sum"] += seconds
+            values["latency_buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            values["queries_sum"] += queries
+            values["query_buckets"][bisect.bisect_left(QUERY_BUCKETS, queries)] += 1
+            values["sql_seconds"] += sql_seconds
+            values["response_bytes"] += size
+            due = time.monotonic() - self.flushed_at >= FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            data = json.dumps({"views": self.views})
+            self.flushed_at = time.monotonic()
+        directory = settings.METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+        # 読み込み中のファイルが途中までにならないよう、一時ファイルに書いてから置き換える
+        fd, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(path, os.path.join(directory, f"{os.getpid()}.json"))
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.flushed_at = 0.0
+
+
+_registry = _Registry()
+
+
+def collect():
+    """全プロセスの集計を合計する {URL名: 集計}"""
+    _registry.flush()
+    total = {}
+    directory = settings.METRICS_DIR
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                _merge(total, json.load(f)["views"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return total
+
+
+def reset_metrics():
+    """集計とファイルを削除する（デプロイ時に終了済みのプロセスの集計を消す）"""
+    _registry.reset()
+    directory = settings.METRICS_DIR
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith((".json", ".tmp")):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram(lines, name, view, bounds, counts, total):
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {cumulative + counts[-1]}')
+    lines.append(f'{name}_sum{{view="{view}"}} {total}')
+    lines.append(f'{name}_count{{view="{view}"}} {cumulative + counts[-1]}')
+
+
+def render_prometheus(views):
+    """集計を Prometheus のテキスト形式にする"""
+    lines = []
+    metrics = [
+        ("booking_request_duration_seconds", "histogram", "レスポンスまでの時間（秒）"),
+        ("booking_request_queries", "histogram", "リクエストあたりの SQL の件数"),
+        ("booking_request_sql_seconds_total", "counter", "SQL の実行時間の合計（秒）"),
+        ("booking_response_bytes_total", "counter", "レスポンスの本文のバイト数の合計（ストリーミングは含まない）"),
+    ]
+    for name, kind, help_text in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for view, values in sorted(views.items()):
+            view = _label(view)
+            if name == "booking_request_duration_seconds":
+                _histogram(lines, name, view, LATENCY_BUCKETS, values["latency_buckets"], values["latency_sum"])
+            elif name == "booking_request_queries":
+                _histogram(lines, name, view, QUERY_BUCKETS, values["query_buckets"], values["queries_sum"])
+            elif name == "booking_request_sql_seconds_total":
+                lines.append(f'{name}{{view="{view}"}} {values["sql_seconds"]}')
+            else:
+                lines.append(f'{name}{{view="{view}"}} {values["response_bytes"]}')
+    return "\n".join(lines) + "\n"
+
+
+def _view_name(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match else "<unresolved>"
+
+
+def _response_size(response):
+    if response.streaming:
+        return 0
+    length = response.get("Content-Length")
+    return int(length) if length else len(response.content)
+
+
+class MetricsMiddleware:
+    """
+    URL 名ごとにレスポンス時間・SQL の件数と時間・レスポンスのサイズを集計する。
+    ミドルウェアの処理時間も含めるため MIDDLEWARE の先頭に置く。
+    ストリーミング（CSV 出力・Server-Sent Events）はレスポンスを返し始めるまでの時間を数える。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _observe(self, request, response, started, stats):
+        _registry.observe(
+            _view_name(request), time.perf_counter() - started,
+            stats.queries, stats.sql_seconds, _response_size(response),
+        )
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = _RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._observe(request, response, started, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = _RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._observe(request, response, started, stats)
+        return response
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:20
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    """既存の予約・補欠件数からカウンタを初期化"""
+    LessonSlot = apps.get_model('booking', 'LessonSlot')
+    Reservation = apps.get_model('booking', 'Reservation')
+    Waitlist = apps.get_model('booking', 'Waitlist')
+
+    def count_of(model):
+        counts = (
+            model.objects.filter(lesson_slot=OuterRef('pk'))
+            .order_by().values('lesson_slot').annotate(c=Count('pk')).values('c')
+        )
+        return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+    LessonSlot.objects.update(
+        reserved_count=count_of(Reservation),
+        waitlist_count=count_of(Waitlist),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lessonslot',
+            name='reserved_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='予約数'),
+        ),
+        migrations.AddField(
+            model_name='lessonslot',
+            name='waitlist_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='補欠数'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
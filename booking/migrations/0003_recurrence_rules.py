@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0002_lessonslot_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurrenceRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=200, verbose_name='授業名')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, '月曜日'), (1, '火曜日'), (2, '水曜日'), (3, '木曜日'), (4, '金曜日'), (5, '土曜日'), (6, '日曜日')], verbose_name='曜日')),
+                ('start_time', models.TimeField(verbose_name='開始時刻')),
+                ('end_time', models.TimeField(verbose_name='終了時刻')),
+                ('capacity', models.PositiveIntegerField(default=1, verbose_name='定員')),
+                ('reservation_open_offset', models.DurationField(help_text='例: 7 00:00:00 で授業開始の7日前から予約を受け付けます。', verbose_name='予約開始（授業開始の何日/何時間前）')),
+                ('valid_from', models.DateField(verbose_name='適用開始日')),
+                ('valid_until', models.DateField(blank=True, null=True, verbose_name='適用終了日')),
+                ('is_active', models.BooleanField(default=True, verbose_name='有効')),
+            ],
+            options={
+                'verbose_name': '繰り返しルール',
+                'verbose_name_plural': '繰り返しルール',
+                'ordering': ['weekday', 'start_time'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RecurrenceException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='休講日')),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='booking.recurrencerule', verbose_name='繰り返しルール')),
+            ],
+            options={
+                'verbose_name': '休講日',
+                'verbose_name_plural': '休講日',
+            },
+        ),
+        migrations.AddField(
+            model_name='lessonslot',
+            name='recurrence_rule',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='booking.recurrencerule', verbose_name='繰り返しルール'),
+        ),
+        migrations.AddConstraint(
+            model_name='lessonslot',
+            constraint=models.UniqueConstraint(fields=('recurrence_rule', 'start_time'), name='unique_recurrence_occurrence'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='recurrenceexception',
+            unique_together={('rule', 'date')},
+        ),
+    ]
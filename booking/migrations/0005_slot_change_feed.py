@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lesson_slot_id', models.BigIntegerField(verbose_name='授業枠ID')),
+                ('capacity', models.PositiveIntegerField(verbose_name='定員')),
+                ('reserved_count', models.PositiveIntegerField(verbose_name='予約数')),
+                ('waitlist_count', models.PositiveIntegerField(verbose_name='補欠数')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='記録日時')),
+            ],
+            options={
+                'verbose_name': '空き状況の変更',
+                'verbose_name_plural': '空き状況の変更',
+                'ordering': ['pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0005_slot_change_feed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reservation',
+            name='lesson_slot',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='booking.lessonslot', verbose_name='授業枠'),
+        ),
+        migrations.AlterField(
+            model_name='reservation',
+            name='student',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='booking.student', verbose_name='予約生徒'),
+        ),
+        migrations.AlterField(
+            model_name='waitlist',
+            name='lesson_slot',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='booking.lessonslot', verbose_name='授業枠'),
+        ),
+        migrations.AddIndex(
+            model_name='lessonslot',
+            index=models.Index(fields=['start_time'], include=('capacity', 'reserved_count', 'waitlist_count', 'reservation_start_time'), name='booking_slot_start_time'),
+        ),
+        migrations.AddIndex(
+            model_name='lessonslot',
+            index=models.Index(condition=models.Q(('waitlist_count__gt', 0)), fields=['start_time'], name='booking_slot_waitlisted'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['student', 'lesson_slot'], name='booking_reservation_student'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['-reserved_at', '-id'], name='booking_reservation_recent'),
+        ),
+        migrations.AddIndex(
+            model_name='waitlist',
+            index=models.Index(fields=['lesson_slot', 'waitlisted_at'], name='booking_waitlist_slot_order'),
+        ),
+    ]
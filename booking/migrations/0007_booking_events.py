@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_events(apps, schema_editor):
+    """既存の予約・補欠を、予約日時・補欠登録日時の履歴として登録する（過去のキャンセルは復元できない）"""
+    BookingEvent = apps.get_model('booking', 'BookingEvent')
+    Reservation = apps.get_model('booking', 'Reservation')
+    Waitlist = apps.get_model('booking', 'Waitlist')
+
+    for model, kind, field in [(Reservation, 'reserved', 'reserved_at'), (Waitlist, 'waitlisted', 'waitlisted_at')]:
+        BookingEvent.objects.bulk_create(
+            (
+                BookingEvent(kind=kind, lesson_slot_id=lesson_slot_id, created_at=created_at)
+                for lesson_slot_id, created_at in model.objects.values_list('lesson_slot_id', field).iterator()
+            ),
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_booking_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('reserved', '予約'), ('cancelled', 'キャンセル'), ('waitlisted', '補欠登録')], max_length=10, verbose_name='種別')),
+                ('lesson_slot_id', models.BigIntegerField(verbose_name='授業枠ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='日時')),
+            ],
+            options={
+                'verbose_name': '予約の履歴',
+                'verbose_name_plural': '予約の履歴',
+                'indexes': [models.Index(fields=['created_at', 'kind'], name='booking_event_created_kind')],
+            },
+        ),
+        migrations.RunPython(backfill_events, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_booking_events'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookingevent',
+            index=models.Index(fields=['lesson_slot_id', 'created_at'], name='booking_event_slot_created'),
+        ),
+    ]
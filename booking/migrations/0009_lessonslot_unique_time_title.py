@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:15
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef
+
+
+def resolve_duplicates(apps, schema_editor):
+    """
+    一意制約の追加前に、開始日時・終了日時・授業名が同じ授業枠を1つにする。
+    予約・補欠のない重複は削除し、予約・補欠のある重複は削除せず授業名に ID を付けて区別する。
+    """
+    LessonSlot = apps.get_model('booking', 'LessonSlot')
+    Reservation = apps.get_model('booking', 'Reservation')
+    Waitlist = apps.get_model('booking', 'Waitlist')
+
+    duplicates = (
+        LessonSlot.objects.values('start_time', 'end_time', 'title')
+        .annotate(n=Count('pk')).filter(n__gt=1).order_by()
+    )
+    for key in duplicates:
+        slots = list(
+            LessonSlot.objects.filter(
+                start_time=key['start_time'], end_time=key['end_time'], title=key['title'],
+            ).annotate(
+                booked=Exists(Reservation.objects.filter(lesson_slot=OuterRef('pk')))
+                | Exists(Waitlist.objects.filter(lesson_slot=OuterRef('pk'))),
+            ).order_by('-booked', 'pk')
+        )
+        # 予約・補欠のあるもの（なければ最初に作成したもの）を残す
+        for slot in slots[1:]:
+            if slot.booked:
+                slot.title = f"{slot.title[:180]} ({slot.pk})"
+                slot.save(update_fields=['title'])
+            else:
+                slot.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0008_booking_event_slot_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(resolve_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='lessonslot',
+            constraint=models.UniqueConstraint(fields=('start_time', 'end_time', 'title'), name='unique_slot_time_title', violation_error_message='同じ日時・授業名の授業枠がすでにあります。'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:40
+
+from django.db import migrations
+from django.db.models import Count, Exists, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def remove_duplicates(apps, schema_editor):
+    """同じ授業枠を予約済みの生徒の補欠を削除し、補欠数カウンタを数え直す"""
+    LessonSlot = apps.get_model('booking', 'LessonSlot')
+    Reservation = apps.get_model('booking', 'Reservation')
+    Waitlist = apps.get_model('booking', 'Waitlist')
+
+    duplicates = Waitlist.objects.filter(Exists(Reservation.objects.filter(
+        lesson_slot_id=OuterRef('lesson_slot_id'), student_id=OuterRef('student_id'),
+    )))
+    slot_ids = set(duplicates.values_list('lesson_slot_id', flat=True))
+    if not slot_ids:
+        return
+    duplicates.delete()
+
+    counts = (
+        Waitlist.objects.filter(lesson_slot=OuterRef('pk'))
+        .order_by().values('lesson_slot').annotate(c=Count('pk')).values('c')
+    )
+    LessonSlot.objects.filter(pk__in=slot_ids).update(
+        waitlist_count=Coalesce(Subquery(counts, output_field=IntegerField()), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0009_lessonslot_unique_time_title'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_remove_reserved_waitlist_duplicates'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bookingevent',
+            name='kind',
+            field=models.CharField(choices=[('reserved', '予約'), ('cancelled', 'キャンセル'), ('waitlisted', '補欠登録'), ('dequeued', '補欠の解除（繰り上げ・取り消し）')], max_length=10, verbose_name='種別'),
+        ),
+    ]
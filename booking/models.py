@@ -34,7 +34,59 @@ class Student(models.Model):
     def __str__(self):
         return self.name
 
-# 3. 授業枠モデル (A-1, A-2: 管理者による設定)
+# 3. 繰り返しルールモデル (A-1: 毎週の定期授業)
+class RecurrenceRule(models.Model):
+    """
+    「毎週火曜 17:00」のような定期授業のルール。
+    授業枠 (LessonSlot) は表示期間に応じて booking.recurrence で必要な分だけ作成される。
+    """
+    WEEKDAYS = [
+        (0, '月曜日'), (1, '火曜日'), (2, '水曜日'), (3, '木曜日'),
+        (4, '金曜日'), (5, '土曜日'), (6, '日曜日'),
+    ]
+
+    title = models.CharField(max_length=200, blank=True, verbose_name="授業名")
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAYS, verbose_name="曜日")
+    start_time = models.TimeField(verbose_name="開始時刻")
+    end_time = models.TimeField(verbose_name="終了時刻")
+    capacity = models.PositiveIntegerField(default=1, verbose_name="定員")
+    reservation_open_offset = models.DurationField(
+        verbose_name="予約開始（授業開始の何日/何時間前）",
+        help_text="例: 7 00:00:00 で授業開始の7日前から予約を受け付けます。",
+    )
+    valid_from = models.DateField(verbose_name="適用開始日")
+    valid_until = models.DateField(null=True, blank=True, verbose_name="適用終了日")
+    is_active = models.BooleanField(default=True, verbose_name="有効")
+
+    class Meta:
+        verbose_name = "繰り返しルール"
+        verbose_name_plural = "繰り返しルール"
+        ordering = ["weekday", "start_time"]
+
+    def __str__(self):
+        return f"{self.title or '書道教室'} (毎週{self.get_weekday_display()} {self.start_time.strftime('%H:%M')})"
+
+    def clean(self):
+        if self.start_time and self.end_time and self.start_time >= self.end_time:
+            raise ValidationError("終了時刻は開始時刻より後に設定してください。")
+        if self.valid_from and self.valid_until and self.valid_from > self.valid_until:
+            raise ValidationError("適用開始日は適用終了日よりも前の日付を設定してください。")
+
+
+class RecurrenceException(models.Model):
+    """繰り返しルールの休講日（この日は授業枠を作成しない）"""
+    rule = models.ForeignKey(RecurrenceRule, on_delete=models.CASCADE, related_name="exceptions", verbose_name="繰り返しルール")
+    date = models.DateField(verbose_name="休講日")
+
+    class Meta:
+        verbose_name = "休講日"
+        verbose_name_plural = "休講日"
+        unique_together = ("rule", "date")
+
+    def __str__(self):
+        return f"{self.rule} 休講: {self.date:%Y/%m/%d}"
+
+# 4. 授業枠モデル (A-1, A-2: 管理者による設定)
 class LessonSlot(models.Model):
     """
     書道教室の授業枠（日時、定員、予約開始時刻）を管理するモデル。
@@ -44,31 +96,68 @@ class LessonSlot(models.Model):
     end_time = models.DateTimeField(verbose_name="終了日時")
     capacity = models.PositiveIntegerField(default=1, verbose_name="定員")
     reservation_start_time = models.DateTimeField(verbose_name="予約開始時刻")
+    # 予約数・補欠数の非正規化カウンタ (booking.signals で Reservation/Waitlist の作成・削除に追従)
+    reserved_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="予約数")
+    waitlist_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="補欠数")
+    # 繰り返しルールから作成された授業枠の場合のみ設定
+    recurrence_rule = models.ForeignKey(
+        RecurrenceRule, null=True, blank=True, editable=False,
+        on_delete=models.SET_NULL, verbose_name="繰り返しルール",
+    )
 
     class Meta:
         verbose_name = "授業枠"
         verbose_name_plural = "授業枠"
         ordering = ["start_time"]
+        constraints = [
+            # 同じルールの同じ回は1つだけ作成する
+            models.UniqueConstraint(fields=["recurrence_rule", "start_time"], name="unique_recurrence_occurrence"),
+            # 一括作成の重複防止（同時に実行しても同じ日時・授業名の授業枠は1つだけ）
+            models.UniqueConstraint(
+                fields=["start_time", "end_time", "title"],
+                name="unique_slot_time_title",
+                violation_error_message="同じ日時・授業名の授業枠がすでにあります。",
+            ),
+        ]
+        indexes = [
+            # 今後の授業枠を開始日時順に取得する検索用（カレンダー・空き状況スナップショット）。
+            # PostgreSQL では空き状況の列も含め、テーブルを読まずに取得できるようにする
+            models.Index(
+                fields=["start_time"],
+                include=["capacity", "reserved_count", "waitlist_count", "reservation_start_time"],
+                name="booking_slot_start_time",
+            ),
+            # 補欠のいる授業枠だけを対象にした部分インデックス（補欠の一括繰り上げ用）
+            models.Index(
+                fields=["start_time"],
+                condition=models.Q(waitlist_count__gt=0),
+                name="booking_slot_waitlisted",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.start_time.strftime('%Y/%m/%d %H:%M')})"
 
     def is_reservable(self):
-        """現在予約可能かどうかを判定"""
+        """現在予約可能かどうかを判定（空き状況スナップショットにあればその値を使う）"""
+        from .availability import slot_availability
+        availability = slot_availability(self.pk)
+        if availability is not None:
+            return availability.is_reservable()
         return timezone.now() >= self.reservation_start_time and self.available_slots() > 0
 
     def available_slots(self):
-        """残りの予約可能枠数を計算"""
-        reserved_count = self.reservation_set.count()
-        return self.capacity - reserved_count
+        """残りの予約可能枠数を計算（カウンタを参照するためクエリは発行しない）"""
+        return self.capacity - self.reserved_count
 
-# 4. 予約モデル (S-1: 生徒による予約)
+# 5. 予約モデル (S-1: 生徒による予約)
 class Reservation(models.Model):
     """
     生徒による授業枠の予約を管理するモデル。
     """
-    lesson_slot = models.ForeignKey(LessonSlot, on_delete=models.CASCADE, verbose_name="授業枠")
-    student = models.ForeignKey(Student, on_delete=models.CASCADE, verbose_name="予約生徒")
+    # 授業枠・生徒での検索は下記の複合インデックスで行うため、外部キー単独のインデックスは作成しない
+    lesson_slot = models.ForeignKey(LessonSlot, on_delete=models.CASCADE, db_index=False, verbose_name="授業枠")
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, db_index=False, verbose_name="予約生徒")
     reserved_at = models.DateTimeField(auto_now_add=True, verbose_name="予約日時")
 
     class Meta:
@@ -76,16 +165,23 @@ class Reservation(models.Model):
         verbose_name_plural = "予約"
         # 同じ授業枠に同じ生徒が二重予約できないようにする
         unique_together = ("lesson_slot", "student")
+        indexes = [
+            # 家族の生徒ごとの予約一覧用
+            models.Index(fields=["student", "lesson_slot"], name="booking_reservation_student"),
+            # 予約一覧（新しい順）用
+            models.Index(fields=["-reserved_at", "-id"], name="booking_reservation_recent"),
+        ]
 
     def __str__(self):
         return f"{self.student.name} - {self.lesson_slot.title}"
 
-# 5. 補欠モデル (S-2: 補欠機能)
+# 6. 補欠モデル (S-2: 補欠機能)
 class Waitlist(models.Model):
     """
     定員オーバー時の補欠予約を管理するモデル。
     """
-    lesson_slot = models.ForeignKey(LessonSlot, on_delete=models.CASCADE, verbose_name="授業枠")
+    # 授業枠での検索は下記の複合インデックスで行うため、外部キー単独のインデックスは作成しない
+    lesson_slot = models.ForeignKey(LessonSlot, on_delete=models.CASCADE, db_index=False, verbose_name="授業枠")
     student = models.ForeignKey(Student, on_delete=models.CASCADE, verbose_name="補欠生徒")
     waitlisted_at = models.DateTimeField(auto_now_add=True, verbose_name="補欠登録日時")
 
@@ -96,6 +192,105 @@ class Waitlist(models.Model):
         ordering = ["waitlisted_at"]
         # 同じ授業枠に同じ生徒が二重に補欠登録できないようにする
         unique_together = ("lesson_slot", "student")
+        indexes = [
+            # 授業枠ごとの補欠を登録順に取得する検索用（繰り上げ処理）
+            models.Index(fields=["lesson_slot", "waitlisted_at"], name="booking_waitlist_slot_order"),
+        ]
 
     def __str__(self):
         return f"補欠: {self.student.name} - {self.lesson_slot.title}"
+
+# 7. バックグラウンドジョブモデル
+class Job(models.Model):
+    """
+    リクエスト外で実行する処理のキュー。
+    booking.jobs.enqueue で登録し、manage.py run_jobs のワーカーが取り出して実行する。
+    """
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "待機中"),
+        (STATUS_RUNNING, "実行中"),
+        (STATUS_DONE, "完了"),
+        (STATUS_FAILED, "失敗"),
+    ]
+
+    name = models.CharField(max_length=100, verbose_name="ジョブ名")
+    payload = models.JSONField(default=dict, blank=True, verbose_name="引数")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name="状態")
+    run_at = models.DateTimeField(default=timezone.now, verbose_name="実行予定日時")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="試行回数")
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name="最大試行回数")
+    last_error = models.TextField(blank=True, verbose_name="最後のエラー")
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name="実行ワーカー")
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name="実行開始日時")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="登録日時")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="終了日時")
+
+    class Meta:
+        verbose_name = "ジョブ"
+        verbose_name_plural = "ジョブ"
+        ordering = ["run_at"]
+        indexes = [
+            # ワーカーが実行可能なジョブを取り出す検索用
+            models.Index(fields=["status", "run_at"], name="booking_job_status_run_at"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+# 8. 空き状況の変更フィード（ライブ更新をプロセス間で共有するため）
+class SlotChange(models.Model):
+    """
+    授業枠の予約数・補欠数が変わったときの値を記録する。
+    各プロセスはこのテーブルを定期的に読み、接続中のブラウザへ変更を配信する。
+    """
+    lesson_slot_id = models.BigIntegerField(verbose_name="授業枠ID")
+    capacity = models.PositiveIntegerField(verbose_name="定員")
+    reserved_count = models.PositiveIntegerField(verbose_name="予約数")
+    waitlist_count = models.PositiveIntegerField(verbose_name="補欠数")
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name="記録日時")
+
+    class Meta:
+        verbose_name = "空き状況の変更"
+        verbose_name_plural = "空き状況の変更"
+        ordering = ["pk"]
+
+    def __str__(self):
+        return f"授業枠 {self.lesson_slot_id}: {self.reserved_count}/{self.capacity}"
+
+# 9. 予約の履歴（管理者ダッシュボードの日別の推移用）
+class BookingEvent(models.Model):
+    """
+    予約・キャンセル・補欠登録・補欠の解除を1件ずつ記録する。予約や補欠は削除されると残らないため、
+    推移の集計はこのテーブルから行う。
+    """
+    KIND_RESERVED = "reserved"
+    KIND_CANCELLED = "cancelled"
+    KIND_WAITLISTED = "waitlisted"
+    KIND_DEQUEUED = "dequeued"
+    KIND_CHOICES = [
+        (KIND_RESERVED, "予約"),
+        (KIND_CANCELLED, "キャンセル"),
+        (KIND_WAITLISTED, "補欠登録"),
+        (KIND_DEQUEUED, "補欠の解除（繰り上げ・取り消し）"),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name="種別")
+    lesson_slot_id = models.BigIntegerField(verbose_name="授業枠ID")
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="日時")
+
+    class Meta:
+        verbose_name = "予約の履歴"
+        verbose_name_plural = "予約の履歴"
+        indexes = [
+            # 期間を指定した日別・種別ごとの集計用（テーブルを読まずにインデックスだけで集計できる）
+            models.Index(fields=["created_at", "kind"], name="booking_event_created_kind"),
+            # 授業枠ごとの履歴を日時順に読む検索用（満席までの時間の分析）
+            models.Index(fields=["lesson_slot_id", "created_at"], name="booking_event_slot_created"),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()}: 授業枠 {self.lesson_slot_id}"
@@ -0,0 +1,228 @@
+import csv
+import io
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from .models import Family, Student
+
+# CSV の列（1行に生徒1人。兄弟は同じユーザー名の行を続けて書く。2行目以降のパスワード・電話番号は省略可）
+COLUMNS = ("ユーザー名", "パスワード", "電話番号", "生徒名")
+BATCH_SIZE = 500
+# この件数未満のパスワードはプロセスを起動せずに順番にハッシュ化する
+PARALLEL_HASH_THRESHOLD = 8
+# バックグラウンドで取り込む CSV をキャッシュに保存しておく秒数（ジョブの再試行を含めて取り込みが終わるまで）。
+# CSV は平文のパスワードを含むため、ジョブの引数（DB）には保存せずキャッシュのキーだけを渡し、
+# ジョブの最初の実行でパスワードをハッシュ化した取り込み内容に置き換える
+UPLOAD_TIMEOUT = 60 * 60
+
+_UPLOAD_KEY = "booking:family-import:{}"
+
+_username_validator = UnicodeUsernameValidator()
+
+
+class FamilyRow(NamedTuple):
+    """取り込む家族1件（line は CSV で最初に現れた行番号）"""
+    line: int
+    username: str
+    password: str
+    phone_number: str
+    students: tuple
+
+
+class ImportPlan(NamedTuple):
+    """CSV の検証結果。errors が空の場合だけ取り込める"""
+    families: list
+    errors: list
+    duplicates: list
+
+    @property
+    def student_count(self):
+        return sum(len(family.students) for family in self.families)
+
+
+class ImportResult(NamedTuple):
+    """取り込みの結果"""
+    families: int
+    students: int
+
+
+def decode_csv(data):
+    """アップロードされた CSV を文字列にする（BOM 付き UTF-8 と、Excel 既定の Shift_JIS に対応）"""
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp932")
+
+
+def stash_upload(text):
+    """取り込み待ちの CSV をキャッシュに保存し、ジョブに渡す参照（推測できないトークン）を返す"""
+    token = secrets.token_urlsafe(16)
+    cache.set(_UPLOAD_KEY.format(token), text, timeout=UPLOAD_TIMEOUT)
+    return token
+
+
+def load_upload(token):
+    """
+    stash_upload で保存した CSV、または replace_upload で置き換えた ImportPlan
+    （保存期間を過ぎた場合や取り込み済みの場合は None）
+    """
+    return cache.get(_UPLOAD_KEY.format(token))
+
+
+def replace_upload(token, plan):
+    """保存した CSV を、パスワードをハッシュ化済みの ImportPlan に置き換える"""
+    cache.set(_UPLOAD_KEY.format(token), plan, timeout=UPLOAD_TIMEOUT)
+
+
+def discard_upload(token):
+    cache.delete(_UPLOAD_KEY.format(token))
+
+
+def parse_family_csv(text):
+    """
+    CSV を検証して ImportPlan を返す。DB へは既存ユーザー名の確認の1クエリだけを行う。
+    既存のユーザー名や同じ家族内で重複する生徒名は取り込まずに duplicates に報告する。
+    """
+    text = text.lstrip("\ufeff")
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [column for column in COLUMNS if column not in (reader.fieldnames or ())]
+    if missing:
+        return ImportPlan([], [f"列が見つかりません: {', '.join(missing)}"], [])
+
+    errors = []
+    rows = {}
+    for line, record in enumerate(reader, start=2):
+        username, password, phone_number, name = ((record.get(column) or "").strip() for column in COLUMNS)
+        if not any((username, password, phone_number, name)):
+            continue
+        try:
+            _username_validator(username)
+        except ValidationError:
+            errors.append(f"{line}行目: ユーザー名「{username}」が正しくありません。")
+            continue
+        if len(username) > 150:
+            errors.append(f"{line}行目: ユーザー名は150文字以内にしてください。")
+            continue
+        if not name or len(name) > 100:
+            errors.append(f"{line}行目: 生徒名は1〜100文字で入力してください。")
+            continue
+        if len(phone_number) > 15:
+            errors.append(f"{line}行目: 電話番号は15文字以内にしてください。")
+            continue
+
+        family = rows.setdefault(username, {"line": line, "password": "", "phone_number": "", "students": []})
+        family["password"] = family["password"] or password
+        family["phone_number"] = family["phone_number"] or phone_number
+        family["students"].append((line, name))
+
+    existing = set(User.objects.filter(username__in=rows).values_list("username", flat=True))
+    families = []
+    duplicates = []
+    for username, family in rows.items():
+        if username in existing:
+            duplicates.append(f"{family['line']}行目: ユーザー名「{username}」は登録済みのためスキップします。")
+            continue
+        if not family["password"]:
+            errors.append(f"{family['line']}行目: ユーザー名「{username}」のパスワードがありません。")
+            continue
+        try:
+            validate_password(family["password"], User(username=username))
+        except ValidationError as e:
+            errors.append(f"{family['line']}行目: {' '.join(e.messages)}")
+            continue
+        names = []
+        for line, name in family["students"]:
+            if name in names:
+                duplicates.append(f"{line}行目: 生徒名「{name}」が同じ家族内で重複しているためスキップします。")
+            else:
+                names.append(name)
+        families.append(FamilyRow(family["line"], username, family["password"], family["phone_number"], tuple(names)))
+    return ImportPlan(families, errors, duplicates)
+
+
+def _hash_chunk(passwords):
+    return [make_password(password) for password in passwords]
+
+
+def hash_passwords(passwords, workers=None):
+    """
+    パスワードをハッシュ化する。PBKDF2 は1件ごとに CPU を使い続けるため、
+    件数が多い場合は workers 個のプロセスに分けて並列に計算する（None は CPU 数）。
+    """
+    passwords = list(passwords)
+    workers = min(workers or os.cpu_count() or 1, len(passwords))
+    if workers <= 1 or len(passwords) < PARALLEL_HASH_THRESHOLD:
+        return _hash_chunk(passwords)
+    size = -(-len(passwords) // workers)
+    chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+    # spawn で起動された子プロセスでも設定を読み込めるよう django.setup() で初期化する
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        return [hashed for chunk in executor.map(_hash_chunk, chunks) for hashed in chunk]
+
+
+def hash_plan(plan, workers=None):
+    """パスワードをハッシュ化した ImportPlan を返す（import_families には hashed=True で渡す）"""
+    hashed = hash_passwords([family.password for family in plan.families], workers)
+    return plan._replace(families=[
+        family._replace(password=password) for family, password in zip(plan.families, hashed)
+    ])
+
+
+def skip_registered(plan):
+    """検証後に登録されたユーザー名の家族を除いた ImportPlan を返す"""
+    existing = set(User.objects.filter(
+        username__in=[family.username for family in plan.families]
+    ).values_list("username", flat=True))
+    if not existing:
+        return plan
+    return plan._replace(families=[family for family in plan.families if family.username not in existing])
+
+
+def _batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def import_families(plan, *, workers=None, batch_size=BATCH_SIZE, hashed=False):
+    """
+    検証済みの ImportPlan から User・Family・Student を batch_size 件ずつ bulk_create で作成する。
+    全体を1トランザクションで行い、途中で失敗した場合は何も作成しない。
+    新しい生徒には予約がないため、カレンダーのキャッシュの更新は不要。
+    hashed=True の場合、plan のパスワードは hash_plan でハッシュ化済みとして扱う。
+    """
+    if plan.errors:
+        raise ValueError("検証エラーのある CSV は取り込めません。")
+    passwords = [family.password for family in plan.families]
+    if not hashed:
+        passwords = hash_passwords(passwords, workers)
+
+    with transaction.atomic():
+        for batch in _batched(list(zip(plan.families, passwords)), batch_size):
+            User.objects.bulk_create([
+                User(username=family.username, password=password) for family, password in batch
+            ])
+            # bulk_create で pk が返らないバックエンドに備えて取り直す
+            user_ids = dict(User.objects.filter(
+                username__in=[family.username for family, _ in batch]
+            ).values_list("username", "pk"))
+            Family.objects.bulk_create([
+                Family(user_id=user_ids[family.username], phone_number=family.phone_number)
+                for family, _ in batch
+            ])
+            family_ids = dict(Family.objects.filter(user_id__in=user_ids.values()).values_list("user_id", "pk"))
+            Student.objects.bulk_create([
+                Student(family_id=family_ids[user_ids[family.username]], name=name)
+                for family, _ in batch
+                for name in family.students
+            ])
+    return ImportResult(families=len(plan.families), students=plan.student_count)
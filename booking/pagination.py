@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.db.models import Q
+
+PAGE_SIZE = 50
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class Cursor(NamedTuple):
+    """キーセットページングの位置（並び替えに使う日時と ID）"""
+    value: datetime
+    pk: int
+
+    def encode(self):
+        """URL に含める文字列（UNIX 時刻のマイクロ秒-ID）"""
+        return f"{(self.value - _EPOCH) // timedelta(microseconds=1)}-{self.pk}"
+
+    @classmethod
+    def decode(cls, text):
+        """encode の逆変換。不正な値の場合は ValueError"""
+        micros, pk = text.split("-")
+        return cls(_EPOCH + timedelta(microseconds=int(micros)), int(pk))
+
+
+class KeysetPage(NamedTuple):
+    """1ページ分の結果と、前後のページの位置（ない場合は None）"""
+    items: list
+    newer: str | None
+    older: str | None
+
+
+def paginate_recent(queryset, field, *, after=None, before=None, size=PAGE_SIZE):
+    """
+    (field, pk) の降順（新しい順）で size 件を取得する。
+    after を指定するとその位置より古いページ、before を指定するとその位置より新しいページを返す。
+    OFFSET を使わないため、履歴が増えてもページの取得にかかる時間は変わらない。
+    """
+    def cursor(obj):
+        return Cursor(getattr(obj, field), obj.pk).encode()
+
+    if before is not None:
+        # 先頭の条件はインデックスの範囲指定に使われる
+        rows = list(
+            queryset.filter(Q(**{f"{field}__gte": before.value}))
+            .filter(Q(**{f"{field}__gt": before.value}) | Q(pk__gt=before.pk))
+            .order_by(field, "pk")[:size + 1]
+        )
+        items = rows[:size][::-1]
+        if items:
+            return KeysetPage(
+                items=items,
+                newer=cursor(items[0]) if len(rows) > size else None,
+                older=cursor(items[-1]),
+            )
+        after = None
+
+    if after is not None:
+        queryset = (
+            queryset.filter(Q(**{f"{field}__lte": after.value}))
+            .filter(Q(**{f"{field}__lt": after.value}) | Q(pk__lt=after.pk))
+        )
+    rows = list(queryset.order_by(f"-{field}", "-pk")[:size + 1])
+    items = rows[:size]
+    return KeysetPage(
+        items=items,
+        newer=cursor(items[0]) if after is not None and items else None,
+        older=cursor(items[-1]) if len(rows) > size else None,
+    )
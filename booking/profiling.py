@@ -0,0 +1,214 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+# このヘッダーを付けた管理者のリクエストはサンプリング率に関わらずプロファイルする
+PROFILE_HEADER = "X-Profile"
+# 要約に表示する関数の数（累積時間の順）
+TOP_FUNCTIONS = 30
+# 要約に表示する SQL の数（実行時間の順）と、1件あたりの最大文字数
+TOP_QUERIES = 10
+SQL_MAX_LENGTH = 500
+
+# プロファイル中のリクエストの SQL と実行時間
+_query_log = ContextVar("booking_profile_queries", default=None)
+# cProfile はスレッドごとに1つしか有効にできないため、プロセス内で同時にプロファイルするのは1件まで
+_profiling = threading.Lock()
+
+
+def record_query(execute, sql, params, many, context):
+    """connection.execute_wrappers に登録して、プロファイル中のリクエストの SQL を記録する"""
+    log = _query_log.get()
+    if log is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        log.append((sql, time.perf_counter() - started))
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """DB 接続ごとに record_query を登録する（connection_created シグナルで呼ぶ）"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class ProfileInfo(NamedTuple):
+    """保存したプロファイル1件（name は拡張子を除いたファイル名）"""
+    name: str
+    view: str
+    method: str
+    path: str
+    status: int
+    seconds: float
+    queries: int
+    sql_seconds: float
+    created_at: str
+    # 関数ごとの時間（.prof）を保存したかどうか（WSGI の非同期ビューは保存しない）
+    functions: bool = True
+
+
+def _sampled(staff_header):
+    """プロファイルするかどうか（同時にプロファイル中のリクエストがある場合はしない）"""
+    rate = settings.PROFILE_SAMPLE_RATE
+    if not staff_header and not (rate > 0 and random.random() < rate):
+        return False
+    return _profiling.acquire(blocking=False)
+
+
+def _stem(view):
+    return "{}-{}-{}".format(timezone.now().strftime("%Y%m%d%H%M%S%f"), re.sub(r"[^\w.-]", "_", view), os.getpid())
+
+
+def _summary(info, profiler, queries):
+    out = io.StringIO()
+    out.write(f"{info.method} {info.path} ({info.view}) -> {info.status}\n")
+    out.write(f"時間 {info.seconds * 1000:.1f} ms / SQL {info.queries} 件 {info.sql_seconds * 1000:.1f} ms\n\n")
+    out.write(f"実行時間の長い SQL（上位 {TOP_QUERIES} 件）\n")
+    for sql, seconds in sorted(queries, key=lambda query: query[1], reverse=True)[:TOP_QUERIES]:
+        out.write(f"{seconds * 1000:8.2f} ms  {sql[:SQL_MAX_LENGTH]}\n")
+    out.write("\n")
+    if info.functions:
+        pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+    else:
+        out.write("非同期ビューは WSGI ではイベントループの別スレッドで実行されるため、関数ごとの時間は計測できません。\n")
+    return out.getvalue()
+
+
+def _rotate(directory):
+    """ディレクトリの合計サイズが PROFILE_MAX_BYTES を超えた分を古いプロファイルから削除する"""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+    total = sum(size for _, _, size in entries)
+    for _, name, size in sorted(entries):
+        if total <= settings.PROFILE_MAX_BYTES:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def save_profile(info, profiler, queries):
+    """.prof（pstats 形式）・.txt（要約）・.json（ビュー名などの情報）を PROFILE_DIR に保存する"""
+    directory = settings.PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, info.name)
+    if info.functions:
+        profiler.dump_stats(base + ".prof")
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(_summary(info, profiler, queries))
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(info._asdict(), f, ensure_ascii=False)
+    _rotate(directory)
+
+
+def load_profiles(view=None):
+    """保存済みのプロファイルの一覧（古い順）。view を指定するとそのビューのみ"""
+    directory = settings.PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                info = ProfileInfo(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            continue
+        if view is None or info.view == view:
+            profiles.append(info)
+    return profiles
+
+
+class _Capture:
+    """with の間、現在のスレッドを cProfile で計測し、SQL を記録する（終了時に _profiling を解放する）"""
+
+    def __enter__(self):
+        self.profiler = cProfile.Profile()
+        self.queries = []
+        self.token = _query_log.set(self.queries)
+        self.started = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        _query_log.reset(self.token)
+        _profiling.release()
+
+    def result(self, request, response, functions=True):
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "<unresolved>"
+        info = ProfileInfo(
+            name=_stem(view),
+            view=view,
+            method=request.method,
+            path=request.get_full_path(),
+            status=response.status_code,
+            seconds=self.seconds,
+            queries=len(self.queries),
+            sql_seconds=sum(seconds for _, seconds in self.queries),
+            created_at=timezone.now().isoformat(),
+            functions=functions,
+        )
+        return info, self.profiler, self.queries
+
+
+class ProfilingMiddleware:
+    """
+    PROFILE_SAMPLE_RATE の割合のリクエスト、または X-Profile ヘッダーを付けた管理者のリクエストを
+    cProfile でプロファイルし、SQL の実行時間と合わせて PROFILE_DIR に保存する。
+    cProfile はこのミドルウェアを実行するスレッドのみを計測する。ASGI の非同期ビューではイベントループ上の処理
+    （同時に処理中の他のリクエストを含む）を計測し、run_db のスレッドの処理は SQL の記録のみになる。
+    WSGI の非同期ビューはイベントループの別スレッドで実行されビューの関数が計測に現れないため、
+    .prof は保存せず、SQL と全体の時間のみを記録する。
+    AuthenticationMiddleware の後に置く。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not _sampled(bool(request.headers.get(PROFILE_HEADER)) and request.user.is_staff):
+            return self.get_response(request)
+        with _Capture() as capture:
+            response = self.get_response(request)
+        match = getattr(request, "resolver_match", None)
+        async_view = match is not None and iscoroutinefunction(match.func)
+        save_profile(*capture.result(request, response, functions=not async_view))
+        return response
+
+    async def __acall__(self, request):
+        staff_header = bool(request.headers.get(PROFILE_HEADER)) and (await request.auser()).is_staff
+        if not _sampled(staff_header):
+            return await self.get_response(request)
+        with _Capture() as capture:
+            response = await self.get_response(request)
+        await sync_to_async(save_profile)(*capture.result(request, response))
+        return response
@@ -0,0 +1,168 @@
+import itertools
+from datetime import datetime, timedelta
+
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .availability import invalidate_snapshot
+from .calendar_cache import bump_slot_dates
+from .models import LessonSlot, RecurrenceRule, RecurrenceException
+from .services import promote_waitlist
+from .slot_generation import DEFAULT_TITLE, SlotDefinition
+
+
+def iter_occurrences(rule, start_date, end_date, skip_dates=(), tz=None):
+    """
+    ルールの start_date〜end_date（両端を含む）の回を SlotDefinition として生成する。
+    休講日 (skip_dates) と適用期間外の日は除く。DB にはアクセスしない。
+    """
+    tz = tz or timezone.get_current_timezone()
+    first = max(start_date, rule.valid_from)
+    last = min(end_date, rule.valid_until) if rule.valid_until else end_date
+    # 最初の該当曜日まで進める
+    current = first + timedelta(days=(rule.weekday - first.weekday()) % 7)
+    while current <= last:
+        if current not in skip_dates:
+            start = datetime.combine(current, rule.start_time, tzinfo=tz)
+            yield SlotDefinition(
+                title=rule.title or DEFAULT_TITLE,
+                start_time=start,
+                end_time=datetime.combine(current, rule.end_time, tzinfo=tz),
+                capacity=rule.capacity,
+                reservation_start_time=start - rule.reservation_open_offset,
+            )
+        current += timedelta(weeks=1)
+
+
+def _active_rules(start_date, end_date=None):
+    """start_date〜end_date（end_date が None の場合は以降すべて）に適用期間がかかる有効なルール"""
+    rules = RecurrenceRule.objects.filter(is_active=True).filter(
+        Q(valid_until__isnull=True) | Q(valid_until__gte=start_date)
+    )
+    if end_date is not None:
+        rules = rules.filter(valid_from__lte=end_date)
+    return list(rules.prefetch_related("exceptions"))
+
+
+def materialize_occurrences(start_date, end_date, rules=None):
+    """
+    有効なルールについて、期間内でまだ作成されていない回の授業枠を作成する。
+    ルール変更前の時刻で予約済みの授業枠が残っている日は、その授業枠を同じ回とみなして作成しない。
+    同時実行時も (recurrence_rule, start_time) の一意制約で重複しない。
+    rules には取得済みの有効なルールを渡せる（期間外のルールは除く）。
+    作成した件数を返す。
+    """
+    if rules is None:
+        rules = _active_rules(start_date, end_date)
+    else:
+        rules = [
+            rule for rule in rules
+            if rule.valid_from <= end_date and (rule.valid_until is None or rule.valid_until >= start_date)
+        ]
+    if not rules:
+        return 0
+
+    tz = timezone.get_current_timezone()
+    existing = {
+        (rule_id, timezone.localtime(start_time, tz).date())
+        for rule_id, start_time in LessonSlot.objects.filter(
+            recurrence_rule__in=rules,
+            start_time__gte=datetime.combine(start_date, datetime.min.time(), tzinfo=tz),
+            start_time__lt=datetime.combine(end_date + timedelta(days=1), datetime.min.time(), tzinfo=tz),
+        ).values_list("recurrence_rule_id", "start_time")
+    }
+    new_slots = []
+    for rule in rules:
+        skip_dates = {exception.date for exception in rule.exceptions.all()}
+        for definition in iter_occurrences(rule, start_date, end_date, skip_dates, tz=tz):
+            if (rule.pk, definition.start_time.date()) not in existing:
+                new_slots.append(LessonSlot(recurrence_rule=rule, **definition._asdict()))
+    if new_slots:
+        # 同時に別のリクエストが作成した回は無視する
+        LessonSlot.objects.bulk_create(new_slots, ignore_conflicts=True)
+        bump_slot_dates([slot.start_time for slot in new_slots])
+        invalidate_snapshot()
+    return len(new_slots)
+
+
+def _nearest_occurrences(window, rules, tz):
+    """表示期間の前後で最も近いルールの回の開始日時（授業枠の作成の有無によらない）"""
+    today = timezone.localdate(window.now)
+    latest_date = timezone.localdate(window.latest_end) - timedelta(days=1)
+    starts = []
+    for rule in rules:
+        skip_dates = {exception.date for exception in rule.exceptions.all()}
+        following = iter_occurrences(rule, window.end_date, latest_date, skip_dates, tz=tz)
+        starts.extend(definition.start_time for definition in itertools.islice(following, 1))
+        preceding = [
+            definition.start_time
+            for definition in iter_occurrences(rule, today, window.start_date - timedelta(days=1), skip_dates, tz=tz)
+            if definition.start_time >= window.now
+        ]
+        starts.extend(preceding[-1:])
+    return starts
+
+
+def materialize_window(window):
+    """
+    カレンダーの表示期間 (CalendarWindow) の回を作成し、前後の期間で最も近い回の開始日時を返す。
+    授業枠が未作成の週・月にも前後の期間へのリンクを付けるため、戻り値は resolve_links に渡す。
+    """
+    tz = timezone.get_current_timezone()
+    rules = _active_rules(timezone.localdate(window.now))
+    materialize_occurrences(timezone.localdate(window.start), window.last_date, rules)
+    return _nearest_occurrences(window, rules, tz)
+
+
+def _unbooked_future_slots(rule, now=None):
+    return LessonSlot.objects.filter(
+        recurrence_rule=rule,
+        start_time__gte=now or timezone.now(),
+        reserved_count=0,
+        waitlist_count=0,
+    )
+
+
+def apply_rule_change(rule):
+    """
+    ルール変更を今後の授業枠に反映する（補欠の繰り上げを除き、回数によらず一定数のクエリ）。
+    予約・補欠のない授業枠は削除して次回表示時に新しいルールで作り直し、
+    予約済みの授業枠は日時を変えずに授業名と定員のみ更新する。
+    同じ日時に新しい授業名の授業枠がすでにある授業枠は、授業名を変えずに定員のみ更新し、
+    そのような授業枠のリストを返す。定員が増えた授業枠は補欠を繰り上げる。
+    """
+    now = timezone.now()
+    title = rule.title or DEFAULT_TITLE
+    _unbooked_future_slots(rule, now).delete()
+    booked = LessonSlot.objects.filter(recurrence_rule=rule, start_time__gte=now)
+    bump_slot_dates(booked.values_list("start_time", flat=True))
+
+    # 授業名を変えると一意制約（同じ日時・授業名）に違反する授業枠
+    conflicting = list(booked.exclude(title=title).filter(Exists(
+        LessonSlot.objects.filter(start_time=OuterRef("start_time"), end_time=OuterRef("end_time"), title=title)
+    )))
+    enlarged = list(booked.filter(capacity__lt=rule.capacity, waitlist_count__gt=0).values_list("pk", flat=True))
+    booked.exclude(pk__in=[slot.pk for slot in conflicting]).update(title=title, capacity=rule.capacity)
+    booked.filter(pk__in=[slot.pk for slot in conflicting]).update(capacity=rule.capacity)
+    for lesson_slot_id in enlarged:
+        promote_waitlist(lesson_slot_id)
+    invalidate_snapshot()
+    return conflicting
+
+
+def apply_exception(exception):
+    """休講日に作成済みの予約のない授業枠を削除する"""
+    tz = timezone.get_current_timezone()
+    day_start = datetime.combine(exception.date, datetime.min.time(), tzinfo=tz)
+    _unbooked_future_slots(exception.rule).filter(
+        start_time__gte=day_start,
+        start_time__lt=day_start + timedelta(days=1),
+    ).delete()
+
+
+def skip_occurrence(lesson):
+    """ルールから作成された授業枠を削除する際、同じ回が再作成されないよう休講日を登録する"""
+    if lesson.recurrence_rule_id:
+        RecurrenceException.objects.get_or_create(
+            rule_id=lesson.recurrence_rule_id,
+            date=timezone.localtime(lesson.start_time).date(),
+        )
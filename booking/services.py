@@ -0,0 +1,324 @@
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Subquery, Value, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.utils import timezone
+from .availability import refresh_counters
+from .calendar_cache import bump_slot_dates
+from .models import BookingEvent, LessonSlot, Reservation, Waitlist
+from .stats import record_booking_events
+
+# ロック競合（SQLite の "database is locked" や PostgreSQL のデッドロック検出）時の再試行設定
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.02
+
+
+class ReservationStatus(str, Enum):
+    """予約処理の結果種別"""
+    RESERVED = "reserved"      # 予約完了
+    WAITLISTED = "waitlisted"  # 満席のため補欠登録
+    DUPLICATE = "duplicate"    # すでに予約済み・補欠登録済み
+    NOT_OPEN = "not_open"      # 予約開始時刻前
+    FULL = "full"              # 満席（補欠登録しない呼び出しの場合）
+
+
+@dataclass(frozen=True)
+class ReservationOutcome:
+    """予約処理の結果"""
+    status: ReservationStatus
+    reservation: Optional[Reservation] = None
+    waitlist: Optional[Waitlist] = None
+
+
+def claim_seats(lesson_slot_id, count=1):
+    """
+    空席があれば条件付き UPDATE で座席を確保する。
+    「空席確認」と「予約数の加算」が1文で行われるため、同時実行でも定員を超えない。
+    確保できた場合は True を返す。
+    """
+    return LessonSlot.objects.filter(
+        pk=lesson_slot_id,
+        reserved_count__lte=F("capacity") - count,
+    ).update(reserved_count=F("reserved_count") + count) == 1
+
+
+def _is_registered(lesson_slot_id, student_id, include_waitlist=True):
+    """生徒がすでに予約または補欠登録済みかどうか（include_waitlist=False の場合は予約のみ）"""
+    return (
+        Reservation.objects.filter(lesson_slot_id=lesson_slot_id, student_id=student_id).exists()
+        or (include_waitlist
+            and Waitlist.objects.filter(lesson_slot_id=lesson_slot_id, student_id=student_id).exists())
+    )
+
+
+def _admit(lesson, student, allow_waitlist, from_waitlist):
+    """座席確保と予約/補欠の作成を1トランザクションで行う"""
+    with transaction.atomic():
+        # 授業枠をロックしてから登録済みかを確認し直す。同じ生徒の同時リクエスト
+        # （一方が最後の席を確保し、他方が満席と判定した場合など）で予約と補欠が二重に作成されないようにする
+        _lock_slot(lesson.pk)
+        if _is_registered(lesson.pk, student.pk, include_waitlist=not from_waitlist):
+            return ReservationOutcome(ReservationStatus.DUPLICATE)
+
+        if claim_seats(lesson.pk):
+            if from_waitlist:
+                Waitlist.objects.filter(lesson_slot=lesson, student=student).delete()
+            reservation = Reservation(lesson_slot=lesson, student=student)
+            # カウンタは claim_seats で加算済みのため、シグナルでの加算を抑止する
+            reservation._counter_applied = True
+            reservation.save()
+            return ReservationOutcome(ReservationStatus.RESERVED, reservation=reservation)
+
+        if not allow_waitlist:
+            return ReservationOutcome(ReservationStatus.FULL)
+
+        waitlist = Waitlist.objects.create(lesson_slot=lesson, student=student)
+        return ReservationOutcome(ReservationStatus.WAITLISTED, waitlist=waitlist)
+
+
+def reserve_seat(lesson, student, *, enforce_open=True, allow_waitlist=True, from_waitlist=False):
+    """
+    空席があれば予約し、満席なら補欠登録する（S-1, S-2）。
+
+    座席の確保は条件付き UPDATE で原子的に行い、ロック競合で失敗した場合は
+    指数バックオフで最大 MAX_RETRIES 回まで再試行する。
+    管理者による予約では enforce_open=False（予約開始時刻の制限なし）、
+    allow_waitlist=False（満席時は FULL を返す）、
+    from_waitlist=True（補欠登録済みの生徒は補欠から予約に切り替える）を指定する。
+    """
+    if enforce_open and timezone.now() < lesson.reservation_start_time:
+        return ReservationOutcome(ReservationStatus.NOT_OPEN)
+
+    if _is_registered(lesson.pk, student.pk, include_waitlist=not from_waitlist):
+        return ReservationOutcome(ReservationStatus.DUPLICATE)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            return _admit(lesson, student, allow_waitlist, from_waitlist)
+        except IntegrityError:
+            # 事前チェック後に同じ生徒の同時リクエストが先に登録した場合
+            return ReservationOutcome(ReservationStatus.DUPLICATE)
+        except OperationalError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
+
+
+def _registered_student_ids(lesson_slot_id, student_ids):
+    """生徒のうち、すでに予約または補欠登録済みの生徒の id（1クエリ）"""
+    reserved = Reservation.objects.filter(lesson_slot_id=lesson_slot_id, student_id__in=student_ids)
+    waitlisted = Waitlist.objects.filter(lesson_slot_id=lesson_slot_id, student_id__in=student_ids)
+    return set(
+        reserved.order_by().values_list("student_id", flat=True)
+        .union(waitlisted.order_by().values_list("student_id", flat=True))
+    )
+
+
+def _admit_group(lesson, students, all_or_nothing):
+    """
+    予約・補欠登録済みでない生徒について、座席確保と予約/補欠の作成を1トランザクションで行い、
+    {生徒 id: 結果} を返す（登録済みの生徒は含まない）
+    """
+    with transaction.atomic():
+        # 授業枠をロックしてから登録済みの生徒を確認する。同じ生徒を含む同時リクエストで
+        # 予約と補欠が二重に作成されないようにする
+        _lock_slot(lesson.pk)
+        registered = _registered_student_ids(lesson.pk, [student.pk for student in students])
+        students = [student for student in students if student.pk not in registered]
+        if not students:
+            return {}
+
+        if claim_seats(lesson.pk, len(students)):
+            seats = len(students)
+        elif all_or_nothing:
+            return {student.pk: ReservationOutcome(ReservationStatus.FULL) for student in students}
+        else:
+            # 全員分の空席がない場合は、残りの空席の分だけ確保する（授業枠はロック済み）
+            slot = LessonSlot.objects.filter(pk=lesson.pk).values("capacity", "reserved_count").first()
+            seats = max(0, min(len(students), slot["capacity"] - slot["reserved_count"]))
+            if seats:
+                claim_seats(lesson.pk, seats)
+
+        outcomes = {}
+        for student in students[:seats]:
+            reservation = Reservation(lesson_slot=lesson, student=student)
+            # カウンタは claim_seats で加算済みのため、シグナルでの加算を抑止する
+            reservation._counter_applied = True
+            reservation.save()
+            outcomes[student.pk] = ReservationOutcome(ReservationStatus.RESERVED, reservation=reservation)
+        for student in students[seats:]:
+            waitlist = Waitlist.objects.create(lesson_slot=lesson, student=student)
+            outcomes[student.pk] = ReservationOutcome(ReservationStatus.WAITLISTED, waitlist=waitlist)
+        return outcomes
+
+
+def reserve_group(lesson, students, *, all_or_nothing=False, enforce_open=True):
+    """
+    同じ家族の複数の生徒（兄弟）を1つの授業枠にまとめて予約し、生徒ごとの結果を
+    [(生徒, ReservationOutcome)] で入力の順に返す。
+
+    空席の確認と確保は全員分を1回の条件付き UPDATE で行い、予約・補欠の作成と合わせて1トランザクションで行う。
+    all_or_nothing=True の場合、全員分の空席がなければ誰も予約せず FULL を返す。
+    False の場合は空席の分だけ先頭の生徒から予約し、残りの生徒を補欠登録する。
+    すでに予約・補欠登録済みの生徒は DUPLICATE を返す。
+    """
+    students = list({student.pk: student for student in students}.values())
+    if enforce_open and timezone.now() < lesson.reservation_start_time:
+        return [(student, ReservationOutcome(ReservationStatus.NOT_OPEN)) for student in students]
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            admitted = _admit_group(lesson, students, all_or_nothing) if students else {}
+        except IntegrityError:
+            # ロック外で同じ生徒が登録された場合（一意制約違反）は、確認からやり直す
+            if attempt == MAX_RETRIES - 1:
+                raise
+            continue
+        except OperationalError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BACKOFF_SECONDS * (2 ** attempt))
+            continue
+        return [
+            (student, admitted.get(student.pk) or ReservationOutcome(ReservationStatus.DUPLICATE))
+            for student in students
+        ]
+
+
+# ---- 補欠の繰り上げ (S-2) ----------------------------------------------------------
+
+def count_subquery(model):
+    """授業枠ごとの予約/補欠の実件数を返すサブクエリ"""
+    counts = (
+        model.objects.filter(lesson_slot=OuterRef("pk"))
+        .order_by().values("lesson_slot").annotate(c=Count("pk")).values("c")
+    )
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+def _lock_slot(lesson_slot_id):
+    """
+    授業枠の行を書き込みロックする。
+    値を変えない UPDATE を最初に実行することで、PostgreSQL では行ロック、
+    SQLite ではデータベースの書き込みロックを取得する。
+    """
+    LessonSlot.objects.filter(pk=lesson_slot_id).update(reserved_count=F("reserved_count"))
+
+
+def _already_reserved():
+    """補欠の生徒が同じ授業枠をすでに予約済みかどうか（Waitlist のクエリセットの条件に使う）"""
+    return Exists(Reservation.objects.filter(
+        lesson_slot_id=OuterRef("lesson_slot_id"), student_id=OuterRef("student_id"),
+    ))
+
+
+def promote_waitlist(lesson_slot_id):
+    """
+    空席の数だけ補欠を登録順に予約へ繰り上げ、作成した予約のリストを返す。
+    授業枠の行をロックしてから空席数を読むため、同時にキャンセルが起きても二重に繰り上げない。
+    呼び出し側のトランザクション（座席の解放と同じトランザクション）内で実行される。
+    """
+    with transaction.atomic():
+        _lock_slot(lesson_slot_id)
+        slot = (
+            LessonSlot.objects.filter(pk=lesson_slot_id, start_time__gte=timezone.now())
+            .values("capacity", "reserved_count").first()
+        )
+        if slot is None:
+            return []
+        free = slot["capacity"] - slot["reserved_count"]
+        if free <= 0:
+            return []
+
+        # 予約済みの生徒の補欠（以前の二重登録）は繰り上げずに削除する
+        waitlist = Waitlist.objects.filter(lesson_slot_id=lesson_slot_id)
+        waitlist.filter(_already_reserved()).delete()
+        entries = list(waitlist.filter(~_already_reserved()).order_by("waitlisted_at", "pk")[:free])
+        if not entries:
+            return []
+
+        claim_seats(lesson_slot_id, len(entries))
+        Waitlist.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+        promoted = []
+        for entry in entries:
+            reservation = Reservation(lesson_slot_id=lesson_slot_id, student_id=entry.student_id)
+            reservation._counter_applied = True
+            reservation.save()
+            promoted.append(reservation)
+        return promoted
+
+
+def release_reservation(reservation):
+    """予約をキャンセルし、同じトランザクションで空いた席に補欠を繰り上げる"""
+    with transaction.atomic():
+        reservation.delete()
+        return promote_waitlist(reservation.lesson_slot_id)
+
+
+def remove_student(student):
+    """生徒を削除し（予約・補欠はカスケード削除）、空いた今後の授業枠に補欠を繰り上げる"""
+    with transaction.atomic():
+        lesson_slot_ids = list(
+            Reservation.objects.filter(student=student, lesson_slot__start_time__gte=timezone.now())
+            .values_list("lesson_slot_id", flat=True)
+        )
+        student.delete()
+        promoted = []
+        for lesson_slot_id in lesson_slot_ids:
+            promoted.extend(promote_waitlist(lesson_slot_id))
+        return promoted
+
+
+def promote_all_waitlists():
+    """
+    空席と補欠の両方がある今後の授業枠すべてについて、補欠をまとめて繰り上げる。
+    繰り上げ対象は ROW_NUMBER() で授業枠ごとの登録順を付けた1クエリで選び、
+    予約は一括作成、予約数カウンタは1文の UPDATE で更新する。
+    繰り上げた件数を返す。
+    """
+    with transaction.atomic():
+        candidates = LessonSlot.objects.filter(
+            start_time__gte=timezone.now(),
+            reserved_count__lt=F("capacity"),
+            waitlist_count__gt=0,
+        )
+        # 対象の授業枠をロックしてから順位付けする
+        if not candidates.update(reserved_count=F("reserved_count")):
+            return 0
+        slot_ids = list(candidates.values_list("pk", flat=True))
+        # 予約済みの生徒の補欠（以前の二重登録）は順位付けの前に削除する
+        Waitlist.objects.filter(_already_reserved(), lesson_slot_id__in=slot_ids).delete()
+
+        entries = list(
+            Waitlist.objects.filter(~_already_reserved(), lesson_slot_id__in=slot_ids)
+            .annotate(
+                position=Window(
+                    RowNumber(),
+                    partition_by=[F("lesson_slot_id")],
+                    order_by=[F("waitlisted_at").asc(), F("pk").asc()],
+                ),
+                free=F("lesson_slot__capacity") - F("lesson_slot__reserved_count"),
+            )
+            .filter(position__lte=F("free"))
+            .values("pk", "lesson_slot_id", "student_id")
+        )
+        if not entries:
+            return 0
+
+        Reservation.objects.bulk_create([
+            Reservation(lesson_slot_id=entry["lesson_slot_id"], student_id=entry["student_id"])
+            for entry in entries
+        ])
+        Waitlist.objects.filter(pk__in=[entry["pk"] for entry in entries]).delete()
+        # bulk_create はシグナルを送らないため、予約の履歴は明示的に記録する
+        record_booking_events(BookingEvent.KIND_RESERVED, [entry["lesson_slot_id"] for entry in entries])
+        promoted_ids = {entry["lesson_slot_id"] for entry in entries}
+        promoted_slots = LessonSlot.objects.filter(pk__in=promoted_ids)
+        promoted_slots.update(reserved_count=count_subquery(Reservation))
+        refresh_counters(promoted_ids)
+        bump_slot_dates(promoted_slots.values_list("start_time", flat=True))
+        return len(entries)
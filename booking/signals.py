@@ -0,0 +1,165 @@
+from django.contrib.auth.models import User
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .availability import invalidate_snapshot, mark_changed, refresh_counters
+from .calendar_cache import bump_slot_dates
+from .identity import invalidate_identity
+from .models import BookingEvent, Family, LessonSlot, Reservation, Waitlist, RecurrenceRule, RecurrenceException, Student
+from .recurrence import apply_exception, apply_rule_change
+from .stats import record_booking_events
+
+# モデルごとに更新する LessonSlot のカウンタ列
+COUNTER_FIELDS = {
+    Reservation: "reserved_count",
+    Waitlist: "waitlist_count",
+}
+
+
+def adjust_slot_counter(lesson_slot_id, field, delta):
+    """
+    授業枠のカウンタを F() 式で原子的に増減する。
+    減算時は 0 未満にならないよう条件付きで更新する。
+    """
+    queryset = LessonSlot.objects.filter(pk=lesson_slot_id)
+    if delta < 0:
+        queryset = queryset.filter(**{f"{field}__gte": -delta})
+    return queryset.update(**{field: F(field) + delta})
+
+
+def _is_lesson_slot_delete(origin):
+    """授業枠そのものの削除によるカスケードかどうか"""
+    model = getattr(origin, "model", None) or type(origin)
+    return model is LessonSlot
+
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_save, sender=Waitlist)
+def increment_slot_counter(sender, instance, created, **kwargs):
+    """予約/補欠の作成時にカウンタを加算"""
+    # 座席確保時にカウンタを加算済みの場合（booking.services.claim_seats）は何もしない
+    if created and not getattr(instance, "_counter_applied", False):
+        adjust_slot_counter(instance.lesson_slot_id, COUNTER_FIELDS[sender], 1)
+
+
+@receiver(post_delete, sender=Reservation)
+@receiver(post_delete, sender=Waitlist)
+def decrement_slot_counter(sender, instance, origin=None, **kwargs):
+    """予約/補欠の削除時（生徒削除などのカスケードを含む）にカウンタを減算"""
+    # 授業枠ごと削除される場合は更新対象が消えるため何もしない
+    if origin is not None and _is_lesson_slot_delete(origin):
+        return
+    adjust_slot_counter(instance.lesson_slot_id, COUNTER_FIELDS[sender], -1)
+
+
+
+def _slot_start_time(instance):
+    """予約/補欠の授業枠の開始日時（授業枠を取得済みなら追加のクエリは発行しない）"""
+    if type(instance).lesson_slot.is_cached(instance):
+        return instance.lesson_slot.start_time
+    return LessonSlot.objects.filter(pk=instance.lesson_slot_id).values_list("start_time", flat=True).first()
+
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_save, sender=Waitlist)
+@receiver(post_delete, sender=Reservation)
+@receiver(post_delete, sender=Waitlist)
+def refresh_calendar_caches(sender, instance, origin=None, **kwargs):
+    """予約/補欠の変更時に、空き状況スナップショットとその日付のカレンダー断片キャッシュを更新する"""
+    if origin is not None and _is_lesson_slot_delete(origin):
+        return
+    refresh_counters([instance.lesson_slot_id])
+    bump_slot_dates([_slot_start_time(instance)])
+
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_save, sender=Waitlist)
+@receiver(post_delete, sender=Reservation)
+@receiver(post_delete, sender=Waitlist)
+def record_booking_event(sender, instance, signal, created=False, origin=None, **kwargs):
+    """
+    予約・補欠登録・キャンセル・補欠の解除（生徒削除によるものを含む）を
+    ダッシュボードの推移と利用状況の分析（補欠の最大人数）用に記録
+    """
+    if signal is post_save:
+        if created:
+            kind = BookingEvent.KIND_RESERVED if sender is Reservation else BookingEvent.KIND_WAITLISTED
+            record_booking_events(kind, [instance.lesson_slot_id])
+    elif origin is None or not _is_lesson_slot_delete(origin):
+        kind = BookingEvent.KIND_CANCELLED if sender is Reservation else BookingEvent.KIND_DEQUEUED
+        record_booking_events(kind, [instance.lesson_slot_id])
+
+
+@receiver(pre_save, sender=LessonSlot)
+def remember_slot_start_time(sender, instance, **kwargs):
+    """日時を変更した場合に変更前の日付も無効にできるよう、保存前の開始日時を保持"""
+    if instance.pk:
+        instance._previous_start_time = (
+            LessonSlot.objects.filter(pk=instance.pk).values_list("start_time", flat=True).first()
+        )
+
+
+@receiver(post_save, sender=LessonSlot)
+@receiver(post_delete, sender=LessonSlot)
+def invalidate_slot_dates(sender, instance, signal, **kwargs):
+    """授業枠の作成・編集・削除時に、空き状況スナップショットとその日付のカレンダー断片キャッシュを無効にする"""
+    invalidate_snapshot()
+    if signal is post_save:
+        # 定員の変更をライブ更新で配信する
+        refresh_counters([instance.pk])
+    bump_slot_dates([instance.start_time, getattr(instance, "_previous_start_time", None)])
+
+
+
+@receiver(post_save, sender=Student)
+def invalidate_student_dates(sender, instance, created, **kwargs):
+    """生徒名の変更を管理者カレンダーの予約者一覧に反映するため、予約のある日付を無効にする"""
+    mark_changed()
+    if not created:
+        bump_slot_dates(
+            Reservation.objects.filter(student=instance).values_list("lesson_slot__start_time", flat=True)
+        )
+
+
+@receiver(post_delete, sender=Student)
+def student_deleted(sender, instance, **kwargs):
+    """空き状況 API の生徒一覧に反映するため、バージョンを進める"""
+    mark_changed()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_identity(sender, instance, **kwargs):
+    """ユーザーの変更（パスワード変更・無効化・最終ログイン日時など）をキャッシュに反映"""
+    invalidate_identity(instance.pk)
+
+
+@receiver(post_save, sender=Family)
+@receiver(post_delete, sender=Family)
+def invalidate_family_identity(sender, instance, **kwargs):
+    invalidate_identity(instance.user_id)
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def invalidate_student_identity(sender, instance, **kwargs):
+    """生徒の追加・編集・削除を保護者の生徒一覧のキャッシュに反映"""
+    if Student.family.is_cached(instance):
+        user_id = instance.family.user_id
+    else:
+        user_id = Family.objects.filter(pk=instance.family_id).values_list("user_id", flat=True).first()
+    invalidate_identity(user_id)
+
+
+@receiver(post_save, sender=RecurrenceRule)
+def propagate_rule_change(sender, instance, created, **kwargs):
+    """繰り返しルールの変更を作成済みの今後の授業枠に反映（授業名を変更できなかった授業枠は管理画面で表示する）"""
+    if not created:
+        instance._conflicting_slots = apply_rule_change(instance)
+
+
+@receiver(post_save, sender=RecurrenceException)
+def propagate_exception(sender, instance, created, **kwargs):
+    """休講日の登録時に作成済みの授業枠を取り除く"""
+    if created:
+        apply_exception(instance)
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from django.db import transaction
+from django.utils import timezone
+from .availability import invalidate_snapshot
+from .calendar_cache import bump_slot_dates
+from .models import LessonSlot
+
+DEFAULT_TITLE = "書道教室"
+BATCH_SIZE = 500
+
+
+class SlotDefinition(NamedTuple):
+    """作成予定の授業枠（DB に保存する前の値）"""
+    title: str
+    start_time: datetime
+    end_time: datetime
+    capacity: int
+    reservation_start_time: datetime
+
+    @property
+    def key(self):
+        """重複判定に使うキー（開始日時・終了日時・授業名が同じ授業枠は作成しない）"""
+        return (self.start_time, self.end_time, self.title)
+
+
+class SlotWriteResult(NamedTuple):
+    """一括作成の結果"""
+    total: int
+    created: int
+    skipped: int
+
+
+def parse_time_slots(text):
+    """「HH:MM-HH:MM」形式の行を (開始時刻, 終了時刻) のリストに変換（不正な行は無視）"""
+    time_pairs = []
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if line and '-' in line:
+            try:
+                start_str, end_str = line.split('-')
+                start_time = datetime.strptime(start_str.strip(), '%H:%M').time()
+                end_time = datetime.strptime(end_str.strip(), '%H:%M').time()
+                time_pairs.append((start_time, end_time))
+            except ValueError:
+                continue
+    return time_pairs
+
+
+def generate_slot_definitions(start_date, end_date, days_of_week, time_pairs, *,
+                              title, capacity, reservation_start_time, tz=None):
+    """
+    期間内の指定曜日・時間帯ごとに SlotDefinition を生成する。
+    DB にはアクセスしない。
+    """
+    tz = tz or timezone.get_current_timezone()
+    title = title or DEFAULT_TITLE
+    days_of_week = set(days_of_week)
+    current_date = start_date
+    while current_date <= end_date:
+        if current_date.weekday() in days_of_week:
+            for start_time, end_time in time_pairs:
+                yield SlotDefinition(
+                    title=title,
+                    start_time=datetime.combine(current_date, start_time, tzinfo=tz),
+                    end_time=datetime.combine(current_date, end_time, tzinfo=tz),
+                    capacity=capacity,
+                    reservation_start_time=reservation_start_time,
+                )
+        current_date += timedelta(days=1)
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _existing_keys(batch):
+    """バッチと同じ期間・授業名の既存授業枠のキーを1クエリで取得"""
+    rows = LessonSlot.objects.filter(
+        start_time__gte=min(d.start_time for d in batch),
+        start_time__lte=max(d.start_time for d in batch),
+        title__in={d.title for d in batch},
+    ).values_list('start_time', 'end_time', 'title')
+    return set(rows)
+
+
+def write_lesson_slots(definitions, *, dry_run=False, batch_size=BATCH_SIZE):
+    """
+    SlotDefinition を batch_size 件ずつ bulk_create で保存する。
+    既存の授業枠や入力内で重複するもの（開始日時・終了日時・授業名が同じ）はスキップする。
+    同時に実行された別の一括作成と重なった分は一意制約 (unique_slot_time_title) で作成しない
+    （この分は created に含まれる）。
+    全体を1トランザクションで行い、dry_run=True の場合は件数の集計だけを行う。
+    """
+    total = created = 0
+    seen = set()
+    with transaction.atomic():
+        for batch in _batched(definitions, batch_size):
+            total += len(batch)
+            existing = _existing_keys(batch)
+            new_slots = []
+            for definition in batch:
+                if definition.key in existing or definition.key in seen:
+                    continue
+                seen.add(definition.key)
+                new_slots.append(LessonSlot(**definition._asdict()))
+            if not dry_run:
+                # bulk_create はシグナルを送らないため、キャッシュの無効化は明示的に行う
+                LessonSlot.objects.bulk_create(new_slots, batch_size=batch_size, ignore_conflicts=True)
+                bump_slot_dates([slot.start_time for slot in new_slots])
+                invalidate_snapshot()
+            created += len(new_slots)
+    return SlotWriteResult(total=total, created=created, skipped=total - created)
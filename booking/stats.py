@@ -0,0 +1,162 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import BookingEvent, Family, LessonSlot
+
+# ダッシュボードの統計のキャッシュ秒数
+DASHBOARD_STATS_TIMEOUT = 60
+# 予約・キャンセル・補欠登録の推移を表示する日数（今日を含む過去の日数）
+HISTORY_DAYS = 28
+# 今後の授業枠の埋まり具合を表示する日数（今日から）
+FORECAST_DAYS = 14
+
+_STATS_KEY = "booking:dashboard:stats"
+
+
+class DailyActivity(NamedTuple):
+    """1日分の予約・キャンセル・補欠登録の件数"""
+    date: object
+    reserved: int
+    cancelled: int
+    waitlisted: int
+
+
+class DailyFill(NamedTuple):
+    """1日分の授業枠の定員と予約数"""
+    date: object
+    capacity: int
+    reserved: int
+
+    @property
+    def rate(self):
+        """予約率（%）。授業枠がない日は None"""
+        return round(self.reserved * 100 / self.capacity) if self.capacity else None
+
+
+class DashboardStats(NamedTuple):
+    total_lessons: int
+    upcoming_lessons: int
+    total_reservations: int
+    total_students: int
+    total_families: int
+    activity: list
+    fill: list
+    built_at: datetime
+
+    def _activity_sum(self, field, days, offset=0):
+        recent = self.activity[::-1][offset:offset + days]
+        return sum(getattr(day, field) for day in recent)
+
+    @property
+    def peak(self):
+        """推移のグラフの縦軸の最大値"""
+        return max([1] + [max(day.reserved, day.cancelled, day.waitlisted) for day in self.activity])
+
+    @property
+    def weekly(self):
+        """直近7日間とその前の7日間の件数 {種別: (直近, 前週)}"""
+        return {
+            field: (self._activity_sum(field, 7), self._activity_sum(field, 7, offset=7))
+            for field in ("reserved", "cancelled", "waitlisted")
+        }
+
+
+def record_booking_events(kind, lesson_slot_ids):
+    """予約・キャンセル・補欠登録を履歴に記録する（授業枠1件につき1行）"""
+    now = timezone.now()
+    BookingEvent.objects.bulk_create([
+        BookingEvent(kind=kind, lesson_slot_id=lesson_slot_id, created_at=now) for lesson_slot_id in lesson_slot_ids
+    ])
+
+
+def _local_midnight(day):
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.get_current_timezone())
+
+
+def _days(start, count):
+    return [start + timedelta(days=i) for i in range(count)]
+
+
+def _totals(now):
+    """
+    件数の合計。予約数は予約テーブルを数えずに授業枠のカウンタの合計から求めるため、
+    履歴が増えても授業枠・家族の件数に比例する時間で済む。
+    """
+    slots = LessonSlot.objects.aggregate(
+        total=Count("pk"),
+        upcoming=Count("pk", filter=Q(start_time__gte=now)),
+        reservations=Sum("reserved_count", default=0),
+    )
+    people = Family.objects.aggregate(families=Count("pk", distinct=True), students=Count("student"))
+    return slots, people
+
+
+def activity_counts(start, end):
+    """start 以上 end 未満の履歴の日別・種別ごとの件数（日時の範囲はインデックスで絞り込む1クエリ）"""
+    return (
+        BookingEvent.objects.filter(created_at__gte=start, created_at__lt=end)
+        .annotate(day=TruncDate("created_at", tzinfo=timezone.get_current_timezone()))
+        .values("day", "kind")
+        .annotate(count=Count("pk"))
+        .order_by()
+    )
+
+
+def _activity(today):
+    """過去 HISTORY_DAYS 日の日別・種別ごとの件数"""
+    days = _days(today - timedelta(days=HISTORY_DAYS - 1), HISTORY_DAYS)
+    counts = {
+        (row["day"], row["kind"]): row["count"]
+        for row in activity_counts(_local_midnight(days[0]), _local_midnight(today + timedelta(days=1)))
+    }
+    return [
+        DailyActivity(
+            date=day,
+            reserved=counts.get((day, BookingEvent.KIND_RESERVED), 0),
+            cancelled=counts.get((day, BookingEvent.KIND_CANCELLED), 0),
+            waitlisted=counts.get((day, BookingEvent.KIND_WAITLISTED), 0),
+        )
+        for day in days
+    ]
+
+
+def _fill(today):
+    """今日から FORECAST_DAYS 日の日別の定員と予約数（開始日時の範囲はインデックスで絞り込む1クエリ）"""
+    days = _days(today, FORECAST_DAYS)
+    totals = {
+        row["day"]: (row["capacity"], row["reserved"])
+        for row in LessonSlot.objects.filter(
+            start_time__gte=_local_midnight(today),
+            start_time__lt=_local_midnight(today + timedelta(days=FORECAST_DAYS)),
+        )
+        .annotate(day=TruncDate("start_time", tzinfo=timezone.get_current_timezone()))
+        .values("day")
+        .annotate(capacity=Sum("capacity"), reserved=Sum("reserved_count"))
+        .order_by()
+    }
+    return [DailyFill(day, *totals.get(day, (0, 0))) for day in days]
+
+
+def dashboard_stats():
+    """ダッシュボードの統計。DASHBOARD_STATS_TIMEOUT 秒の間はキャッシュを返す"""
+    stats = cache.get(_STATS_KEY)
+    if stats is None:
+        now = timezone.now()
+        today = timezone.localdate(now)
+        slots, people = _totals(now)
+        stats = DashboardStats(
+            total_lessons=slots["total"],
+            upcoming_lessons=slots["upcoming"],
+            total_reservations=slots["reservations"],
+            total_students=people["students"],
+            total_families=people["families"],
+            activity=_activity(today),
+            fill=_fill(today),
+            built_at=now,
+        )
+        cache.set(_STATS_KEY, stats, timeout=DASHBOARD_STATS_TIMEOUT)
+    return stats
@@ -0,0 +1,56 @@
+from datetime import date, datetime, timedelta
+
+from django.utils import timezone
+from .jobs import job
+from .onboarding import (
+    discard_upload, hash_plan, import_families as import_family_rows, load_upload, parse_family_csv, replace_upload,
+    skip_registered,
+)
+from .recurrence import materialize_occurrences
+from .services import promote_all_waitlists
+from .slot_generation import generate_slot_definitions, parse_time_slots, write_lesson_slots
+
+# バックグラウンドジョブとして実行する処理（引数は JSON で保存できる値のみ）
+
+
+@job("promote_waitlists")
+def promote_waitlists():
+    """空席のある授業枠の補欠をまとめて繰り上げる"""
+    promote_all_waitlists()
+
+
+@job("materialize_recurrences")
+def materialize_recurrences(weeks=8):
+    """繰り返しルールから今後 weeks 週分の授業枠を作成する"""
+    today = timezone.localdate()
+    materialize_occurrences(today, today + timedelta(weeks=weeks))
+
+
+@job("create_lesson_slots")
+def create_lesson_slots(start_date, end_date, days_of_week, time_slots, title, capacity, reservation_start_time):
+    """授業枠一括作成（件数が多い場合に admin_views.create_lesson_slots から登録される）"""
+    definitions = generate_slot_definitions(
+        date.fromisoformat(start_date),
+        date.fromisoformat(end_date),
+        days_of_week,
+        parse_time_slots(time_slots),
+        title=title,
+        capacity=capacity,
+        reservation_start_time=datetime.fromisoformat(reservation_start_time),
+    )
+    write_lesson_slots(definitions)
+
+
+@job("import_families", sensitive=True)
+def import_families(upload):
+    """保護者・生徒の CSV 一括登録（admin_views.import_families から、キャッシュに保存した CSV の参照を渡される）"""
+    data = load_upload(upload)
+    if data is None:
+        raise LookupError("取り込む CSV が見つかりません（保存期間を過ぎたか、取り込み済みです）。")
+    if isinstance(data, str):
+        # 平文のパスワードを含む CSV は最初の実行でハッシュ化済みの取り込み内容に置き換え、再試行ではそれを使う
+        data = hash_plan(parse_family_csv(data))
+        replace_upload(upload, data)
+    # 検証後に登録されたユーザー名はスキップするため、再試行しても二重には作成されない
+    import_family_rows(skip_registered(data), hashed=True)
+    discard_upload(upload)
@@ -2,6 +2,8 @@ from django import template
 from django.utils.safestring import mark_safe
 import json
 
+from booking.analytics import format_duration
+
 register = template.Library()
 
 @register.filter
@@ -31,3 +33,8 @@ def get_reservable_count(lessons):
 def to_json(value):
     """PythonオブジェクトをJSON文字列に変換する"""
     return mark_safe(json.dumps(value, default=str))
+
+@register.filter
+def duration_ja(value):
+    """timedelta を「2日3時間」「45分」のように表示する"""
+    return format_duration(value)
@@ -1,3 +1,1503 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import time as datetime_time, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from .analytics import occupancy_report
+from .availability import slot_availability
+from .calendar_cache import date_versions
+from .calendar_window import MAX_DAYS_AHEAD
+from .jobs import claim_jobs, enqueue, heartbeat, job, requeue_stale_jobs, run_job
+from .live import FEED_RETENTION, SlotChangeHub, record_slot_changes
+from .metrics import reset_metrics
+from .pagination import PAGE_SIZE
+from .profiling import load_profiles
+from .services import (
+    ReservationStatus, claim_seats, promote_all_waitlists, release_reservation, remove_student, reserve_group, reserve_seat,
+)
+from .models import (
+    BookingEvent, Family, Job, LessonSlot, RecurrenceException, RecurrenceRule, Reservation, SlotChange, Student, Waitlist,
+)
+from .onboarding import import_families, load_upload, parse_family_csv, stash_upload
+from .recurrence import materialize_occurrences
+from .slot_generation import SlotWriteResult, generate_slot_definitions, parse_time_slots, write_lesson_slots
+from .stats import activity_counts
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ReservationCalendarQueryBudgetTest(TestCase):
+    """予約カレンダーのクエリ数が授業枠・予約の件数に依存しないことを確認"""
+
+    # セッション, ユーザー, 家族, 生徒（以上はキャッシュがない場合のみ）, 生徒の予約(prefetch),
+    # 前後の期間リンク×2, 繰り返しルール, 空き状況スナップショットの作成, 断片キャッシュがない日付の授業枠
+    QUERY_BUDGET = 10
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        self.family = Family.objects.create(user=user)
+        self.students = [
+            Student.objects.create(family=self.family, name=f"生徒{i}") for i in range(3)
+        ]
+        self.client.force_login(user)
+
+    def _add_lessons(self, count):
+        # 既定の週表示に収まるよう、すべて今後5日以内に配置する
+        base = timezone.now() + timedelta(hours=1)
+        for i in range(count):
+            start = base + timedelta(days=i % 5, minutes=i)
+            lesson = LessonSlot.objects.create(
+                title=f"授業{i}",
+                start_time=start,
+                end_time=start + timedelta(hours=1),
+                capacity=5,
+                reservation_start_time=timezone.now() - timedelta(days=1),
+            )
+            for student in self.students:
+                Reservation.objects.create(lesson_slot=lesson, student=student)
+
+    def _count_queries(self):
+        # スナップショット・断片キャッシュがない状態（最もクエリが多い場合）で数える
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("reservation_calendar"))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self._add_lessons(1)
+        small = self._count_queries()
+
+        self._add_lessons(30)
+        large = self._count_queries()
+
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+
+    def test_warm_cache_skips_session_identity_snapshot_and_lesson_queries(self):
+        self._add_lessons(10)
+        cold = self._count_queries()
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse("reservation_calendar"))
+        self.assertEqual(len(ctx.captured_queries), cold - 6)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class IdentityCacheTest(TestCase):
+    """ログイン中の保護者の家族・生徒をキャッシュから取得し、生徒の変更で更新されることを確認"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        self.student = Student.objects.create(family=Family.objects.create(user=user), name="生徒")
+        self.client.force_login(user)
+
+    def test_student_pages_use_cached_identity_until_students_change(self):
+        self.client.get(reverse("view_students"))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("view_students"))
+        # 生徒ごとの予約数の集計のみで、セッション・ユーザー・家族・生徒は取得しない
+        self.assertEqual([q["sql"] for q in ctx.captured_queries if "booking_reservation" not in q["sql"]], [])
+        self.assertEqual([student.name for student in response.context["students"]], ["生徒"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("edit_student", args=[self.student.pk]), {"name": "改名"})
+            self.client.post(reverse("add_student"), {"name": "弟"})
+        response = self.client.get(reverse("view_students"))
+        self.assertEqual([student.name for student in response.context["students"]], ["改名", "弟"])
+
+        # 他の家族の生徒は編集できない
+        other = Student.objects.create(family=Family.objects.create(user=User.objects.create_user(username="other")), name="他")
+        response = self.client.get(reverse("edit_student", args=[other.pk]))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class AvailabilityApiConditionalGetTest(TestCase):
+    """空き状況 API が変更のないポーリングに 304 を返すことを確認"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        family = Family.objects.create(user=user)
+        self.student = Student.objects.create(family=family, name="生徒")
+        start = timezone.now() + timedelta(days=1)
+        self.lesson = LessonSlot.objects.create(
+            title="授業",
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=2,
+            reservation_start_time=timezone.now() - timedelta(days=1),
+        )
+        self.client.force_login(user)
+
+    def test_unchanged_poll_returns_304_without_booking_queries(self):
+        first = self.client.get(reverse("availability_api"))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()["slots"][0]["remaining"], 2)
+
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(reverse("availability_api"), HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        # セッション・ユーザー・家族はキャッシュから取得する
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_reservation_changes_etag(self):
+        first = self.client.get(reverse("availability_api"))
+        with self.captureOnCommitCallbacks(execute=True):
+            Reservation.objects.create(lesson_slot=self.lesson, student=self.student)
+
+        second = self.client.get(reverse("availability_api"), HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        slot = second.json()["slots"][0]
+        self.assertEqual(slot["remaining"], 1)
+        self.assertEqual(slot["reserved_student_ids"], [self.student.pk])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SlotEventsTest(TestCase):
+    """空き状況のライブ更新（Server-Sent Events）"""
+
+    def test_wsgi_request_gets_no_content(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        self.client.force_login(user)
+        response = self.client.get(reverse("slot_events"), {"slots": "1"})
+        self.assertEqual(response.status_code, 204)
+
+    async def test_hub_streams_latest_change_for_subscribed_slots(self):
+        hub = SlotChangeHub()
+        stream = hub.stream({1})
+        self.assertEqual(await anext(stream), "retry: 5000\n\n")
+
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        hub._dispatch([
+            SlotChange(pk=1, lesson_slot_id=1, capacity=3, reserved_count=1, waitlist_count=0),
+            SlotChange(pk=2, lesson_slot_id=2, capacity=3, reserved_count=1, waitlist_count=0),
+            SlotChange(pk=3, lesson_slot_id=1, capacity=3, reserved_count=2, waitlist_count=0),
+        ])
+        message = await pending
+        self.assertIn("id: 3\n", message)
+        self.assertIn('"remaining": 1', message)
+        await stream.aclose()
+        self.assertFalse(hub._subscribers)
+
+    def test_recording_changes_purges_expired_feed(self):
+        expired = SlotChange.objects.create(
+            lesson_slot_id=1, capacity=3, reserved_count=0, waitlist_count=0,
+            created_at=timezone.now() - FEED_RETENTION - timedelta(minutes=1),
+        )
+        with mock.patch("booking.live._last_purge", 0.0):
+            record_slot_changes([(1, 3, 1, 0)])
+            self.assertFalse(SlotChange.objects.filter(pk=expired.pk).exists())
+
+            # 削除は FEED_PURGE_INTERVAL に1回だけ行う
+            expired.save()
+            record_slot_changes([(1, 3, 2, 0)])
+            self.assertTrue(SlotChange.objects.filter(pk=expired.pk).exists())
+        self.assertEqual(SlotChange.objects.count(), 3)
+
+
+class HotQueryPlanTest(TestCase):
+    """よく使う検索が全件走査（シーケンシャルスキャン）にならないことを EXPLAIN で確認"""
+
+    SLOTS = 2000
+    STUDENTS = 400
+    RESERVATIONS_PER_STUDENT = 10
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = User.objects.bulk_create([User(username=f"plan{i}") for i in range(cls.STUDENTS)])
+        families = Family.objects.bulk_create([Family(user=user) for user in users])
+        cls.students = Student.objects.bulk_create([
+            Student(family=family, name=f"生徒{family.pk}") for family in families
+        ])
+        # 過去から未来まで 1 時間おきに配置し、補欠のいる授業枠は一部だけにする
+        cls.slots = LessonSlot.objects.bulk_create([
+            LessonSlot(
+                title=f"授業{i}",
+                start_time=now + timedelta(hours=i - cls.SLOTS // 2),
+                end_time=now + timedelta(hours=i - cls.SLOTS // 2 + 1),
+                capacity=20,
+                reservation_start_time=now - timedelta(days=30),
+                waitlist_count=1 if i % 100 == 0 else 0,
+            )
+            for i in range(cls.SLOTS)
+        ])
+        Reservation.objects.bulk_create([
+            Reservation(student=student, lesson_slot=cls.slots[(n * 37 + i * 7) % cls.SLOTS])
+            for n, student in enumerate(cls.students)
+            for i in range(cls.RESERVATIONS_PER_STUDENT)
+        ])
+        Waitlist.objects.bulk_create([
+            Waitlist(student=student, lesson_slot=cls.slots[n % 20 * 100])
+            for n, student in enumerate(cls.students)
+        ])
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+    def assertNoFullScan(self, queryset):
+        plan = queryset.explain()
+        tables = {model._meta.db_table for model in (LessonSlot, Reservation, Waitlist, Student, BookingEvent)}
+        for table in tables:
+            if connection.vendor == "postgresql":
+                full_scan = re.search(rf"Seq Scan on {table}\b", plan)
+            else:
+                # SQLite: "SCAN テーブル" のうちインデックスを使わないもの
+                full_scan = re.search(rf"\bSCAN {table}\b(?! USING (COVERING )?INDEX)", plan)
+            self.assertIsNone(full_scan, f"{table} が全件走査されています:\n{plan}")
+
+    def test_upcoming_slots_by_start_time(self):
+        now = timezone.now()
+        self.assertNoFullScan(
+            LessonSlot.objects.filter(start_time__gte=now, start_time__lt=now + timedelta(days=7)).order_by("start_time")
+        )
+
+    def test_waitlisted_upcoming_slots(self):
+        self.assertNoFullScan(
+            LessonSlot.objects.filter(waitlist_count__gt=0, start_time__gte=timezone.now()).values_list("pk", flat=True)
+        )
+
+    def test_recent_reservations(self):
+        self.assertNoFullScan(Reservation.objects.order_by("-reserved_at", "-id")[:50])
+
+    def test_waitlist_by_slot_in_order(self):
+        self.assertNoFullScan(Waitlist.objects.filter(lesson_slot=self.slots[0]).order_by("waitlisted_at"))
+
+    def test_daily_activity(self):
+        now = timezone.now()
+        self.assertNoFullScan(activity_counts(now - timedelta(days=28), now))
+
+    def test_family_reservations(self):
+        family_students = [student.pk for student in self.students[:3]]
+        self.assertNoFullScan(
+            Reservation.objects.filter(student_id__in=family_students)
+            .select_related("lesson_slot").order_by("lesson_slot__start_time")
+        )
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class AdminReservationListTest(TestCase):
+    """管理者の予約一覧のページングと絞り込み"""
+
+    def setUp(self):
+        cache.clear()
+        staff = User.objects.create_user(username="staff", password="pass", is_staff=True)
+        self.client.force_login(staff)
+        self.family = Family.objects.create(user=User.objects.create_user(username="parent"))
+        self.other = Family.objects.create(user=User.objects.create_user(username="other"))
+        self.lessons = []
+
+    def _add_reservations(self, count, family=None):
+        # 予約日時が同じ予約も並び順が安定するよう、一部は同じ日時にする
+        now = timezone.now()
+        lesson = LessonSlot.objects.create(
+            start_time=now + timedelta(days=len(self.lessons) + 1),
+            end_time=now + timedelta(days=len(self.lessons) + 1, hours=1),
+            capacity=count,
+            reservation_start_time=now - timedelta(days=1),
+        )
+        self.lessons.append(lesson)
+        students = Student.objects.bulk_create([
+            Student(family=family or self.family, name=f"生徒{i}") for i in range(count)
+        ])
+        Reservation.objects.bulk_create([
+            Reservation(lesson_slot=lesson, student=student, reserved_at=now - timedelta(minutes=i // 3))
+            for i, student in enumerate(students)
+        ])
+        return lesson
+
+    def _get(self, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("admin_reservation_list"), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self._add_reservations(10)
+        # ログイン中のユーザーをキャッシュに載せてから数える
+        self._get()
+        _, small = self._get()
+
+        self._add_reservations(200)
+        response, large = self._get()
+        _, next_page = self._get(after=response.context["page"].older)
+
+        self.assertEqual(small, large)
+        self.assertEqual(large, next_page)
+
+    def test_pages_cover_all_reservations_once(self):
+        self._add_reservations(PAGE_SIZE * 2 + 7)
+        seen = []
+        response, _ = self._get()
+        while True:
+            seen.extend(reservation.pk for reservation in response.context["reservations"])
+            older = response.context["page"].older
+            if older is None:
+                break
+            response, _ = self._get(after=older)
+        self.assertEqual(sorted(seen), sorted(Reservation.objects.values_list("pk", flat=True)))
+
+        # 戻るリンクで1つ前のページと同じ内容になる
+        first, _ = self._get()
+        second, _ = self._get(after=first.context["page"].older)
+        back, _ = self._get(before=second.context["page"].newer)
+        self.assertEqual(
+            [r.pk for r in back.context["reservations"]], [r.pk for r in first.context["reservations"]]
+        )
+        self.assertIsNone(back.context["page"].newer)
+
+    def test_filters(self):
+        lesson = self._add_reservations(3)
+        self._add_reservations(2, family=self.other)
+
+        response, _ = self._get(lesson=lesson.pk)
+        self.assertEqual(len(response.context["reservations"]), 3)
+        response, _ = self._get(family=self.other.pk)
+        self.assertEqual(len(response.context["reservations"]), 2)
+        day = timezone.localdate(self.lessons[1].start_time)
+        response, _ = self._get(date_from=day.isoformat(), date_to=day.isoformat())
+        self.assertEqual(len(response.context["reservations"]), 2)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CsvExportTest(TestCase):
+    """CSV 出力"""
+
+    def setUp(self):
+        cache.clear()
+        staff = User.objects.create_user(username="staff", password="pass", is_staff=True)
+        self.client.force_login(staff)
+        family = Family.objects.create(user=User.objects.create_user(username="保護者"), phone_number="090")
+        self.student = Student.objects.create(family=family, name="=山田花子")
+        now = timezone.now()
+        self.lessons = [
+            LessonSlot.objects.create(
+                title="硬筆",
+                start_time=now + timedelta(days=days),
+                end_time=now + timedelta(days=days, hours=1),
+                capacity=1,
+                reservation_start_time=now - timedelta(days=1),
+            )
+            for days in (1, 10)
+        ]
+        for lesson in self.lessons:
+            Reservation.objects.create(lesson_slot=lesson, student=self.student)
+
+    def _download(self, kind, **params):
+        response = self.client.get(reverse("admin_export_csv", args=[kind]), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    def test_reservations_are_streamed_with_bom_and_filtered(self):
+        content = self._download("reservations")
+        self.assertTrue(content.startswith("\ufeff予約ID,"))
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 3)
+        # 数式として解釈される先頭文字はエスケープする
+        self.assertIn(",'=山田花子,保護者,090", lines[1])
+
+        day = timezone.localdate(self.lessons[0].start_time)
+        content = self._download("rosters", date_from=day.isoformat(), date_to=day.isoformat())
+        self.assertEqual(len(content.splitlines()), 2)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class FamilyImportTest(TestCase):
+    """保護者・生徒の CSV 一括登録"""
+
+    CSV = (
+        "ユーザー名,パスワード,電話番号,生徒名\n"
+        "suzuki,Kaisho-2024!,0901111,鈴木一郎\n"
+        "suzuki,,,鈴木花子\n"
+        "suzuki,,,鈴木花子\n"
+        "tanaka,Gyosho-2024!,,田中次郎\n"
+        "existing,Sosho-2024!,,佐藤三郎\n"
+    )
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user(username="existing")
+
+    def test_import_creates_families_and_reports_duplicates(self):
+        plan = parse_family_csv(self.CSV)
+        self.assertEqual(plan.errors, [])
+        self.assertEqual(len(plan.duplicates), 2)
+        self.assertEqual(plan.student_count, 3)
+
+        result = import_families(plan, workers=1)
+        self.assertEqual((result.families, result.students), (2, 3))
+        suzuki = Family.objects.get(user__username="suzuki")
+        self.assertEqual(suzuki.phone_number, "0901111")
+        self.assertTrue(suzuki.user.check_password("Kaisho-2024!"))
+        self.assertEqual(sorted(suzuki.student_set.values_list("name", flat=True)), ["鈴木一郎", "鈴木花子"])
+
+        errors = parse_family_csv("ユーザー名,パスワード,電話番号,生徒名\nbad name,x,,生徒\nnew,,,生徒\n").errors
+        self.assertEqual(len(errors), 2)
+
+    def test_large_upload_is_imported_by_job_without_keeping_passwords(self):
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        self.client.force_login(staff)
+        rows = "".join(f"family{i},Reisho-{i}-2024!,,生徒{i}\n" for i in range(12))
+        upload = SimpleUploadedFile("families.csv", ("ユーザー名,パスワード,電話番号,生徒名\n" + rows).encode("cp932"))
+
+        response = self.client.post(reverse("admin_import_families"), {"file": upload})
+        self.assertRedirects(response, reverse("admin_student_management"))
+        self.assertFalse(Family.objects.filter(user__username__startswith="family").exists())
+        # 実行待ちのジョブの引数にもパスワードを保存しない
+        self.assertNotIn("Reisho", json.dumps(Job.objects.get(name="import_families").payload))
+
+        for job_obj in claim_jobs("test", 10):
+            self.assertTrue(run_job(job_obj))
+        self.assertEqual(Student.objects.filter(family__user__username__startswith="family").count(), 12)
+        self.assertEqual(Job.objects.get(name="import_families").payload, {})
+
+    def test_job_replaces_csv_with_hashed_passwords_before_importing(self):
+        rows = "".join(f"family{i},Reisho-{i}-2024!,,生徒{i}\n" for i in range(12))
+        token = stash_upload("ユーザー名,パスワード,電話番号,生徒名\n" + rows)
+        job_obj = enqueue("import_families", {"upload": token})
+        # 1回目は取り込み中に失敗させる。再試行までキャッシュに平文のパスワードを残さない
+        with mock.patch("booking.tasks.import_family_rows", side_effect=OperationalError):
+            self.assertFalse(run_job(claim_jobs("test", 1)[0]))
+        plan = load_upload(token)
+        self.assertNotIn("Reisho", "".join(family.password for family in plan.families))
+
+        # 再試行までに登録されたユーザー名はスキップする
+        User.objects.create_user(username="family0")
+        Job.objects.filter(pk=job_obj.pk).update(run_at=timezone.now())
+        self.assertTrue(run_job(claim_jobs("test", 1)[0]))
+        self.assertEqual(Family.objects.filter(user__username__startswith="family").count(), 11)
+        self.assertTrue(User.objects.get(username="family1").check_password("Reisho-1-2024!"))
+        self.assertIsNone(load_upload(token))
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class DashboardStatsTest(TestCase):
+    """管理者ダッシュボードの統計と推移"""
+
+    def setUp(self):
+        cache.clear()
+        staff = User.objects.create_user(username="staff", password="pass", is_staff=True)
+        self.client.force_login(staff)
+        family = Family.objects.create(user=User.objects.create_user(username="parent"))
+        self.students = [Student.objects.create(family=family, name=f"生徒{i}") for i in range(3)]
+        start = timezone.now() + timedelta(hours=1)
+        self.lesson = LessonSlot.objects.create(
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=2,
+            reservation_start_time=timezone.now() - timedelta(days=1),
+        )
+
+    def test_totals_and_trends_are_cached(self):
+        for student in self.students[:2]:
+            Reservation.objects.create(lesson_slot=self.lesson, student=student)
+        Waitlist.objects.create(lesson_slot=self.lesson, student=self.students[2])
+        Reservation.objects.filter(student=self.students[0]).delete()
+        # 履歴の集計が過去の日付にも分かれることを確認する
+        BookingEvent.objects.create(kind=BookingEvent.KIND_RESERVED, lesson_slot_id=self.lesson.pk,
+                                    created_at=timezone.now() - timedelta(days=8))
+
+        stats = self.client.get(reverse("admin_dashboard")).context["stats"]
+        self.assertEqual((stats.total_lessons, stats.total_reservations, stats.total_students, stats.total_families),
+                         (1, 1, 3, 1))
+        self.assertEqual(stats.activity[-1][1:], (2, 1, 1))
+        self.assertEqual(stats.weekly["reserved"], (2, 1))
+        today_fill = stats.fill[0] if stats.fill[0].capacity else stats.fill[1]
+        self.assertEqual(today_fill.rate, 50)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse("admin_dashboard"))
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+
+class OccupancyReportTest(TestCase):
+    """曜日・開始時刻ごとの利用状況の集計"""
+
+    def _lesson(self, start, capacity, reserved, waitlist, events):
+        lesson = LessonSlot.objects.create(
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=capacity,
+            reservation_start_time=start - timedelta(days=7),
+        )
+        LessonSlot.objects.filter(pk=lesson.pk).update(reserved_count=reserved, waitlist_count=waitlist)
+        BookingEvent.objects.filter(lesson_slot_id=lesson.pk).delete()
+        BookingEvent.objects.bulk_create([
+            BookingEvent(kind=kind, lesson_slot_id=lesson.pk, created_at=lesson.reservation_start_time + timedelta(hours=hours))
+            for kind, hours in events
+        ])
+        return lesson
+
+    def test_fill_rate_sellout_and_waitlist_in_one_query(self):
+        tz = timezone.get_current_timezone()
+        monday = timezone.datetime(2026, 4, 6, 16, 0, tzinfo=tz)
+        reserved, cancelled = BookingEvent.KIND_RESERVED, BookingEvent.KIND_CANCELLED
+        waitlisted, dequeued = BookingEvent.KIND_WAITLISTED, BookingEvent.KIND_DEQUEUED
+        # 予約→予約で2時間後に満席、キャンセル後に再び満席。補欠は最大3人で、現在は繰り上げ・取り消しで0人
+        self._lesson(monday, 2, 2, 0, [
+            (reserved, 1), (reserved, 2), (waitlisted, 2), (waitlisted, 2), (cancelled, 3), (dequeued, 3),
+            (reserved, 5), (waitlisted, 5), (waitlisted, 6), (dequeued, 7), (dequeued, 8), (waitlisted, 9), (dequeued, 10),
+        ])
+        # 予約→キャンセル→予約→予約で6時間後に満席。補欠の履歴がない場合は現在の人数（1人）
+        self._lesson(monday + timedelta(days=7), 2, 2, 1, [(reserved, 1), (cancelled, 2), (reserved, 4), (reserved, 6)])
+        # 満席にならない
+        self._lesson(monday + timedelta(days=14), 2, 1, 0, [(reserved, 1)])
+        # 火曜日の別の時間帯
+        self._lesson(monday + timedelta(days=1, hours=2), 4, 1, 0, [(reserved, 3)])
+
+        with CaptureQueriesContext(connection) as ctx:
+            report = occupancy_report(monday.date(), (monday + timedelta(days=14)).date())
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        monday_cell, tuesday_cell = report.cells
+        self.assertEqual((monday_cell.weekday, monday_cell.start_time.hour), (1, 16))
+        self.assertEqual((monday_cell.slots, monday_cell.fill_rate, monday_cell.sold_out), (3, 83, 2))
+        self.assertEqual(monday_cell.time_to_sellout, timedelta(hours=4))
+        self.assertEqual((monday_cell.waitlist_avg, monday_cell.waitlist_max), (1.3, 3))
+        self.assertEqual((tuesday_cell.weekday, tuesday_cell.fill_rate, tuesday_cell.time_to_sellout), (2, 25, None))
+        self.assertEqual([start_time.hour for start_time, _ in report.rows], [16, 18])
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MetricsTest(TestCase):
+    """URL 名ごとのレスポンス時間・SQL の件数などの集計と、メトリクスの取得"""
+
+    def setUp(self):
+        cache.clear()
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        settings_override = override_settings(METRICS_DIR=metrics_dir.name, METRICS_TOKEN="secret")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_metrics()
+
+    def _value(self, text, line_prefix):
+        return float(next(line for line in text.splitlines() if line.startswith(line_prefix)).split()[-1])
+
+    def test_records_queries_and_size_per_view(self):
+        user = User.objects.create_user(username="parent")
+        Student.objects.create(family=Family.objects.create(user=user), name="生徒")
+        self.client.force_login(user)
+        # 非同期ビュー（DB 処理は sync_to_async のスレッドで実行される）の SQL も数える
+        with CaptureQueriesContext(connection) as ctx:
+            calendar = self.client.get(reverse("reservation_calendar"))
+        self.client.get(reverse("reservation_calendar"))
+
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        self.client.force_login(staff)
+        text = self.client.get(reverse("admin_metrics")).content.decode()
+        view = 'view="reservation_calendar"'
+        self.assertEqual(self._value(text, f"booking_request_duration_seconds_count{{{view}}}"), 2)
+        self.assertEqual(self._value(text, f'booking_request_duration_seconds_bucket{{{view},le="+Inf"}}'), 2)
+        self.assertGreaterEqual(self._value(text, f"booking_request_queries_sum{{{view}}}"), len(ctx.captured_queries) + 1)
+        self.assertGreater(self._value(text, f"booking_request_sql_seconds_total{{{view}}}"), 0)
+        self.assertGreaterEqual(self._value(text, f"booking_response_bytes_total{{{view}}}"), len(calendar.content))
+
+    def test_requires_staff_or_token(self):
+        self.assertEqual(self.client.get(reverse("admin_metrics")).status_code, 403)
+        response = self.client.get(reverse("admin_metrics"), headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE booking_request_duration_seconds histogram", response.content.decode())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ProfilingTest(TestCase):
+    """X-Profile ヘッダーを付けた管理者のリクエストのプロファイル"""
+
+    def setUp(self):
+        cache.clear()
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        settings_override = override_settings(PROFILE_DIR=profile_dir.name, PROFILE_SAMPLE_RATE=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.profile_dir = profile_dir.name
+
+    def test_staff_header_profiles_request_with_sql(self):
+        self.client.force_login(User.objects.create_user(username="parent"))
+        self.client.get(reverse("view_students"), headers={"X-Profile": "1"})
+        self.assertEqual(load_profiles(), [])
+
+        self.client.force_login(User.objects.create_user(username="staff", is_staff=True))
+        self.client.get(reverse("admin_lesson_list"))
+        self.client.get(reverse("admin_lesson_list"), headers={"X-Profile": "1"})
+        [info] = load_profiles()
+        self.assertEqual((info.view, info.status), ("admin_lesson_list", 200))
+        self.assertGreater(info.queries, 0)
+        with open(f"{self.profile_dir}/{info.name}.txt", encoding="utf-8") as f:
+            summary = f.read()
+        self.assertIn("SELECT", summary)
+        self.assertIn("admin_views.py", summary)
+
+        out = io.StringIO()
+        call_command("profiles", "admin_lesson_list", stdout=out)
+        self.assertIn(f"{info.name}.txt", out.getvalue())
+
+        # 上限を超えると古いプロファイルから削除する
+        with override_settings(PROFILE_MAX_BYTES=1):
+            self.client.get(reverse("admin_lesson_list"), headers={"X-Profile": "1"})
+        self.assertEqual(load_profiles(), [])
+
+    def test_async_view_under_wsgi_records_sql_without_functions(self):
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        Student.objects.create(family=Family.objects.create(user=staff), name="生徒")
+        self.client.force_login(staff)
+        self.client.get(reverse("admin_lesson_list"), headers={"X-Profile": "1"})
+        self.client.get(reverse("reservation_calendar"), headers={"X-Profile": "1"})
+        sync_info, async_info = load_profiles()
+        self.assertTrue(sync_info.functions)
+        self.assertTrue(os.path.exists(f"{self.profile_dir}/{sync_info.name}.prof"))
+
+        self.assertEqual((async_info.view, async_info.functions), ("reservation_calendar", False))
+        self.assertGreater(async_info.queries, 0)
+        self.assertFalse(os.path.exists(f"{self.profile_dir}/{async_info.name}.prof"))
+        with open(f"{self.profile_dir}/{async_info.name}.txt", encoding="utf-8") as f:
+            summary = f.read()
+        self.assertIn("SELECT", summary)
+        self.assertIn("関数ごとの時間は計測できません", summary)
+
+        out = io.StringIO()
+        call_command("profiles", "reservation_calendar", stdout=out)
+        self.assertIn(f"{async_info.name}.txt", out.getvalue())
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class GroupReservationTest(TestCase):
+    """兄弟をまとめて1つの授業枠に予約する"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="parent")
+        family = Family.objects.create(user=self.user)
+        self.siblings = [Student.objects.create(family=family, name=name) for name in ("太郎", "花子", "次郎")]
+        start = timezone.now() + timedelta(days=1)
+        self.lesson = LessonSlot.objects.create(
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=3,
+            reservation_start_time=timezone.now() - timedelta(hours=1),
+        )
+        other = Family.objects.create(user=User.objects.create_user(username="other"))
+        Reservation.objects.create(lesson_slot=self.lesson, student=Student.objects.create(family=other, name="他"))
+
+    def _statuses(self, results):
+        return [(student.name, outcome.status) for student, outcome in results]
+
+    def test_all_or_nothing_then_best_effort_with_waitlist(self):
+        results = reserve_group(self.lesson, self.siblings, all_or_nothing=True)
+        self.assertEqual({outcome.status for _, outcome in results}, {ReservationStatus.FULL})
+        self.assertEqual(Reservation.objects.filter(student__in=self.siblings).count(), 0)
+
+        results = reserve_group(self.lesson, self.siblings)
+        self.assertEqual(self._statuses(results), [
+            ("太郎", ReservationStatus.RESERVED), ("花子", ReservationStatus.RESERVED), ("次郎", ReservationStatus.WAITLISTED),
+        ])
+        self.lesson.refresh_from_db()
+        self.assertEqual((self.lesson.reserved_count, self.lesson.waitlist_count), (3, 1))
+        self.assertEqual(BookingEvent.objects.filter(lesson_slot_id=self.lesson.pk, kind=BookingEvent.KIND_RESERVED).count(), 3)
+
+        results = reserve_group(self.lesson, self.siblings)
+        self.assertEqual({outcome.status for _, outcome in results}, {ReservationStatus.DUPLICATE})
+
+    def test_registration_is_checked_under_slot_lock(self):
+        def concurrent_reservation(lesson_slot_id):
+            # ロック待ちの間に、同じ生徒の別リクエストが先に予約した場合を再現する
+            Reservation.objects.create(lesson_slot=self.lesson, student=self.siblings[0])
+
+        with mock.patch("booking.services._lock_slot", side_effect=concurrent_reservation):
+            results = reserve_group(self.lesson, self.siblings[:2])
+        self.assertEqual(self._statuses(results), [
+            ("太郎", ReservationStatus.DUPLICATE), ("花子", ReservationStatus.RESERVED),
+        ])
+        self.assertFalse(Waitlist.objects.filter(lesson_slot=self.lesson).exists())
+        self.lesson.refresh_from_db()
+        self.assertEqual((self.lesson.reserved_count, self.lesson.waitlist_count), (3, 0))
+
+    def test_view_returns_per_student_results(self):
+        self.client.force_login(self.user)
+        url = reverse("reserve_lesson", args=[self.lesson.pk])
+        response = self.client.post(
+            url, {"student_id": [self.siblings[0].pk, self.siblings[1].pk], "mode": "all"},
+            headers={"Accept": "application/json"},
+        )
+        self.assertEqual(response.json()["results"], [
+            {"student_id": self.siblings[0].pk, "status": "reserved"},
+            {"student_id": self.siblings[1].pk, "status": "reserved"},
+        ])
+
+        response = self.client.post(url, {"student_id": [self.siblings[1].pk, self.siblings[2].pk]}, follow=True)
+        self.assertEqual([str(message) for message in response.context["messages"]], [
+            "次郎を補欠登録しました。", "花子はすでに予約済みまたは補欠登録済みです。",
+        ])
+
+        other = Student.objects.exclude(family__user=self.user).first()
+        self.assertEqual(self.client.post(url, {"student_id": other.pk}).status_code, 404)
+
+
+@job("test_always_fails", sensitive=True)
+def _always_fails(secret):
+    raise RuntimeError("失敗")
+
+
+class JobQueueTest(TestCase):
+    """バックグラウンドジョブの取り出し・再試行・失敗・異常終了したワーカーのジョブの再実行"""
+
+    def test_claim_is_exclusive_and_skips_future_jobs(self):
+        first = enqueue("promote_waitlists")
+        second = enqueue("promote_waitlists")
+        enqueue("promote_waitlists", run_at=timezone.now() + timedelta(hours=1))
+
+        claimed = claim_jobs("worker-a", 10)
+        self.assertEqual([job_obj.pk for job_obj in claimed], [first.pk, second.pk])
+        self.assertEqual({(job_obj.status, job_obj.locked_by, job_obj.attempts) for job_obj in claimed},
+                         {(Job.STATUS_RUNNING, "worker-a", 1)})
+        self.assertEqual(claim_jobs("worker-b", 10), [])
+
+    def test_failures_back_off_then_fail_and_clear_payload(self):
+        enqueue("test_always_fails", {"secret": "x"}, max_attempts=2)
+        [job_obj] = claim_jobs("worker", 10)
+        with self.assertLogs("booking.jobs", level="ERROR"):
+            self.assertFalse(run_job(job_obj))
+        job_obj.refresh_from_db()
+        self.assertEqual(job_obj.status, Job.STATUS_PENDING)
+        self.assertGreater(job_obj.run_at, timezone.now() + timedelta(seconds=5))
+        self.assertIn("RuntimeError", job_obj.last_error)
+        self.assertEqual(claim_jobs("worker", 10), [])
+
+        Job.objects.filter(pk=job_obj.pk).update(run_at=timezone.now())
+        [job_obj] = claim_jobs("worker", 10)
+        with self.assertLogs("booking.jobs", level="ERROR"):
+            self.assertFalse(run_job(job_obj))
+        job_obj.refresh_from_db()
+        self.assertEqual((job_obj.status, job_obj.attempts, job_obj.payload), (Job.STATUS_FAILED, 2, {}))
+        self.assertIsNotNone(job_obj.finished_at)
+
+    def test_stale_jobs_are_requeued_until_max_attempts(self):
+        for _ in range(3):
+            enqueue("test_always_fails", {"secret": "x"}, max_attempts=2)
+        alive, crashed, exhausted = claim_jobs("worker", 10)
+        Job.objects.filter(pk=exhausted.pk).update(attempts=2)
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        # 実行中のジョブはハートビートで locked_at が更新されるため再実行されない
+        heartbeat("worker", [alive.pk])
+
+        self.assertEqual(requeue_stale_jobs(), 1)
+        statuses = dict(Job.objects.values_list("pk", "status"))
+        self.assertEqual(statuses, {
+            alive.pk: Job.STATUS_RUNNING, crashed.pk: Job.STATUS_PENDING, exhausted.pk: Job.STATUS_FAILED,
+        })
+        self.assertEqual(Job.objects.get(pk=exhausted.pk).payload, {})
+
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+class CounterAssertions:
+    """授業枠の予約数・補欠数カウンタのテスト用の準備と確認"""
+
+    def make_lesson(self, capacity, opens_in=timedelta(hours=-1)):
+        start = timezone.now() + timedelta(days=1)
+        return LessonSlot.objects.create(
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=capacity,
+            reservation_start_time=timezone.now() + opens_in,
+        )
+
+    def make_students(self, count):
+        family = Family.objects.create(user=User.objects.create_user(username=f"parent{Family.objects.count()}"))
+        return [Student.objects.create(family=family, name=f"生徒{i}") for i in range(count)]
+
+    def assertCounters(self, lesson, reserved, waitlist):
+        lesson.refresh_from_db()
+        self.assertEqual((lesson.reserved_count, lesson.waitlist_count), (reserved, waitlist))
+        self.assertEqual(
+            (Reservation.objects.filter(lesson_slot=lesson).count(), Waitlist.objects.filter(lesson_slot=lesson).count()),
+            (reserved, waitlist),
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SlotCounterTest(CounterAssertions, TestCase):
+    """予約・補欠の作成・削除に合わせた授業枠のカウンタの更新と、ずれの修正"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counters_follow_creates_deletes_and_cascades(self):
+        lesson = self.make_lesson(3)
+        first, second, third = self.make_students(3)
+        reservation = Reservation.objects.create(lesson_slot=lesson, student=first)
+        Reservation.objects.create(lesson_slot=lesson, student=second)
+        Waitlist.objects.create(lesson_slot=lesson, student=third)
+        self.assertCounters(lesson, 2, 1)
+
+        reservation.delete()
+        self.assertCounters(lesson, 1, 1)
+        # 生徒の削除による予約・補欠のカスケード削除
+        second.delete()
+        third.delete()
+        self.assertCounters(lesson, 0, 0)
+
+        # claim_seats で加算済みの予約はシグナルで二重に加算しない
+        self.assertTrue(claim_seats(lesson.pk))
+        reservation = Reservation(lesson_slot=lesson, student=first)
+        reservation._counter_applied = True
+        reservation.save()
+        self.assertCounters(lesson, 1, 0)
+
+        # 授業枠ごとの削除でもエラーにならない
+        lesson.delete()
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_reconcile_command_repairs_drift(self):
+        lesson = self.make_lesson(3)
+        student, = self.make_students(1)
+        Reservation.objects.create(lesson_slot=lesson, student=student)
+        LessonSlot.objects.filter(pk=lesson.pk).update(reserved_count=3, waitlist_count=2)
+
+        out = io.StringIO()
+        call_command("reconcile_slot_counters", "--dry-run", stdout=out)
+        self.assertIn("予約数 3 -> 1", out.getvalue())
+        lesson.refresh_from_db()
+        self.assertEqual(lesson.reserved_count, 3)
+
+        call_command("reconcile_slot_counters", stdout=io.StringIO())
+        self.assertCounters(lesson, 1, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReserveSeatTest(CounterAssertions, TestCase):
+    """予約サービスの結果種別と、満席の授業枠を超過予約しないこと"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_each_outcome(self):
+        lesson = self.make_lesson(1)
+        first, second, third = self.make_students(3)
+        self.assertEqual(reserve_seat(lesson, first).status, ReservationStatus.RESERVED)
+        self.assertEqual(reserve_seat(lesson, first).status, ReservationStatus.DUPLICATE)
+        self.assertEqual(reserve_seat(lesson, second).status, ReservationStatus.WAITLISTED)
+        self.assertEqual(reserve_seat(lesson, second).status, ReservationStatus.DUPLICATE)
+        self.assertEqual(
+            reserve_seat(lesson, third, enforce_open=False, allow_waitlist=False).status, ReservationStatus.FULL
+        )
+        self.assertCounters(lesson, 1, 1)
+
+        not_open = self.make_lesson(1, opens_in=timedelta(hours=1))
+        self.assertEqual(reserve_seat(not_open, first).status, ReservationStatus.NOT_OPEN)
+        self.assertEqual(
+            reserve_seat(not_open, first, enforce_open=False, allow_waitlist=False).status, ReservationStatus.RESERVED
+        )
+
+    def test_last_seat_is_claimed_once(self):
+        lesson = self.make_lesson(2)
+        first, second, third = self.make_students(3)
+        reserve_seat(lesson, first)
+        # 2人とも残り1席の時点の授業枠を読み込んでから予約する
+        stale_a = LessonSlot.objects.get(pk=lesson.pk)
+        stale_b = LessonSlot.objects.get(pk=lesson.pk)
+        self.assertEqual(stale_b.available_slots(), 1)
+
+        self.assertEqual(reserve_seat(stale_a, second, allow_waitlist=False).status, ReservationStatus.RESERVED)
+        self.assertEqual(reserve_seat(stale_b, third, allow_waitlist=False).status, ReservationStatus.FULL)
+        self.assertFalse(claim_seats(lesson.pk))
+        self.assertCounters(lesson, 2, 0)
+
+    def test_registration_is_rechecked_under_slot_lock(self):
+        lesson = self.make_lesson(1)
+        (first,) = self.make_students(1)
+        reserve_seat(lesson, first)
+        # 事前チェックの後、授業枠のロック前に同じ生徒の別リクエストが予約した場合を再現する
+        with mock.patch("booking.services._is_registered", side_effect=[False, True]):
+            outcome = reserve_seat(lesson, first)
+        self.assertEqual(outcome.status, ReservationStatus.DUPLICATE)
+        self.assertFalse(Waitlist.objects.filter(lesson_slot=lesson, student=first).exists())
+        self.assertCounters(lesson, 1, 0)
+
+    def test_admin_reserves_waitlisted_student(self):
+        lesson = self.make_lesson(1)
+        first, second = self.make_students(2)
+        reserve_seat(lesson, first)
+        reserve_seat(lesson, second)
+        admin = dict(enforce_open=False, allow_waitlist=False, from_waitlist=True)
+        self.assertEqual(reserve_seat(lesson, second, **admin).status, ReservationStatus.FULL)
+
+        LessonSlot.objects.filter(pk=lesson.pk).update(capacity=2)
+        self.assertEqual(reserve_seat(lesson, second, **admin).status, ReservationStatus.RESERVED)
+        self.assertEqual(reserve_seat(lesson, second, **admin).status, ReservationStatus.DUPLICATE)
+        self.assertFalse(Waitlist.objects.filter(lesson_slot=lesson).exists())
+        self.assertCounters(lesson, 2, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConcurrentLastSeatTest(CounterAssertions, TransactionTestCase):
+    """残り1席に同時に予約しても1人だけが予約できる（別スレッド・別接続から同時に送信）"""
+
+    def test_only_one_concurrent_claim_wins(self):
+        for _ in range(5):
+            lesson = self.make_lesson(1)
+            students = self.make_students(4)
+            barrier = threading.Barrier(len(students))
+            statuses = []
+
+            def reserve(student):
+                barrier.wait()
+                try:
+                    # テスト用のインメモリ SQLite（共有キャッシュ）は読み込みもテーブルロックで失敗するため、
+                    # 送信し直す（座席の確保は毎回 claim_seats を通るため、判定は変わらない）
+                    for _ in range(50):
+                        try:
+                            statuses.append(reserve_seat(lesson, student, allow_waitlist=False).status)
+                            return
+                        except OperationalError:
+                            time.sleep(0.01)
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=reserve, args=(student,)) for student in students]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(statuses), sorted([ReservationStatus.RESERVED] + [ReservationStatus.FULL] * 3))
+            self.assertCounters(lesson, 1, 0)
+
+    def test_failed_refresh_after_commit_does_not_retry_reservation(self):
+        lesson = self.make_lesson(1)
+        (student,) = self.make_students(1)
+        with mock.patch("booking.availability._refresh_counters", side_effect=OperationalError), \
+                self.assertLogs("django.db.backends.base", "ERROR"):
+            outcome = reserve_seat(lesson, student)
+        self.assertEqual(outcome.status, ReservationStatus.RESERVED)
+        self.assertCounters(lesson, 1, 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class WaitlistPromotionTest(CounterAssertions, TestCase):
+    """空席ができたときの補欠の繰り上げ（登録順）"""
+
+    def setUp(self):
+        cache.clear()
+
+    def _waitlist(self, lesson, students):
+        """students の順に補欠登録する（作成順と逆の登録日時を付け、登録日時の順に繰り上がることを確認する）"""
+        now = timezone.now()
+        for position, student in reversed(list(enumerate(students))):
+            entry = Waitlist.objects.create(lesson_slot=lesson, student=student)
+            Waitlist.objects.filter(pk=entry.pk).update(waitlisted_at=now - timedelta(minutes=10 - position))
+
+    def _reserved_names(self, lesson):
+        return sorted(Reservation.objects.filter(lesson_slot=lesson).values_list("student__name", flat=True))
+
+    def test_cancellation_promotes_oldest_entry(self):
+        lesson = self.make_lesson(1)
+        holder, *waiting = self.make_students(3)
+        reserve_seat(lesson, holder)
+        self._waitlist(lesson, waiting)
+
+        reservation = Reservation.objects.get(student=holder)
+        promoted = release_reservation(reservation)
+        self.assertEqual([entry.student_id for entry in promoted], [waiting[0].pk])
+        self.assertCounters(lesson, 1, 1)
+        # 繰り上げた補欠は利用状況の分析用に補欠の解除として記録する
+        self.assertEqual(BookingEvent.objects.filter(lesson_slot_id=lesson.pk, kind=BookingEvent.KIND_DEQUEUED).count(), 1)
+
+    def test_reserved_students_at_head_of_queue_are_skipped(self):
+        # 以前は満席の授業枠に再度申し込むと、予約済みの生徒も補欠登録されていた
+        lesson = self.make_lesson(2)
+        first, second, waiting = self.make_students(3)
+        reserve_seat(lesson, first)
+        reserve_seat(lesson, second)
+        self._waitlist(lesson, [second, waiting])
+
+        promoted = release_reservation(Reservation.objects.get(student=first))
+        self.assertEqual([entry.student_id for entry in promoted], [waiting.pk])
+        self.assertEqual(self._reserved_names(lesson), [second.name, waiting.name])
+        self.assertCounters(lesson, 2, 0)
+
+    def test_promote_all_waitlists_skips_reserved_students(self):
+        lesson = self.make_lesson(2)
+        holder, waiting = self.make_students(2)
+        reserve_seat(lesson, holder)
+        self._waitlist(lesson, [holder, waiting])
+
+        self.assertEqual(promote_all_waitlists(), 1)
+        self.assertEqual(self._reserved_names(lesson), [holder.name, waiting.name])
+        self.assertCounters(lesson, 2, 0)
+
+    def test_raising_capacity_promotes_that_many_entries(self):
+        staff = User.objects.create_user(username="staff", is_staff=True)
+        self.client.force_login(staff)
+        lesson = self.make_lesson(1)
+        holder, *waiting = self.make_students(4)
+        reserve_seat(lesson, holder)
+        self._waitlist(lesson, waiting)
+
+        local = timezone.localtime
+        self.client.post(reverse("admin_edit_lesson_slot", args=[lesson.pk]), {
+            "title": "",
+            "start_time": local(lesson.start_time).strftime("%Y-%m-%dT%H:%M"),
+            "end_time": local(lesson.end_time).strftime("%Y-%m-%dT%H:%M"),
+            "capacity": 3,
+            "reservation_start_time": local(lesson.reservation_start_time).strftime("%Y-%m-%dT%H:%M"),
+        })
+        self.assertEqual(self._reserved_names(lesson), ["生徒0", "生徒1", "生徒2"])
+        self.assertCounters(lesson, 3, 1)
+
+    def test_removing_student_frees_seats(self):
+        lessons = [self.make_lesson(1), self.make_lesson(1)]
+        holder, waiting = self.make_students(2)
+        for lesson in lessons:
+            reserve_seat(lesson, holder)
+            self._waitlist(lesson, [waiting])
+
+        self.assertEqual(len(remove_student(holder)), 2)
+        for lesson in lessons:
+            self.assertEqual(self._reserved_names(lesson), [waiting.name])
+            self.assertCounters(lesson, 1, 0)
+
+    def test_promote_all_waitlists_ranks_entries_per_slot(self):
+        lessons = [self.make_lesson(1), self.make_lesson(1)]
+        students = self.make_students(5)
+        self._waitlist(lessons[0], students[:3])
+        self._waitlist(lessons[1], students[3:])
+        # シグナルを通さずに定員を増やした場合（一括更新など）をまとめて繰り上げる
+        LessonSlot.objects.filter(pk=lessons[0].pk).update(capacity=2, reserved_count=0)
+        LessonSlot.objects.filter(pk=lessons[1].pk).update(capacity=5, reserved_count=0)
+        Reservation.objects.all().delete()
+
+        self.assertEqual(promote_all_waitlists(), 4)
+        self.assertEqual(self._reserved_names(lessons[0]), ["生徒0", "生徒1"])
+        self.assertCounters(lessons[0], 2, 1)
+        self.assertCounters(lessons[1], 2, 0)
+
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class StudentSearchTest(TestCase):
+    """管理者用カレンダーの生徒選択で使う生徒検索"""
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user(username="staff", password="pass", is_staff=True)
+        for username, names in [("tanaka", ["山田花子", "田中一郎"]), ("yamada", ["佐藤次郎"]), ("suzuki", ["鈴木三郎"])]:
+            family = Family.objects.create(user=User.objects.create_user(username=username))
+            for name in names:
+                Student.objects.create(family=family, name=name)
+        self.client.force_login(self.staff)
+
+    def _search(self, **params):
+        response = self.client.get(reverse("admin_student_search"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_prefix_matches_rank_before_substring_matches(self):
+        data = self._search(q="田")
+        # 生徒名の前方一致 → 部分一致の順（ユーザー名には一致しない）
+        self.assertEqual([row["text"] for row in data["results"]], ["田中一郎 (tanaka)", "山田花子 (tanaka)"])
+
+        data = self._search(q="yama")
+        self.assertEqual([row["text"] for row in data["results"]], ["佐藤次郎 (yamada)"])
+        self.assertEqual(data["results"][0]["id"], Student.objects.get(name="佐藤次郎").pk)
+
+    def test_limit_and_pagination(self):
+        first = self._search(limit=3)
+        self.assertEqual(len(first["results"]), 3)
+        self.assertTrue(first["pagination"]["more"])
+        second = self._search(limit=3, page=2)
+        self.assertEqual(len(second["results"]), 1)
+        self.assertFalse(second["pagination"]["more"])
+        self.assertEqual(
+            {row["id"] for row in first["results"] + second["results"]},
+            set(Student.objects.values_list("pk", flat=True)),
+        )
+
+        response = self.client.get(reverse("admin_student_search"), {"limit": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_is_one_query_regardless_of_roster(self):
+        family = Family.objects.get(user__username="suzuki")
+        Student.objects.bulk_create([Student(family=family, name=f"鈴木{i}") for i in range(30)])
+        with CaptureQueriesContext(connection) as ctx:
+            data = self._search(q="鈴木", limit=50)
+        self.assertEqual(len(data["results"]), 31)
+        # 保護者のユーザー名は select_related で同じクエリで取得する
+        self.assertEqual(len([q for q in ctx.captured_queries if "booking_student" in q["sql"]]), 1)
+
+    def test_staff_only(self):
+        parent = User.objects.get(username="tanaka")
+        self.client.force_login(parent)
+        response = self.client.get(reverse("admin_student_search"), {"q": "田"})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn("田中", response.content.decode())
+
+        self.client.logout()
+        response = self.client.get(reverse("admin_student_search"), {"q": "田"})
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CalendarWindowRangeTest(TestCase):
+    """カレンダーの表示期間の開始日 (start) の範囲外の指定"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="parent", password="pass")
+        Student.objects.create(family=Family.objects.create(user=self.user), name="生徒")
+        self.staff = User.objects.create_user(username="staff", password="pass", is_staff=True)
+
+    def test_far_future_start_is_clamped(self):
+        latest = timezone.localdate() + timedelta(days=MAX_DAYS_AHEAD)
+        for user, url_name in [(self.user, "reservation_calendar"), (self.staff, "admin_reservation_calendar")]:
+            self.client.force_login(user)
+            for span, start_date in [("week", latest), ("month", latest.replace(day=1))]:
+                for start in ["9999-12-31", "9999-12-01", "2999-01-01"]:
+                    response = self.client.get(reverse(url_name), {"start": start, "span": span})
+                    self.assertEqual(response.status_code, 200, (url_name, span, start))
+                    self.assertEqual(response.context["window"].start_date, start_date)
+
+    def test_next_link_stops_at_latest_window(self):
+        start = timezone.now() + timedelta(days=MAX_DAYS_AHEAD + 40)
+        LessonSlot.objects.create(
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=1,
+            reservation_start_time=timezone.now(),
+        )
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("reservation_calendar"))
+        self.assertIsNone(response.context["window"].next_date)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RecurrenceLinkTest(TestCase):
+    """授業枠が未作成の繰り返しルールの回しかない週・月への前後のリンク"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        Student.objects.create(family=Family.objects.create(user=user), name="生徒")
+        self.client.force_login(user)
+        self.today = timezone.localdate()
+        # 3週間後から1週間だけ適用されるルール（回は3週間後と4週間後の同じ曜日）
+        self.first = self.today + timedelta(days=21)
+        self.rule = RecurrenceRule.objects.create(
+            title="定期",
+            weekday=self.first.weekday(),
+            start_time=datetime_time(10),
+            end_time=datetime_time(11),
+            capacity=3,
+            reservation_open_offset=timedelta(days=7),
+            valid_from=self.first,
+            valid_until=self.first + timedelta(days=7),
+        )
+
+    def _window(self, **params):
+        response = self.client.get(reverse("reservation_calendar"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context["window"]
+
+    def test_links_reach_rule_only_weeks(self):
+        window = self._window()
+        self.assertEqual(window.next_date, self.first)
+        # 表示した週の回のみ作成し、リンク先の回はまだ作成しない
+        self.assertFalse(LessonSlot.objects.exists())
+
+        window = self._window(start=(self.first + timedelta(days=30)).isoformat())
+        self.assertEqual(window.prev_date, self.first + timedelta(days=1))
+        self.assertIsNone(window.next_date)
+
+        # 今月の表示では、翌月以降の最初の回を含む月にリンクする
+        window = self._window(span="month")
+        following = [day for day in (self.first, self.first + timedelta(days=7)) if day >= window.end_date]
+        self.assertEqual(window.next_date, following[0].replace(day=1) if following else None)
+
+    def test_skipped_occurrence_is_not_linked(self):
+        RecurrenceException.objects.create(rule=self.rule, date=self.first)
+        window = self._window()
+        self.assertEqual(window.next_date, self.first + timedelta(days=7))
+        self.rule.is_active = False
+        self.rule.save()
+        self.assertIsNone(self._window().next_date)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RecurrenceRuleChangeTest(CounterAssertions, TestCase):
+    """繰り返しルールの変更を予約済みの授業枠に反映する"""
+
+    def setUp(self):
+        cache.clear()
+        first = timezone.localdate() + timedelta(days=7)
+        self.rule = RecurrenceRule.objects.create(
+            title="定期",
+            weekday=first.weekday(),
+            start_time=datetime_time(10),
+            end_time=datetime_time(11),
+            capacity=1,
+            reservation_open_offset=timedelta(days=7),
+            valid_from=first,
+        )
+        materialize_occurrences(first, first + timedelta(days=7))
+        self.first, self.second = LessonSlot.objects.filter(recurrence_rule=self.rule).order_by("start_time")
+
+    def test_conflicting_titles_are_skipped_and_waitlists_promoted(self):
+        students = self.make_students(4)
+        for student in students[:3]:
+            reserve_seat(self.first, student, enforce_open=False)
+        reserve_seat(self.second, students[3], enforce_open=False)
+        # 2回目と同じ日時に、変更後の授業名の授業枠がすでにある
+        LessonSlot.objects.create(
+            title="新クラス", start_time=self.second.start_time, end_time=self.second.end_time,
+            capacity=1, reservation_start_time=self.second.reservation_start_time,
+        )
+
+        self.rule.title = "新クラス"
+        self.rule.capacity = 2
+        self.rule.save()
+        self.assertEqual([slot.pk for slot in self.rule._conflicting_slots], [self.second.pk])
+
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.title, self.first.capacity), ("新クラス", 2))
+        self.assertEqual((self.second.title, self.second.capacity), ("定期", 2))
+        # 定員が増えた分だけ補欠を繰り上げる
+        self.assertCounters(self.first, 2, 1)
+        self.assertTrue(Reservation.objects.filter(lesson_slot=self.first, student=students[1]).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SlotGenerationTest(TestCase):
+    """授業枠の一括作成（定義の生成・重複のスキップ・件数の確認のみの実行）"""
+
+    def setUp(self):
+        cache.clear()
+        # 月曜日から2週間
+        today = timezone.localdate()
+        self.monday = today + timedelta(days=7 - today.weekday())
+        self.opens = timezone.now()
+
+    def _definitions(self, title="", days=13, time_pairs=None):
+        return list(generate_slot_definitions(
+            self.monday, self.monday + timedelta(days=days), [0, 2],
+            time_pairs or parse_time_slots("10:00-11:00\n不正な行\n13:30 - 15:00\n"),
+            title=title, capacity=4, reservation_start_time=self.opens,
+        ))
+
+    def test_generate_slot_definitions(self):
+        definitions = self._definitions()
+        # 月・水 × 2週 × 2時間帯
+        self.assertEqual(len(definitions), 8)
+        first = definitions[0]
+        self.assertEqual(first.title, "書道教室")
+        self.assertEqual(timezone.localtime(first.start_time).date(), self.monday)
+        self.assertEqual(timezone.localtime(first.start_time).time(), datetime_time(10))
+        self.assertEqual(timezone.localtime(definitions[1].end_time).time(), datetime_time(15))
+        self.assertEqual(
+            sorted({timezone.localtime(d.start_time).weekday() for d in definitions}), [0, 2],
+        )
+
+    def test_dry_run_counts_without_writing(self):
+        definitions = self._definitions()
+        preview = write_lesson_slots(definitions + definitions[:2], dry_run=True)
+        self.assertEqual(preview, SlotWriteResult(total=10, created=8, skipped=2))
+        self.assertFalse(LessonSlot.objects.exists())
+
+    def test_existing_and_repeated_slots_are_skipped(self):
+        result = write_lesson_slots(self._definitions(days=6), batch_size=3)
+        self.assertEqual(result, SlotWriteResult(total=4, created=4, skipped=0))
+
+        # 作成済みの1週目はスキップし、入力内の重複（2週目の2回目）も1つだけ作成する
+        definitions = self._definitions()
+        result = write_lesson_slots(definitions + definitions[4:], batch_size=3)
+        self.assertEqual(result, SlotWriteResult(total=12, created=4, skipped=8))
+        self.assertEqual(LessonSlot.objects.count(), 8)
+
+        # 授業名が違えば同じ日時でも作成する
+        result = write_lesson_slots(self._definitions(title="特別授業", days=6))
+        self.assertEqual(result.created, 4)
+
+    def test_unique_constraint_blocks_concurrent_duplicates(self):
+        definitions = self._definitions(days=6)
+        write_lesson_slots(definitions)
+        # 同時に実行された別の一括作成を、既存の授業枠の確認をすり抜けた場合として再現する
+        with mock.patch("booking.slot_generation._existing_keys", return_value=set()):
+            write_lesson_slots(definitions)
+        self.assertEqual(LessonSlot.objects.count(), 4)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            LessonSlot.objects.create(**definitions[0]._asdict())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CalendarInvalidationTest(TestCase):
+    """予約・キャンセル・授業枠の編集が、次のカレンダー表示の残り枠数に反映されること"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(username="parent", password="pass")
+        self.student = Student.objects.create(family=Family.objects.create(user=user), name="生徒")
+        self.client.force_login(user)
+        self.staff_client = Client()
+        self.staff_client.force_login(User.objects.create_user(username="staff", password="pass", is_staff=True))
+        start = timezone.localtime().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        self.lesson = LessonSlot.objects.create(
+            title="授業",
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=2,
+            reservation_start_time=timezone.now() - timedelta(days=1),
+        )
+        self.day = start.date()
+
+    def _remaining(self):
+        """カレンダーに表示された授業枠の残り枠数"""
+        response = self.client.get(reverse("reservation_calendar"))
+        match = re.search(
+            rf'data-lesson-id="{self.lesson.pk}".*?class="remaining-slots"[^>]*>\s*(-?\d+)',
+            response.content.decode(), re.S,
+        )
+        self.assertIsNotNone(match)
+        return int(match.group(1))
+
+    def _version(self, day=None):
+        return date_versions([day or self.day])[day or self.day]
+
+    def test_reservation_and_cancellation_change_rendered_remaining(self):
+        self.assertEqual(self._remaining(), 2)
+        # 2回目の表示は断片キャッシュから描画される
+        self.assertEqual(self._remaining(), 2)
+        version = self._version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("reserve_lesson", args=[self.lesson.pk]), {"student_id": [self.student.pk]})
+        self.assertNotEqual(self._version(), version)
+        self.assertEqual(slot_availability(self.lesson.pk).reserved, 1)
+        self.assertEqual(self._remaining(), 1)
+
+        version = self._version()
+        reservation = Reservation.objects.get(student=self.student)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("cancel_reservation", args=[reservation.pk]))
+        self.assertNotEqual(self._version(), version)
+        self.assertEqual(slot_availability(self.lesson.pk).reserved, 0)
+        self.assertEqual(self._remaining(), 2)
+
+    def test_slot_edit_invalidates_snapshot_and_both_dates(self):
+        self.assertEqual(self._remaining(), 2)
+        version = self._version()
+        moved = self.lesson.start_time + timedelta(days=1)
+        moved_version = self._version(moved.date())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.staff_client.post(reverse("admin_edit_lesson_slot", args=[self.lesson.pk]), {
+                "title": "授業",
+                "start_time": timezone.localtime(moved).strftime("%Y-%m-%dT%H:%M"),
+                "end_time": timezone.localtime(moved + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M"),
+                "capacity": 5,
+                "reservation_start_time": timezone.localtime(self.lesson.reservation_start_time).strftime("%Y-%m-%dT%H:%M"),
+            })
+        self.assertEqual(response.status_code, 302)
+        # 変更前・変更後の日付の断片キャッシュとスナップショットの授業枠一覧を無効にする
+        self.assertNotEqual(self._version(), version)
+        self.assertNotEqual(self._version(moved.date()), moved_version)
+        self.assertIsNone(slot_availability(self.lesson.pk))
+        self.assertEqual(self._remaining(), 5)
+        self.assertEqual(slot_availability(self.lesson.pk).start_time, moved)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AsgiViewsTest(TransactionTestCase):
+    """ASGI で DB 処理をスレッドプールで実行する非同期ビュー（予約・カレンダー・キャンセル）"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="parent", password="pass")
+        self.student = Student.objects.create(family=Family.objects.create(user=self.user), name="生徒")
+        start = timezone.now() + timedelta(days=1)
+        self.lesson = LessonSlot.objects.create(
+            title="授業",
+            start_time=start,
+            end_time=start + timedelta(hours=1),
+            capacity=1,
+            reservation_start_time=timezone.now() - timedelta(days=1),
+        )
+
+    async def test_reserve_render_and_cancel(self):
+        await self.async_client.aforce_login(self.user)
+        # 非同期 ORM・既定の sync_to_async が DB 処理を実行するスレッド
+        shared_thread = await sync_to_async(threading.get_ident)()
+        db_threads = set()
+        reserve = reserve_group
+
+        def record_thread(*args, **kwargs):
+            db_threads.add(threading.get_ident())
+            return reserve(*args, **kwargs)
+
+        with mock.patch("booking.views.reserve_group", record_thread):
+            response = await self.async_client.post(
+                reverse("reserve_lesson", args=[self.lesson.pk]),
+                {"student_id": [self.student.pk]}, headers={"Accept": "application/json"},
+            )
+        self.assertEqual(response.json()["results"][0]["status"], ReservationStatus.RESERVED.value)
+        self.assertTrue(db_threads)
+        self.assertNotIn(shared_thread, db_threads)
+
+        response = await self.async_client.get(reverse("reservation_calendar"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, self.lesson.title)
+
+        reservation = await Reservation.objects.aget(student=self.student)
+        response = await self.async_client.post(reverse("cancel_reservation", args=[reservation.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(await Reservation.objects.filter(pk=reservation.pk).aexists())
+
+        response = await self.async_client.post(reverse("reserve_lesson", args=[self.lesson.pk + 1]))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SignUpTest(TestCase):
+    """保護者アカウントの作成"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_signup_creates_family_and_logs_in(self):
+        response = self.client.post(reverse("signup"), {
+            "username": "newparent",
+            "password1": "Shodo-pass-2024",
+            "password2": "Shodo-pass-2024",
+        })
+        self.assertRedirects(response, reverse("reservation_calendar"))
+        user = User.objects.get(username="newparent")
+        self.assertTrue(Family.objects.filter(user=user).exists())
+        self.assertEqual(self.client.session["_auth_user_id"], str(user.pk))
+        self.assertEqual(self.client.session["_auth_user_backend"], "booking.identity.CachedModelBackend")
+        self.assertEqual(self.client.get(reverse("reservation_calendar")).status_code, 200)
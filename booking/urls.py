@@ -20,6 +20,8 @@ urlpatterns = [
     path('students/<int:student_id>/edit/', views.edit_student, name='edit_student'),
     path('students/<int:student_id>/delete/', views.delete_student, name='delete_student'),
     path('calendar/', views.reservation_calendar, name='reservation_calendar'),
+    path('api/availability/', views.availability_api, name='availability_api'),
+    path('api/availability/events/', views.slot_events, name='slot_events'),
     path('reserve/<int:lesson_id>/', views.reserve_lesson, name='reserve_lesson'),
     path('reservations/<int:reservation_id>/cancel/', views.cancel_reservation, name='cancel_reservation'),
 ]
@@ -33,12 +35,17 @@ admin_urlpatterns = [
     path('admin-dashboard/lessons/<int:lesson_id>/edit/', admin_views.edit_lesson_slot, name='admin_edit_lesson_slot'),
     path('admin-dashboard/lessons/<int:lesson_id>/delete/', admin_views.delete_lesson_slot, name='admin_delete_lesson_slot'),
     path('admin-dashboard/reservations/', admin_views.reservation_list, name='admin_reservation_list'),
+    path('admin-dashboard/exports/<slug:kind>.csv', admin_views.export_csv, name='admin_export_csv'),
+    path('admin-dashboard/metrics/', admin_views.metrics, name='admin_metrics'),
     path('admin-dashboard/students/', admin_views.student_management, name='admin_student_management'),
+    path('admin-dashboard/students/search/', admin_views.student_search, name='admin_student_search'),
+    path('admin-dashboard/students/import/', admin_views.import_families, name='admin_import_families'),
     path('admin-dashboard/students/add/<int:family_id>/', admin_views.add_student_admin, name='admin_add_student'),
     path('admin-dashboard/students/<int:student_id>/edit/', admin_views.edit_student_admin, name='admin_edit_student'),
     path('admin-dashboard/students/<int:student_id>/delete/', admin_views.delete_student_admin, name='admin_delete_student'),
     path('admin-dashboard/reservations/<int:reservation_id>/cancel/', admin_views.cancel_reservation_admin, name='admin_cancel_reservation'),
     path('admin-dashboard/calendar/', admin_views.admin_reservation_calendar, name='admin_reservation_calendar'),
+    path('admin-dashboard/analytics/', admin_views.occupancy_report_view, name='admin_occupancy_report'),
     path('admin-dashboard/reserve/<int:lesson_id>/', admin_views.admin_reserve_lesson, name='admin_reserve_lesson'),
 ]
 
@@ -5,10 +5,21 @@ from django.contrib.auth import login, logout
 from django.urls import reverse_lazy
 from django.views.generic.edit import CreateView
 from django.contrib import messages
-from datetime import timedelta, datetime
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import condition
+from django.db.models import BooleanField, ExpressionWrapper, F, Prefetch, Q, prefetch_related_objects
 from collections import defaultdict
-from .models import Family, Student, LessonSlot, Reservation, Waitlist
+from .models import Family, LessonSlot, Reservation, Waitlist
+from .async_db import run_db
+from .availability import by_local_date, changed_at, version as availability_version, window_availability
+from .calendar_cache import CALENDAR_FRAGMENT_TIMEOUT, cached_fragment_dates, date_versions, lessons_state
+from .calendar_window import CalendarWindow
 from .forms import StudentForm
+from .identity import get_family_or_404, get_student_or_404
+from .live import MAX_SUBSCRIBED_SLOTS, hub
+from .recurrence import materialize_window
+from .services import ReservationStatus, release_reservation, remove_student, reserve_group
 from django.utils import timezone
 
 # ユーザー登録(保護者アカウント作成)
@@ -22,16 +33,17 @@ class SignUpView(CreateView):
         user = form.save()
         # ユーザーに紐づくFamilyモデルを自動作成
         Family.objects.create(user=user)
-        # ログインさせる
-        login(self.request, user)
+        # ログインさせる（認証バックエンドが複数あるため、使用するバックエンドを指定する）
+        login(self.request, user, backend='booking.identity.CachedModelBackend')
         return redirect(self.success_url)
 
 # 生徒閲覧・管理(保護者用)
 @login_required
 def view_students(request):
     """保護者による生徒閲覧・管理"""
-    family = get_object_or_404(Family, user=request.user)
-    students = Student.objects.filter(family=family)
+    # 家族・生徒は FamilyMiddleware がキャッシュから設定したものを使う
+    family = get_family_or_404(request)
+    students = request.students
     
     context = {
         'students': students,
@@ -43,7 +55,7 @@ def view_students(request):
 @login_required
 def add_student(request):
     """保護者による生徒追加"""
-    family = get_object_or_404(Family, user=request.user)
+    family = get_family_or_404(request)
     
     if request.method == 'POST':
         form = StudentForm(request.POST)
@@ -66,8 +78,8 @@ def add_student(request):
 @login_required
 def edit_student(request, student_id):
     """保護者による生徒編集"""
-    family = get_object_or_404(Family, user=request.user)
-    student = get_object_or_404(Student, pk=student_id, family=family)
+    family = get_family_or_404(request)
+    student = get_student_or_404(request, student_id)
     
     if request.method == 'POST':
         form = StudentForm(request.POST, instance=student)
@@ -89,12 +101,12 @@ def edit_student(request, student_id):
 @login_required
 def delete_student(request, student_id):
     """保護者による生徒削除"""
-    family = get_object_or_404(Family, user=request.user)
-    student = get_object_or_404(Student, pk=student_id, family=family)
+    family = get_family_or_404(request)
+    student = get_student_or_404(request, student_id)
     
     if request.method == 'POST':
         student_name = student.name
-        student.delete()
+        remove_student(student)
         messages.success(request, f"生徒「{student_name}」を削除しました。")
         return redirect('view_students')
     
@@ -104,80 +116,247 @@ def delete_student(request, student_id):
     }
     return render(request, 'booking/delete_student.html', context)
 
-# 予約カレンダー画面(日別表示)
-@login_required
-def reservation_calendar(request):
-    family = get_object_or_404(Family, user=request.user)
-    students = Student.objects.filter(family=family)
-    
-    # 今後の授業枠を取得
-    lessons = LessonSlot.objects.filter(start_time__gte=timezone.now()).order_by('start_time')
+def _calendar_lessons(now):
+    """予約カレンダーに表示する授業枠（残り枠数と予約可否を付加）"""
+    return LessonSlot.objects.annotate(
+        remaining_slots=F('capacity') - F('reserved_count'),
+        reservable=ExpressionWrapper(
+            Q(reservation_start_time__lte=now, capacity__gt=F('reserved_count')),
+            output_field=BooleanField(),
+        ),
+    ).order_by('start_time')
+
+
+def _calendar_data(window, now, students):
+    """
+    予約カレンダーの DB 処理（生徒の予約・繰り返しルールの回の作成・空き状況・断片キャッシュがない日付の授業枠）を
+    まとめて行い、日付ごとの (日付, 授業枠, バージョン, 予約可否) のリストを返す。
+    非同期ビューからは run_db で1回の呼び出しで実行する。
+    """
+    # 予約一覧は授業枠ごと一括取得し、テンプレート内でクエリが発生しないようにする
+    prefetch_related_objects(
+        students,
+        Prefetch(
+            'reservation_set',
+            queryset=Reservation.objects.select_related('lesson_slot').order_by('lesson_slot__start_time'),
+        ),
+    )
+
+    # 繰り返しルールの回のうち、表示期間内で未作成のものを作成し、前後の期間へのリンクを求める
+    occurrences = materialize_window(window)
+    window.resolve_links(LessonSlot.objects.all(), occurrences)
     
-    # 日付ごとにグループ化
-    lessons_by_date = defaultdict(list)
-    for lesson in lessons:
-        date_key = lesson.start_time.date()
-        lessons_by_date[date_key].append(lesson)
+    # 表示期間内の授業枠の日付と予約可否は空き状況スナップショットから求める
+    slots_by_date = by_local_date(window_availability(window.start, window.end))
+    versions = date_versions([date_key for date_key, _ in slots_by_date])
+    states = {date_key: lessons_state(slots, now) for date_key, slots in slots_by_date}
+    cached_dates = cached_fragment_dates(
+        'calendar_day',
+        {date_key: [date_key, versions[date_key], states[date_key], bool(students)] for date_key, _ in slots_by_date},
+    )
     
-    # 日付順にソート
-    sorted_lessons_by_date = sorted(lessons_by_date.items())
+    # 授業枠の内容は断片キャッシュがない日付の分だけ1クエリで取得する
+    # （キャッシュがある日付も、描画までに期限切れになった場合に備えて遅延評価のクエリセットを渡す）
+    lessons = _calendar_lessons(now)
+    missed = defaultdict(list)
+    for lesson in lessons.filter(pk__in=[
+        pk for date_key, slots in slots_by_date if date_key not in cached_dates for pk, _ in slots
+    ]):
+        missed[timezone.localtime(lesson.start_time).date()].append(lesson)
+    return [
+        (
+            date_key,
+            lessons.filter(pk__in=[pk for pk, _ in slots]) if date_key in cached_dates else missed[date_key],
+            versions[date_key],
+            states[date_key],
+        )
+        for date_key, slots in slots_by_date
+    ]
+
+
+# 予約カレンダー画面(日別表示)
+@login_required
+async def reservation_calendar(request):
+    user = await request.auser()
+    family = get_family_or_404(request)
+    students = list(request.students)
+    now = timezone.now()
+    window = CalendarWindow.from_request(request, now=now)
+    sorted_lessons_by_date = await run_db(request, _calendar_data, window, now, students)
     
     context = {
+        # 認証済みユーザーは取得済みのものを使い、テンプレートでの再取得を避ける
+        'user': user,
         'family': family,
         'students': students,
         'lessons_by_date': sorted_lessons_by_date,
+        'has_students': bool(students),
+        'window': window,
+        'fragment_timeout': CALENDAR_FRAGMENT_TIMEOUT,
     }
-    return render(request, 'booking/calendar.html', context)
+    # テンプレートはセッション（メッセージ）や遅延評価のクエリセットを参照するため、同期処理として描画する
+    return await run_db(request, render, request, 'booking/calendar.html', context)
 
 # 予約処理
+# 生徒ごとの結果のメッセージ（同じ結果の兄弟は1つのメッセージにまとめる）
+RESERVATION_MESSAGES = {
+    ReservationStatus.RESERVED: (messages.SUCCESS, '{names}の予約が完了しました。'),
+    ReservationStatus.WAITLISTED: (messages.INFO, '{names}を補欠登録しました。'),
+    ReservationStatus.FULL: (messages.ERROR, '全員分の空きがないため、{names}の予約は行いませんでした。'),
+    ReservationStatus.DUPLICATE: (messages.ERROR, '{names}はすでに予約済みまたは補欠登録済みです。'),
+    ReservationStatus.NOT_OPEN: (messages.ERROR, '予約開始時刻前です。'),
+}
+
 @login_required
-def reserve_lesson(request, lesson_id):
-    lesson = get_object_or_404(LessonSlot, pk=lesson_id)
-    family = get_object_or_404(Family, user=request.user)
+async def reserve_lesson(request, lesson_id):
+    """予約（複数の生徒を選んだ場合は兄弟まとめて1回で予約する）"""
+    lesson = await run_db(request, get_object_or_404, LessonSlot, pk=lesson_id)
     
     if request.method == 'POST':
-        student_id = request.POST.get('student_id')
-        student = get_object_or_404(Student, pk=student_id, family=family)
-        
-        # 予約開始時刻チェック
-        if timezone.now() < lesson.reservation_start_time:
-            messages.error(request, '予約開始時刻前です。')
+        student_ids = request.POST.getlist('student_id')
+        if not student_ids:
+            get_family_or_404(request)
+            messages.error(request, '予約する生徒を選択してください。')
             return redirect('reservation_calendar')
-
-        # 予約処理
-        if lesson.available_slots() > 0:
-            try:
-                Reservation.objects.create(lesson_slot=lesson, student=student)
-                messages.success(request, f'{student.name}の予約が完了しました。')
-            except Exception as e:
-                messages.error(request, '予約に失敗しました。すでに予約済みの可能性があります。')
+        students = [get_student_or_404(request, student_id) for student_id in student_ids]
+        all_or_nothing = request.POST.get('mode') == 'all'
         
-        # 補欠処理
-        elif lesson.available_slots() <= 0:
-            try:
-                Waitlist.objects.create(lesson_slot=lesson, student=student)
-                messages.info(request, f'{student.name}を補欠登録しました。')
-            except Exception as e:
-                messages.error(request, '補欠登録に失敗しました。すでに登録済みの可能性があります。')
+        # 予約処理（空席があれば予約、満席なら補欠登録）。トランザクションを使うため同期処理として実行する
+        results = await run_db(request, reserve_group, lesson, students, all_or_nothing=all_or_nothing)
+        if 'application/json' in request.headers.get('Accept', ''):
+            return JsonResponse({'results': [
+                {'student_id': student.pk, 'status': outcome.status.value} for student, outcome in results
+            ]})
+        names = defaultdict(list)
+        for student, outcome in results:
+            names[outcome.status].append(student.name)
+        for status, (level, text) in RESERVATION_MESSAGES.items():
+            if names[status]:
+                messages.add_message(request, level, text.format(names='・'.join(names[status])))
 
     return redirect('reservation_calendar')
 
 # 予約キャンセル(保護者用)
 @login_required
-def cancel_reservation(request, reservation_id):
+async def cancel_reservation(request, reservation_id):
     """保護者による予約キャンセル"""
-    family = get_object_or_404(Family, user=request.user)
-    reservation = get_object_or_404(Reservation, pk=reservation_id, student__family=family)
+    user = await request.auser()
+    family = get_family_or_404(request)
+    reservation = await run_db(
+        request,
+        get_object_or_404,
+        Reservation.objects.select_related('student', 'lesson_slot'),
+        pk=reservation_id,
+        student__family=family,
+    )
     
     if request.method == 'POST':
         student_name = reservation.student.name
         lesson_title = reservation.lesson_slot.title or '書道教室'
-        reservation.delete()
+        await run_db(request, release_reservation, reservation)
         messages.success(request, f'{student_name}の"{lesson_title}"への予約をキャンセルしました。')
         return redirect('reservation_calendar')
     
     context = {
+        'user': user,
         'reservation': reservation,
         'family': family
     }
-    return render(request, 'booking/cancel_reservation.html', context)
+    return await run_db(request, render, request, 'booking/cancel_reservation.html', context)
+
+
+# 空き状況 API（予約カレンダーの定期更新用）
+def _availability_state(request):
+    """表示期間とその空き状況（ETag・Last-Modified・本体で同じ値を使うため、リクエストごとに1回だけ求める）"""
+    if not hasattr(request, '_availability_state'):
+        window = CalendarWindow.from_request(request)
+        request._availability_state = (window, window_availability(window.start, window.end))
+    return request._availability_state
+
+
+def _availability_etag(request):
+    # 予約開始時刻の到来や開始済み授業枠の除外はバージョンに現れないため、件数もキーに含める
+    window, slots = _availability_state(request)
+    opened = sum(1 for slot in slots.values() if slot.opens_at <= window.now)
+    return f"{availability_version()}-{request.user.pk}-{window.start_date}-{window.span}-{len(slots)}-{opened}"
+
+
+def _availability_last_modified(request):
+    window, slots = _availability_state(request)
+    opened_at = [slot.opens_at for slot in slots.values() if slot.opens_at <= window.now]
+    candidates = [value for value in [changed_at(), max(opened_at, default=None)] if value is not None]
+    return max(candidates, default=None)
+
+
+@login_required
+@condition(etag_func=_availability_etag, last_modified_func=_availability_last_modified)
+def availability_api(request):
+    """
+    表示期間内の授業枠の残り枠数・予約可否と、家族の生徒の予約・補欠状況を JSON で返す。
+    空き状況が変わっていなければ ETag により 304 を返す（DB にはアクセスしない）。
+    """
+    family = get_family_or_404(request)
+    window, slots = _availability_state(request)
+
+    reserved = defaultdict(list)
+    for lesson_slot_id, student_id in Reservation.objects.filter(
+        student__family=family, lesson_slot_id__in=slots,
+    ).values_list('lesson_slot_id', 'student_id'):
+        reserved[lesson_slot_id].append(student_id)
+    waitlisted = defaultdict(list)
+    for lesson_slot_id, student_id in Waitlist.objects.filter(
+        student__family=family, lesson_slot_id__in=slots,
+    ).values_list('lesson_slot_id', 'student_id'):
+        waitlisted[lesson_slot_id].append(student_id)
+
+    response = JsonResponse({
+        'start': window.start_date.isoformat(),
+        'end': window.last_date.isoformat(),
+        'span': window.span,
+        'students': [
+            {'id': student.pk, 'name': student.name}
+            for student in request.students
+        ],
+        'slots': [
+            {
+                'id': pk,
+                'start_time': slot.start_time.isoformat(),
+                'capacity': slot.capacity,
+                'remaining': slot.remaining,
+                'waitlisted': slot.waitlisted,
+                'reservation_start_time': slot.opens_at.isoformat(),
+                'reservable': slot.is_reservable(window.now),
+                'reserved_student_ids': reserved[pk],
+                'waitlisted_student_ids': waitlisted[pk],
+            }
+            for date_key, day_slots in by_local_date(slots)
+            for pk, slot in day_slots
+        ],
+    })
+    # ブラウザにキャッシュさせつつ、毎回 ETag で再検証させる
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# 空き状況のライブ更新(Server-Sent Events)
+@login_required
+async def slot_events(request):
+    """
+    指定した授業枠（?slots=1,2,3）の予約数の変更を Server-Sent Events で配信する。
+    接続はイベントループ上で待機するだけなので、1プロセスで多数の接続を保持できる。
+    WSGI で動作している場合はワーカーを占有しないよう 204 を返し、ブラウザに再接続させない
+    （その場合は空き状況 API の定期取得で更新される）。
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    try:
+        slot_ids = {int(value) for value in request.GET.get('slots', '').split(',') if value}
+    except ValueError:
+        return HttpResponse(status=400)
+    slot_ids = set(sorted(slot_ids)[:MAX_SUBSCRIBED_SLOTS])
+
+    response = StreamingHttpResponse(hub.stream(slot_ids), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx などのプロキシにバッファリングさせない
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -8,8 +8,23 @@ python manage.py migrate --noinput
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+# バックグラウンドジョブのワーカーを起動（JOB_WORKER_CONCURRENCY=0 で無効）
+JOB_WORKER_CONCURRENCY=${JOB_WORKER_CONCURRENCY:-2}
+if [ "$JOB_WORKER_CONCURRENCY" != "0" ]; then
+    echo "Starting job worker..."
+    python manage.py run_jobs --concurrency "$JOB_WORKER_CONCURRENCY" &
+fi
+
+# 前回の起動時のワーカーのメトリクスを削除
+python manage.py reset_metrics
+
 # Gunicornでアプリケーションを起動
 echo "Starting Gunicorn..."
 # Renderの環境変数PORTを使用。未設定の場合は8000をデフォルトとする
 PORT=${PORT:-8000}
+# SERVER_INTERFACE=asgi の場合は Uvicorn ワーカーで ASGI として起動する（DEPLOYMENT.md 参照）
+# （空き状況のライブ更新（Server-Sent Events）は ASGI の場合のみ有効）
+if [ "$SERVER_INTERFACE" = "asgi" ]; then
+    exec gunicorn shodo_reserve.asgi:application -k uvicorn_worker.UvicornWorker --bind 0.0.0.0:$PORT
+fi
 exec gunicorn shodo_reserve.wsgi:application --bind 0.0.0.0:$PORT
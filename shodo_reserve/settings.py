@@ -41,11 +41,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'booking.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'booking.profiling.ProfilingMiddleware',
+    'booking.identity.FamilyMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -99,6 +102,48 @@ else:
         )
     }
 
+# キャッシュ（カレンダーの断片キャッシュなど）
+# gunicorn の複数ワーカー間で共有できるよう、追加のサービスが不要なファイルベースのキャッシュを使う
+import tempfile
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('DJANGO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'shodo_reserve_cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# セッションはキャッシュから読み、キャッシュにない場合だけ DB を参照する。
+# DJANGO_SESSION_ENGINE=signed_cookies で、セッションを署名付き Cookie に保存（DB・キャッシュを使わない）
+SESSION_ENGINE = {
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+    'db': 'django.contrib.sessions.backends.db',
+}[os.environ.get('DJANGO_SESSION_ENGINE', 'cached_db')]
+
+# ログイン中のユーザー・家族・生徒をキャッシュから取得する（booking.identity）。
+# 変更前からのセッションがログアウトされないよう、標準の ModelBackend も残す
+AUTHENTICATION_BACKENDS = [
+    'booking.identity.CachedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# URL 名ごとのレスポンス時間・SQL の件数などの集計（booking.metrics）。
+# gunicorn の各ワーカーがこのディレクトリに集計を書き出し、/admin-dashboard/metrics/ で合計して返す
+METRICS_DIR = os.environ.get('DJANGO_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'shodo_reserve_metrics'))
+# 設定すると Authorization: Bearer <トークン> でもメトリクスを取得できる（Prometheus からの収集用）
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# リクエストのプロファイル（booking.profiling）。DJANGO_PROFILE_SAMPLE_RATE の割合（0〜1、既定は0）のリクエストと、
+# X-Profile ヘッダーを付けた管理者のリクエストを cProfile で計測して保存する
+PROFILE_SAMPLE_RATE = float(os.environ.get('DJANGO_PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.environ.get('DJANGO_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'shodo_reserve_profiles'))
+# 保存するプロファイルの合計サイズの上限。超えた分は古いものから削除する
+PROFILE_MAX_BYTES = int(os.environ.get('DJANGO_PROFILE_MAX_MB', '100')) * 1024 * 1024
+
 
 
 
@@ -144,6 +189,10 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# 授業枠の開始日時インデックスの付加列（INCLUDE）は PostgreSQL でのみ作成される。
+# ローカルの SQLite では付加列なしのインデックスになるため、その警告は表示しない
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
 # ログイン後のリダイレクト先
 LOGIN_REDIRECT_URL = 'reservation_calendar'
 LOGOUT_REDIRECT_URL = '/accounts/login/'